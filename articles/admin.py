@@ -1,16 +1,28 @@
-from django.contrib import admin
+import uuid
 
-from .models import AdvUser, Category, Article, Gender, Notifications
+from django.conf import settings
+from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, JsonResponse
+from django.db.models.functions import Length
+from django.shortcuts import get_object_or_404, redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils import timezone
+
+from .exports import DATASETS, FORMATS, export_response
+from .models import AdvUser, Category, Article, ArticleRevision, Gender, SlowQuery, Task
+from .moderation import get_progress, pending_page, set_progress
+from .paginators import EstimatedCountPaginator
+from .revisions import diff_revisions, get_revision
+from .slow_queries import export_jsonl
+from .tasks import approve_pending
+from .utilities import parse_int
 
 
 def activate_articles(modeladmin, request, queryset):
-    for rec in queryset:
-        if not rec.is_active:
-            rec.is_active = True
-            rec.save()
-            notification = Notifications.objects.create(user=rec.author, sender=f'articles/{rec.pk}/', n_type='Статья опубликована', content='Ваша статья была опубликована')
-            notification.save()
-    modeladmin.message_user(request, 'Выбранные статьи активированы.')
+    approve_pending.delay(list(queryset.filter(is_active=False).values_list('pk', flat=True)))
+    modeladmin.message_user(request, 'Выбранные статьи поставлены в очередь на публикацию.')
     
 
 activate_articles.short_description = 'Активация выбранных статей (пометка как модерированных).'
@@ -27,7 +39,12 @@ admin.site.register(Gender, GenderAdmin)
 # User admin panel.
 class AdvUserAdmin(admin.ModelAdmin):
     list_display = ('__str__', 'company', 'is_activated', 'date_joined')
+    list_select_related = ('company', )
+    # Searched with trigram indexes on PostgreSQL (migration 0024).
     search_fields = ('username', 'email', 'first_name', 'last_name')
+    date_hierarchy = 'date_joined'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     fields = (('username', 'email'),
               'gender',
               ('first_name', 'last_name'),
@@ -71,12 +88,166 @@ admin.site.register(Category, CategoryAdmin)
 # Article admin.
 class ArticleAdmin(admin.ModelAdmin):
     list_display = ('title', 'category', 'author', 'created_at', 'total_rating', 'is_active', )
+    list_select_related = ('category', 'author', )
+    list_filter = ('is_active', )
     # filter_horizontal = ('tags', )
-    search_fields = ('title', 'rubric', )
+    # Title is searched with a trigram index on PostgreSQL, author by exact username.
+    search_fields = ('title', '=author__username', )
+    date_hierarchy = 'created_at'
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     readonly_fields = ('views',
                        'created_at',
                        )
     actions = (activate_articles, )
+
+    def get_urls(self):
+        return [
+            path('moderation/', self.admin_site.admin_view(self.moderation_view), name='articles_article_moderation'),
+            path('moderation/progress/', self.admin_site.admin_view(self.moderation_progress), name='articles_article_moderation_progress'),
+            path('<int:pk>/revisions/', self.admin_site.admin_view(self.revisions_view), name='articles_article_revisions'),
+            path('export/', self.admin_site.admin_view(self.export_view), name='articles_article_export'),
+            path('export/<str:dataset>/', self.admin_site.admin_view(self.export_download), name='articles_article_export_download'),
+        ] + super().get_urls()
+
+    # Queue of articles waiting for moderation, oldest first, paginated by ?after=<pk>.
+    # POST queues publishing of selected ids or, with "all", of the whole queue.
+    def moderation_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        if request.method == 'POST':
+            ids = None if request.POST.get('all') else [pk for pk in map(parse_int, request.POST.getlist('ids')) if pk is not None]
+            # Published by a background task, the page polls progress of the job.
+            job = request.POST.get('job') or uuid.uuid4().hex
+            set_progress(job, 0, len(ids) if ids is not None else None)
+            approve_pending.delay(ids, job=job)
+            if request.is_ajax():
+                return JsonResponse({'job': job})
+            self.message_user(request, 'Статьи поставлены в очередь на публикацию.')
+            return redirect(request.get_full_path())
+
+        after = request.GET.get('after')
+        articles = pending_page(parse_int(after, 0))
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Очередь модерации',
+            opts=self.model._meta,
+            articles=articles,
+            next_after=articles[-1].pk if len(articles) >= settings.MODERATION_PAGE_SIZE else None,
+        )
+        return TemplateResponse(request, 'admin/articles/article/moderation.html', context)
+
+    def moderation_progress(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        return JsonResponse(get_progress(request.GET.get('job', '')) or {})
+
+    # History of an article with a diff of two revisions: ?a=<number>&b=<number>,
+    # by default the latest revision against the previous one.
+    def revisions_view(self, request, pk):
+        article = get_object_or_404(Article, pk=pk)
+        if not self.has_view_or_change_permission(request, article):
+            raise PermissionDenied
+        revisions = list(ArticleRevision.objects.filter(article=article).select_related('editor')
+                         .annotate(stored=Length('data')).defer('data').order_by('-number'))
+        numbers = [revision.number for revision in revisions]
+        b = parse_int(request.GET.get('b'), numbers[0] if numbers else None)
+        a = parse_int(request.GET.get('a'), numbers[1] if len(numbers) > 1 else None)
+        diff = None
+        if a in numbers and b in numbers:
+            diff = diff_revisions(get_revision(article.pk, a), get_revision(article.pk, b))
+        context = dict(
+            self.admin_site.each_context(request),
+            title=f'История статьи «{article}»',
+            opts=self.model._meta,
+            article=article,
+            revisions=revisions,
+            a=a, b=b, diff=diff,
+            size=sum(revision.size for revision in revisions),
+            stored=sum(revision.stored or 0 for revision in revisions),
+        )
+        return TemplateResponse(request, 'admin/articles/article/revisions.html', context)
+
+    # Downloads of articles, users, votes and views for analytics.
+    def export_view(self, request):
+        datasets = [name for name, dataset in DATASETS.items() if request.user.has_perm(dataset.permission)]
+        if not datasets:
+            raise PermissionDenied
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Экспорт данных',
+            opts=self.model._meta,
+            datasets=datasets,
+            formats=list(FORMATS),
+        )
+        return TemplateResponse(request, 'admin/articles/article/export.html', context)
+
+    # Streams a dataset: ?format=csv|jsonl&gzip=1.
+    def export_download(self, request, dataset):
+        fmt = request.GET.get('format', 'csv')
+        if dataset not in DATASETS or fmt not in FORMATS:
+            raise Http404
+        if not request.user.has_perm(DATASETS[dataset].permission):
+            raise PermissionDenied
+        return export_response(dataset, fmt, compress=request.GET.get('gzip') == '1')
     
     
 admin.site.register(Article, ArticleAdmin)
+
+
+def export_slow_queries(modeladmin, request, queryset):
+    return export_jsonl(queryset)
+
+
+export_slow_queries.short_description = 'Экспорт выбранных запросов в JSONL.'
+
+
+# Slow query log admin (read only).
+class SlowQueryAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'duration', 'view', '__str__', 'analyzed')
+    list_filter = ('view', 'database', 'analyzed')
+    search_fields = ('sql', 'path')
+    readonly_fields = ('created_at', 'duration', 'database', 'view', 'path', 'sql', 'params', 'plan', 'analyzed')
+    actions = (export_slow_queries, )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def get_urls(self):
+        export = self.admin_site.admin_view(self.export_view)
+        return [path('export/', export, name='articles_slowquery_export')] + super().get_urls()
+
+    # All records as JSONL: admin/articles/slowquery/export/
+    def export_view(self, request):
+        if not self.has_view_permission(request):
+            raise PermissionDenied
+        return export_jsonl(SlowQuery.objects.all())
+
+
+admin.site.register(SlowQuery, SlowQueryAdmin)
+
+
+def retry_tasks(modeladmin, request, queryset):
+    count = queryset.exclude(status=Task.RUNNING).update(status=Task.QUEUED, attempts=0, run_at=timezone.now(), error='')
+    modeladmin.message_user(request, f'Поставлено в очередь задач: {count}.')
+
+
+retry_tasks.short_description = 'Повторить выбранные задачи.'
+
+
+# Background tasks admin (read only).
+class TaskAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'queue', 'status', 'attempts', 'run_at', 'duration', 'worker')
+    list_filter = ('status', 'queue', 'name')
+    readonly_fields = ('name', 'queue', 'payload', 'status', 'attempts', 'max_attempts', 'run_at', 'worker',
+                       'started_at', 'heartbeat_at', 'finished_at', 'duration', 'error', 'created_at')
+    actions = (retry_tasks, )
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(Task, TaskAdmin)
@@ -0,0 +1,221 @@
+import base64
+import json
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.views.decorators.http import require_GET
+from tagging.models import Tag
+from tagging.utils import parse_tag_input
+
+from .models import AdvUser, Article, Category
+from .utilities import parse_int
+
+
+class ApiError(Exception):
+    pass
+
+
+def _image(obj, field, url_field):
+    image = getattr(obj, field)
+    if image:
+        return image.url
+    return getattr(obj, url_field) or None
+
+
+# Field of API resource.
+# only - model fields to load, related - relations for select_related, get - value getter.
+class Field:
+    def __init__(self, only, get, related=()):
+        self.only = only
+        self.get = get
+        self.related = related
+
+
+def _simple(name):
+    return Field((name,), lambda obj: getattr(obj, name))
+
+
+def _date(name):
+    return Field((name,), lambda obj: getattr(obj, name).isoformat())
+
+
+ARTICLE_FIELDS = {
+    'id': _simple('id'),
+    'title': _simple('title'),
+    'card_text': _simple('card_text'),
+    'content': _simple('content'),
+    'image': Field(('image', 'image_url'), lambda a: _image(a, 'image', 'image_url')),
+    'category': Field(('category', 'category__name'), lambda a: {'id': a.category_id, 'name': a.category.name}, ('category',)),
+    'author': Field(('author', 'author__username'), lambda a: {'id': a.author_id, 'username': a.author.username}, ('author',)),
+    # Tags are read from the article row, not from TaggedItem.
+    'tags': Field(('tags',), lambda a: parse_tag_input(a.tags or '')),
+    'rating': _simple('rating'),
+    'total_rating': _simple('total_rating'),
+    'views': _simple('views'),
+    'created_at': _date('created_at'),
+    'updated_at': _date('updated_at'),
+}
+
+USER_FIELDS = {
+    'id': _simple('id'),
+    'username': _simple('username'),
+    'first_name': _simple('first_name'),
+    'last_name': _simple('last_name'),
+    'status': _simple('status'),
+    'bio': _simple('bio'),
+    'activity': _simple('activity'),
+    'company': Field(('company', 'company__name'), lambda u: {'id': u.company_id, 'name': u.company.name} if u.company_id else None, ('company',)),
+    'country': Field(('country',), lambda u: u.country.code or None),
+    'city': _simple('city'),
+    'rating': _simple('rating'),
+    'image': Field(('account_image', 'account_image_url'), lambda u: _image(u, 'account_image', 'account_image_url')),
+    'date_joined': _date('date_joined'),
+}
+
+CATEGORY_FIELDS = {
+    'id': _simple('id'),
+    'name': _simple('name'),
+    'order': _simple('order'),
+}
+
+TAG_FIELDS = {
+    'id': _simple('id'),
+    'name': _simple('name'),
+}
+
+
+# Describes collection: queryset, fields and what is returned when fields= is omitted.
+class Resource:
+    def __init__(self, queryset, fields, list_fields, detail_fields, lookup='pk'):
+        self.queryset = queryset
+        self.fields = fields
+        self.list_fields = list_fields
+        self.detail_fields = detail_fields
+        self.lookup = lookup
+
+    def get_fields(self, request, default):
+        if 'fields' not in request.GET:
+            return default
+        names = [name for name in request.GET['fields'].split(',') if name]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown or not names:
+            raise ApiError('Unknown fields: %s' % ', '.join(unknown))
+        return names
+
+    # Queryset which loads only columns of requested fields, related objects are joined.
+    def get_queryset(self, names):
+        only = {'id'}
+        related = set()
+        for name in names:
+            only.update(self.fields[name].only)
+            related.update(self.fields[name].related)
+        queryset = self.queryset()
+        if related:
+            queryset = queryset.select_related(*related)
+        return queryset.only(*only)
+
+    def serialize(self, obj, names):
+        return {name: self.fields[name].get(obj) for name in names}
+
+
+RESOURCES = {
+    'articles': Resource(lambda: Article.objects.filter(is_active=True), ARTICLE_FIELDS,
+                         list_fields=('id', 'title', 'card_text', 'image', 'category', 'author', 'tags', 'rating', 'views', 'created_at'),
+                         detail_fields=tuple(ARTICLE_FIELDS)),
+    'users': Resource(lambda: AdvUser.objects.filter(is_active=True), USER_FIELDS,
+                      list_fields=('id', 'username', 'first_name', 'last_name', 'image', 'rating'),
+                      detail_fields=tuple(USER_FIELDS), lookup='username'),
+    'categories': Resource(lambda: Category.objects.all(), CATEGORY_FIELDS, tuple(CATEGORY_FIELDS), tuple(CATEGORY_FIELDS)),
+    'tags': Resource(lambda: Tag.objects.all(), TAG_FIELDS, tuple(TAG_FIELDS), tuple(TAG_FIELDS), lookup='name'),
+}
+
+# Filters of list calls: {resource: {query parameter: lookup}}.
+FILTERS = {
+    'articles': {'category': 'category__name', 'author': 'author__username'},
+}
+
+
+def encode_cursor(pk):
+    return base64.urlsafe_b64encode(json.dumps({'id': pk}).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))['id'])
+    except (ValueError, KeyError, TypeError):
+        raise ApiError('Invalid cursor')
+
+
+def _int_list(value, name):
+    try:
+        return [int(pk) for pk in value.split(',') if pk]
+    except ValueError:
+        raise ApiError(f'{name} must be a comma separated list of numbers')
+
+
+def api_response(data, status=200):
+    return JsonResponse(data, status=status, json_dumps_params={'ensure_ascii': False})
+
+
+def not_found():
+    return api_response({'error': 'Not found'}, status=404)
+
+
+# GET /api/<resource>/
+# fields=a,b  - sparse fieldset, ids=1,2,3 - batch fetch with one query,
+# cursor=...&limit=N - keyset pagination (newest first).
+@require_GET
+def api_list(request, resource):
+    if resource not in RESOURCES:
+        return not_found()
+    res = RESOURCES[resource]
+    try:
+        names = res.get_fields(request, res.list_fields)
+        queryset = res.get_queryset(names)
+        for param, lookup in FILTERS.get(resource, {}).items():
+            if param in request.GET:
+                queryset = queryset.filter(**{lookup: request.GET[param]})
+
+        if 'ids' in request.GET:
+            ids = _int_list(request.GET['ids'], 'ids')
+            if len(ids) > settings.API_MAX_LIMIT:
+                raise ApiError(f'No more than {settings.API_MAX_LIMIT} ids')
+            objects = {obj.pk: obj for obj in queryset.filter(pk__in=ids)}
+            # Keep the requested order, missing objects are skipped.
+            return api_response({'results': [res.serialize(objects[pk], names) for pk in ids if pk in objects]})
+
+        try:
+            limit = min(int(request.GET.get('limit', settings.API_DEFAULT_LIMIT)), settings.API_MAX_LIMIT)
+        except ValueError:
+            raise ApiError('limit must be a number')
+        if limit < 1:
+            raise ApiError('limit must be positive')
+        if request.GET.get('cursor'):
+            queryset = queryset.filter(pk__lt=decode_cursor(request.GET['cursor']))
+    except ApiError as e:
+        return api_response({'error': str(e)}, status=400)
+
+    # One extra row tells whether there is a next page without COUNT(*).
+    objects = list(queryset.order_by('-pk')[:limit + 1])
+    next_cursor = encode_cursor(objects[limit - 1].pk) if len(objects) > limit else None
+    return api_response({'results': [res.serialize(obj, names) for obj in objects[:limit]], 'next': next_cursor})
+
+
+# GET /api/<resource>/<key>/
+@require_GET
+def api_detail(request, resource, key):
+    if resource not in RESOURCES:
+        return not_found()
+    res = RESOURCES[resource]
+    try:
+        names = res.get_fields(request, res.detail_fields)
+    except ApiError as e:
+        return api_response({'error': str(e)}, status=400)
+    if res.lookup == 'pk':
+        key = parse_int(key)
+        if key is None:
+            return not_found()
+    obj = res.get_queryset(names).filter(**{res.lookup: key}).first()
+    if obj is None:
+        return not_found()
+    return api_response(res.serialize(obj, names))
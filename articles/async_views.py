@@ -0,0 +1,128 @@
+import asyncio
+import io
+import time
+
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.http import AsgiHandler, AsgiRequest
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.core.handlers.base import BaseHandler
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+from django.utils.module_loading import import_string
+
+from . import db_router
+from .db_router import ReplicaPinningMiddleware
+from .metrics import REQUEST_LATENCY
+from .profiles import PROFILE_PARTS, cache_profile, cached_profile, make_profile
+from .views import index_parts
+
+
+# Runs a blocking call in its own pool thread (with its own DB connection),
+# so calls awaited together wait on the database in parallel.
+# Reads follow the replica pin of the request, like ReplicaPinningMiddleware does for sync views.
+def db_call(request, func, *args):
+    pinned = getattr(request, 'pinned_to_primary', False)
+
+    def call():
+        with db_router.routing_scope(pinned):
+            return func(*args)
+    return database_sync_to_async(call, thread_sensitive=False)()
+
+
+def gather(request, calls):
+    return asyncio.gather(*(db_call(request, func, *args) for func, *args in calls))
+
+
+# Session and user of the request. The middleware chain later reuses them
+# (AuthenticationMiddleware takes the user cached on request).
+def load_user(request):
+    engine = import_string(settings.SESSION_ENGINE)
+    request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+    request.user = request._cached_user = get_user(request)
+
+
+# Async front of a hot page: independent reads of the page run concurrently without
+# holding a worker thread while they wait, then the usual sync view renders the page
+# through the whole middleware chain with the prefetched data.
+class AsyncPageConsumer(AsyncHttpConsumer):
+    view_name = None
+    handler = None
+
+    @classmethod
+    def get_handler(cls):
+        if AsyncPageConsumer.handler is None:
+            handler = BaseHandler()
+            handler.load_middleware()
+            AsyncPageConsumer.handler = handler
+        return AsyncPageConsumer.handler
+
+    async def handle(self, body):
+        start = time.perf_counter()
+        request = AsgiRequest(self.scope, io.BytesIO(body))
+        request.pinned_to_primary = ReplicaPinningMiddleware.is_pinned(request)
+        await db_call(request, load_user, request)
+        await self.prefetch(request, **self.scope['url_route']['kwargs'])
+        response = await db_call(request, self.get_handler().get_response, request)
+        # SessionMiddleware replaces the session loaded here and doesn't see it was read.
+        patch_vary_headers(response, ('Cookie', ))
+        for message in AsgiHandler.encode_response(response):
+            await self.send(message)
+        response.close()
+        # MetricsMiddleware sees only the render part, the whole request is labelled async:<view>.
+        REQUEST_LATENCY.labels('async:' + self.view_name, request.method, response.status_code).observe(time.perf_counter() - start)
+
+    # Reads the page context concurrently before the view runs. Nothing by default,
+    # the view then reads it itself.
+    async def prefetch(self, request, **kwargs):
+        pass
+
+
+class AsyncIndexConsumer(AsyncPageConsumer):
+    view_name = 'articles:index'
+
+    async def prefetch(self, request):
+        parts = index_parts(request)
+        results = await gather(request, [(read, request.user) for read in parts.values()])
+        request.prefetched = dict(zip(parts, results))
+
+
+class AsyncProfileConsumer(AsyncPageConsumer):
+    view_name = 'articles:profile'
+
+    async def prefetch(self, request, username=None):
+        username = username or request.user.username
+        data = await db_call(request, cached_profile, username)
+        if data is None:
+            data = make_profile(*await gather(request, [(read, username) for read in PROFILE_PARTS]))
+            await db_call(request, cache_profile, username, data)
+        # Picked up by request_profile() in the profile view.
+        request._profile = data
+
+
+ASYNC_CONSUMERS = {
+    'articles:index': AsyncIndexConsumer,
+    'articles:profile': AsyncProfileConsumer,
+}
+
+
+# HTTP application: GET and HEAD of pages in ASYNC_CONSUMERS go to their consumers,
+# everything else to Django views. Pages are matched with the project URLconf,
+# so routes stay defined in one place.
+class AsyncViewRouter:
+    def __init__(self, consumers=None, fallback=AsgiHandler):
+        self.consumers = ASYNC_CONSUMERS if consumers is None else consumers
+        self.fallback = fallback
+
+    def __call__(self, scope):
+        consumer = None
+        if scope['method'] in ('GET', 'HEAD'):
+            try:
+                match = resolve(scope['path'])
+            except Resolver404:
+                match = None
+            consumer = self.consumers.get(match.view_name) if match else None
+        if consumer is None:
+            return self.fallback(scope)
+        return consumer(dict(scope, url_route={'args': match.args, 'kwargs': match.kwargs}))
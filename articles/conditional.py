@@ -0,0 +1,139 @@
+from functools import wraps
+import hashlib
+import time
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.http import condition
+
+from .counters import tag_names
+from .metrics import record_cache
+from .snapshots import DEFERRED, current, loaded
+
+
+def _version_key(kind, key):
+    # Tag names can contain spaces and unicode, which some cache backends don't accept.
+    return 'listing-version:%s:%s' % (kind, hashlib.md5(str(key).encode('utf-8')).hexdigest())
+
+
+# Version stamp of listing page or feed (all articles of a category, an author or a tag).
+# Changes every time an article of the listing is saved or deleted.
+def listing_version(kind, key):
+    cache_key = _version_key(kind, key)
+    version = cache.get(cache_key)
+    record_cache('listing_version', version is not None)
+    if version is None:
+        # Unknown (or evicted) version gets a new value, which just costs one full render.
+        cache.add(cache_key, str(time.time()), None)
+        version = cache.get(cache_key)
+    return version
+
+
+def bump_listing_versions(kind, keys):
+    version = str(time.time())
+    cache.set_many({_version_key(kind, key): version for key in keys}, None)
+
+
+# Version of the viewer's read articles: listings highlight the cards the viewer has read.
+def read_version(request):
+    return listing_version('reads', request.user.pk) if request.user.is_authenticated else None
+
+
+# Viewer specific part of validators: page shows subscribe buttons, edit links etc.
+def _viewer(request):
+    if not request.user.is_authenticated:
+        return 'anonymous', None
+    return '%s:%s' % (request.user.pk, request.user.updated_at.timestamp()), request.user.updated_at
+
+
+# Adds ETag/Last-Modified to a page and answers 304 Not Modified without running the view.
+# stamp_func(request, *args, **kwargs) returns (stamp, last modified datetime or None)
+# or None when the page can't be validated (e.g. object doesn't exist).
+def conditional_page(stamp_func):
+    def decorator(view):
+        def get_stamp(request, *args, **kwargs):
+            if not hasattr(request, '_page_stamp'):
+                # Pending flash messages are shown once, such page is never "not modified".
+                if len(get_messages(request)):
+                    request._page_stamp = None
+                else:
+                    request._page_stamp = stamp_func(request, *args, **kwargs)
+            return request._page_stamp
+
+        def etag(request, *args, **kwargs):
+            stamp = get_stamp(request, *args, **kwargs)
+            if stamp is None:
+                return None
+            parts = (settings.CONDITIONAL_GET_VERSION, request.get_full_path(), _viewer(request)[0], stamp[0])
+            return hashlib.sha1(':'.join(map(str, parts)).encode('utf-8')).hexdigest()
+
+        def last_modified(request, *args, **kwargs):
+            stamp = get_stamp(request, *args, **kwargs)
+            if stamp is None or stamp[1] is None:
+                return None
+            viewer_modified = _viewer(request)[1]
+            return max(stamp[1], viewer_modified) if viewer_modified else stamp[1]
+
+        conditional_view = condition(etag_func=etag, last_modified_func=last_modified)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            # Browsers must revalidate every time instead of guessing freshness from Last-Modified.
+            patch_cache_control(response, private=True, no_cache=True)
+            patch_vary_headers(response, ('Cookie',))
+            return response
+        return wrapper
+    return decorator
+
+
+# Article fields its listings depend on.
+LISTING_FIELDS = ('category_id', 'author_id', 'tags')
+
+
+# Listings of (category_id, author_id, tags) values; fields not loaded add none.
+def _article_listings(category, author, tags):
+    return ({category} - {None, DEFERRED}, {author} - {None, DEFERRED},
+            set() if tags is DEFERRED else tag_names(tags))
+
+
+# post_save and post_delete receiver for Article: listings it belonged to when loaded and now.
+def bump_article_listings(sender, instance, **kwargs):
+    old_categories, old_authors, old_tags = _article_listings(*loaded(instance, *LISTING_FIELDS))
+    new_categories, new_authors, new_tags = _article_listings(*current(instance, *LISTING_FIELDS))
+    bump_listing_versions('category', old_categories | new_categories)
+    bump_listing_versions('author', old_authors | new_authors)
+    bump_listing_versions('tag', old_tags | new_tags)
+
+
+# m2m_changed receiver for subscriptions: subscribe buttons and subscribers
+# lists of both users change, so their pages must be re-rendered.
+def touch_subscribed_users(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    from .models import AdvUser
+    pks = set(pk_set or ())
+    if model is not AdvUser:
+        pks = set()
+    if isinstance(instance, AdvUser):
+        pks.add(instance.pk)
+    if pks:
+        AdvUser.objects.filter(pk__in=pks).update(updated_at=timezone.now())
+
+
+# m2m_changed receiver for read articles: highlighted cards of the readers' listings change.
+def bump_read_articles(sender, instance, action, reverse, model, pk_set, **kwargs):
+    from .models import AdvUser
+    if isinstance(instance, AdvUser):
+        readers = {instance.pk} if action.startswith('post_') else set()
+    elif action == 'pre_clear':
+        readers = set(instance.viewed_users.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove'):
+        readers = set(pk_set or ())
+    else:
+        readers = set()
+    if readers:
+        bump_listing_versions('reads', readers)
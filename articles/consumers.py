@@ -2,13 +2,17 @@ from asgiref.sync import async_to_sync
 from channels.generic.websocket import WebsocketConsumer
 import json
 
+from .metrics import WEBSOCKETS
+
+
 class NotificationsConsumer(WebsocketConsumer):
     def connect(self):
         print('a')
         self.accept()
+        WEBSOCKETS.labels('notifications').inc()
         
     def disconnect(self, close_code):
-        pass
+        WEBSOCKETS.labels('notifications').dec()
     
     def receive(self, text_data):
         text_data_json = json.loads(text_data)
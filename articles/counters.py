@@ -0,0 +1,127 @@
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete
+from tagging import settings as tagging_settings
+from tagging.utils import calculate_cloud, parse_tag_input
+
+from .metrics import record_cache
+from .models import Article, CategoryCount, TagCount
+from .snapshots import DEFERRED, current, loaded
+
+SNAPSHOT_KEY = 'article-counters'
+
+# Article fields the counters depend on.
+ARTICLE_FIELDS = ('is_active', 'category_id', 'tags')
+
+# Tag names of an article as tagging stores them.
+def tag_names(tags):
+    names = parse_tag_input(tags or '')
+    return {name.lower() for name in names} if tagging_settings.FORCE_LOWERCASE_TAGS else set(names)
+
+
+# What published articles add to the counters: ({category id: n}, {tag name: n}).
+# rows: (category_id, tags).
+def article_counts(rows):
+    categories, tags = Counter(), Counter()
+    for category, value in rows:
+        categories[category] += 1
+        tags.update(tag_names(value))
+    return categories, tags
+
+
+# Adds {category id: delta} and {tag name: delta} to the counters. Missing rows are
+# created first, then one UPDATE per distinct delta, so a batch costs a few queries.
+def apply_counts(categories, tags):
+    categories = {pk: value for pk, value in categories.items() if value and pk is not None}
+    tags = {name: value for name, value in tags.items() if value}
+    if not categories and not tags:
+        return
+    CategoryCount.objects.bulk_create([CategoryCount(category_id=pk) for pk in categories], ignore_conflicts=True)
+    TagCount.objects.bulk_create([TagCount(name=name) for name in tags], ignore_conflicts=True)
+    for queryset, lookup, deltas in ((CategoryCount.objects, 'category_id__in', categories),
+                                     (TagCount.objects, 'name__in', tags)):
+        keys = defaultdict(list)
+        for key, value in deltas.items():
+            keys[value].append(key)
+        for value, group in keys.items():
+            queryset.filter(**{lookup: group}).update(articles=F('articles') + value)
+    invalidate_snapshot()
+
+
+# Recomputes the counters from published articles. Repairs the drift after changes that
+# bypass the receivers (raw SQL, updates of articles loaded with deferred fields).
+# Returns (categories, tags).
+def rebuild_counters():
+    published = Article.objects.filter(is_active=True)
+    categories = dict(published.order_by().values('category').annotate(count=Count('pk')).values_list('category', 'count'))
+    tags = Counter()
+    for value in published.values_list('tags', flat=True).iterator():
+        tags.update(tag_names(value))
+    with transaction.atomic():
+        CategoryCount.objects.all().delete()
+        TagCount.objects.all().delete()
+        CategoryCount.objects.bulk_create([CategoryCount(category_id=pk, articles=n) for pk, n in categories.items()], batch_size=1000)
+        TagCount.objects.bulk_create([TagCount(name=name, articles=n) for name, n in tags.items()], batch_size=1000)
+    invalidate_snapshot()
+    return len(categories), len(tags)
+
+
+# Categories with article counts and the tag cloud: the TAG_CLOUD_SIZE most used tags
+# in alphabetical order, weight 1..TAG_CLOUD_STEPS on a logarithmic scale.
+def build_snapshot():
+    categories = (CategoryCount.objects.filter(articles__gt=0).order_by('category__order', 'category__name')
+                  .values_list('category__name', 'articles'))
+    tags = list(TagCount.objects.filter(articles__gt=0).order_by('-articles', 'name')[:settings.TAG_CLOUD_SIZE])
+    for tag in tags:
+        tag.count = tag.articles
+    calculate_cloud(tags, steps=settings.TAG_CLOUD_STEPS)
+    return {
+        'categories': [{'name': name, 'count': count} for name, count in categories],
+        'tags': sorted(({'name': tag.name, 'count': tag.count, 'weight': tag.font_size} for tag in tags),
+                       key=lambda tag: tag['name']),
+    }
+
+
+# Snapshot from the cache. Changes delete it; a snapshot built concurrently from data read
+# before such a change committed may still be cached, TAG_CLOUD_CACHE_TIMEOUT bounds that.
+def get_snapshot():
+    data = cache.get(SNAPSHOT_KEY)
+    record_cache('article_counters', data is not None)
+    if data is None:
+        data = build_snapshot()
+        cache.set(SNAPSHOT_KEY, data, settings.TAG_CLOUD_CACHE_TIMEOUT)
+    return data
+
+
+def invalidate_snapshot():
+    cache.delete(SNAPSHOT_KEY)
+
+
+def _share(values):
+    if not values or not values[0]:
+        return Counter(), Counter()
+    return article_counts([values[1:]])
+
+
+# post_save and post_delete receiver for Article. Moves the article's share of the counters
+# from what it was when loaded to what it is now; no query unless a published article changed.
+def article_counts_changed(sender, instance, created=False, **kwargs):
+    deleted = kwargs.get('signal') is post_delete
+    old = () if created else loaded(instance, *ARTICLE_FIELDS)
+    new = () if deleted else current(instance, *ARTICLE_FIELDS)
+    if deleted and DEFERRED in old:
+        old = current(instance, *ARTICLE_FIELDS)
+    if old == new:
+        return
+    if DEFERRED in old + new:
+        # Loaded with deferred fields: the old share is unknown, left to rebuild_counters.
+        return
+    categories, tags = _share(new)
+    removed_categories, removed_tags = _share(old)
+    categories.subtract(removed_categories)
+    tags.subtract(removed_tags)
+    apply_counts(categories, tags)
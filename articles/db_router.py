@@ -0,0 +1,81 @@
+from contextlib import contextmanager
+import random
+import threading
+import time
+
+from django.conf import settings
+
+# Routing state of the current thread (request):
+# pinned - session wrote recently, wrote - this request already wrote.
+state = threading.local()
+
+
+def reads_from_primary():
+    return getattr(state, 'pinned', False) or getattr(state, 'wrote', False)
+
+
+# Routing state of one unit of work: a request, a background task, a call in a pool thread.
+# Reads go to replicas until it writes, then to the primary; the state is reset on exit,
+# so a long-lived thread (task worker, pool) isn't left reading from the primary for good.
+@contextmanager
+def routing_scope(pinned=False):
+    state.pinned, state.wrote = pinned, False
+    try:
+        yield state
+    finally:
+        state.pinned = state.wrote = False
+
+
+# Sends writes to 'default' and reads to a random DATABASE_REPLICAS database.
+# After a write the rest of the request reads from the primary, and
+# ReplicaPinningMiddleware keeps the session there for REPLICA_PIN_SECONDS.
+class PrimaryReplicaRouter:
+    def __init__(self, replicas=None):
+        self._replicas = replicas
+
+    @property
+    def replicas(self):
+        return list(settings.DATABASE_REPLICAS if self._replicas is None else self._replicas)
+
+    def db_for_read(self, model, **hints):
+        if not self.replicas or reads_from_primary():
+            return 'default'
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+# Pins a session to the primary database for a short time after it changed something,
+# so authors see their own edits while replicas catch up.
+# Only unsafe requests pin: GET pages also write (view counters, sessions),
+# pinning on them would send every reader to the primary.
+class ReplicaPinningMiddleware:
+    cookie_name = 'primary_db'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    @classmethod
+    def is_pinned(cls, request):
+        try:
+            return float(request.COOKIES.get(cls.cookie_name, 0)) > time.time()
+        except ValueError:
+            return False
+
+    def __call__(self, request):
+        with routing_scope(self.is_pinned(request)) as scope:
+            response = self.get_response(request)
+            wrote = scope.wrote
+        if wrote and request.method not in ('GET', 'HEAD', 'OPTIONS'):
+            seconds = settings.REPLICA_PIN_SECONDS
+            response.set_cookie(self.cookie_name, str(time.time() + seconds), max_age=seconds, httponly=True, samesite='Lax')
+        return response
@@ -0,0 +1,109 @@
+import csv
+import io
+import json
+import zlib
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from .models import AdvUser, Article
+
+
+# Exported table: columns as (name in the file, lookup) and permission needed to download it.
+class Dataset:
+    def __init__(self, queryset, columns, permission):
+        self.queryset = queryset
+        self.columns = columns
+        self.permission = permission
+
+    @property
+    def header(self):
+        return [name for name, lookup in self.columns]
+
+    # Rows in primary key order, read in keyset batches of `chunk_size`: every batch is
+    # a short query of its own, so neither memory nor an open transaction grows with the table.
+    def rows(self, chunk_size=None):
+        chunk_size = chunk_size or settings.EXPORT_CHUNK_SIZE
+        queryset = self.queryset().order_by('pk')
+        lookups = ['pk'] + [lookup for name, lookup in self.columns]
+        last = None
+        while True:
+            batch = queryset if last is None else queryset.filter(pk__gt=last)
+            batch = list(batch.values_list(*lookups)[:chunk_size])
+            if not batch:
+                return
+            yield [row[1:] for row in batch]
+            last = batch[-1][0]
+
+
+DATASETS = {
+    'articles': Dataset(Article.objects.all, (
+        ('id', 'pk'), ('title', 'title'), ('category', 'category__name'), ('author', 'author__username'),
+        ('tags', 'tags'), ('rating', 'rating'), ('total_rating', 'total_rating'), ('views', 'views'),
+        ('is_active', 'is_active'), ('created_at', 'created_at'), ('updated_at', 'updated_at'),
+    ), 'articles.view_article'),
+    'users': Dataset(AdvUser.objects.all, (
+        ('id', 'pk'), ('username', 'username'), ('email', 'email'), ('first_name', 'first_name'),
+        ('last_name', 'last_name'), ('company', 'company__name'), ('country', 'country'), ('city', 'city'),
+        ('rating', 'rating'), ('is_active', 'is_active'), ('is_activated', 'is_activated'),
+        ('date_joined', 'date_joined'), ('last_login', 'last_login'),
+    ), 'articles.view_advuser'),
+    'votes': Dataset(Article.rated_users.through.objects.all, (
+        ('id', 'pk'), ('article_id', 'article_id'), ('user_id', 'advuser_id'),
+    ), 'articles.view_article'),
+    'views': Dataset(Article.viewed_users.through.objects.all, (
+        ('id', 'pk'), ('article_id', 'article_id'), ('user_id', 'advuser_id'),
+    ), 'articles.view_article'),
+}
+
+FORMATS = {
+    'csv': ('text/csv; charset=utf-8', 'csv'),
+    'jsonl': ('application/x-ndjson; charset=utf-8', 'jsonl'),
+}
+
+
+def _csv_chunks(dataset, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(dataset.header)
+    for batch in dataset.rows(chunk_size):
+        writer.writerows([[value.isoformat() if hasattr(value, 'isoformat') else value for value in row] for row in batch])
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+def _jsonl_chunks(dataset, chunk_size):
+    header = dataset.header
+    for batch in dataset.rows(chunk_size):
+        yield ''.join(json.dumps(dict(zip(header, row)), cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+                      for row in batch).encode('utf-8')
+
+
+# Compresses chunks on the fly into one gzip stream.
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Bytes of an export, one chunk per batch of rows.
+def export_chunks(name, fmt='csv', compress=False, chunk_size=None):
+    dataset = DATASETS[name]
+    chunks = _csv_chunks(dataset, chunk_size) if fmt == 'csv' else _jsonl_chunks(dataset, chunk_size)
+    return gzip_chunks(chunks) if compress else chunks
+
+
+def export_response(name, fmt='csv', compress=False):
+    content_type, extension = FORMATS[fmt]
+    filename = f'{name}.{extension}'
+    if compress:
+        content_type, filename = 'application/gzip', filename + '.gz'
+    response = StreamingHttpResponse(export_chunks(name, fmt, compress), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
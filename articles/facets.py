@@ -0,0 +1,296 @@
+from collections import Counter, defaultdict
+from datetime import timedelta
+import threading
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.utils import timezone
+from tagging.utils import parse_tag_input
+
+from .models import Article, FacetChange
+from .snapshots import DEFERRED, current, loaded
+from .utilities import parse_int
+
+# Facets of published articles. Rating facet values are buckets: 0 is [0, 1), ..., 4 is [4, 5].
+FACETS = ('category', 'tag', 'country', 'city', 'rating')
+RATING_BUCKETS = range(5)
+
+FACET_TITLES = {'category': 'Категория', 'tag': 'Тег', 'country': 'Страна автора', 'city': 'Город автора', 'rating': 'Рейтинг'}
+
+# Columns of an article its facets are computed from.
+COLUMNS = ('pk', 'is_active', 'category_id', 'tags', 'rating', 'author__country', 'author__city')
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+
+def _facet_values(category_id, tags, rating, country, city):
+    city = (city or '').strip()
+    return (
+        (category_id, ),
+        tuple(set(parse_tag_input(tags or ''))),
+        (country, ) if country else (),
+        (city, ) if city else (),
+        (min(int(rating or 0), RATING_BUCKETS[-1]), ),
+    )
+
+
+# Article ids set in a bitset, highest (newest) first: a sequence for Paginator.
+class Matches:
+    def __init__(self, bits):
+        self.bits = bits
+        self.total = popcount(bits)
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        return iter(self[0:self.total])
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start, stop, _ = item.indices(self.total)
+        digits = bin(self.bits)[2:]
+        top = len(digits) - 1
+        result = []
+        position = digits.find('1')
+        for i in range(stop):
+            if i >= start:
+                result.append(top - position)
+            position = digits.find('1', position + 1)
+        return result
+
+
+# Bitsets of published articles per facet value (bit n is the article with id n), so counts of
+# any combination of filters are ANDs and popcounts of in-memory ints instead of GROUP BY queries.
+# Built once per process, then kept up to date by replaying FacetChange rows.
+class FacetIndex:
+    def __init__(self):
+        self.lock = threading.RLock()
+        # One thread syncs at a time, the others wait for its result.
+        self.sync_lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.bits = {facet: defaultdict(int) for facet in FACETS}
+            # Facet values of every indexed article, to clear its old bits on change.
+            self.articles = {}
+            self.all = 0
+            self.synced_at = None
+            self.pruned_at = None
+            self.seen = set()
+
+    def _add(self, pk, values):
+        bit = 1 << pk
+        for facet, facet_values in zip(FACETS, values):
+            bits = self.bits[facet]
+            for value in facet_values:
+                bits[value] |= bit
+        self.all |= bit
+        self.articles[pk] = values
+
+    def _remove(self, pk):
+        values = self.articles.pop(pk, None)
+        if values is None:
+            return
+        mask = ~(1 << pk)
+        for facet, facet_values in zip(FACETS, values):
+            bits = self.bits[facet]
+            for value in facet_values:
+                bits[value] &= mask
+                if not bits[value]:
+                    del bits[value]
+        self.all &= mask
+
+    def rebuild(self):
+        now = timezone.now()
+        # Changes committed before the scan are in it and needn't be replayed.
+        seen = set(FacetChange.objects.filter(created_at__gte=now - timedelta(seconds=settings.FACET_SYNC_LAG))
+                   .values_list('pk', flat=True))
+        positions = {facet: defaultdict(list) for facet in FACETS}
+        articles = {}
+        for pk, is_active, *columns in Article.objects.filter(is_active=True).values_list(*COLUMNS).iterator():
+            values = articles[pk] = _facet_values(*columns)
+            for facet, facet_values in zip(FACETS, values):
+                for value in facet_values:
+                    positions[facet][value].append(pk)
+        with self.lock:
+            self.reset()
+            # One int per value from a byte buffer: setting bits one by one copies the int every time.
+            for facet, values in positions.items():
+                for value, pks in values.items():
+                    buffer = bytearray(max(pks) // 8 + 1)
+                    for pk in pks:
+                        buffer[pk >> 3] |= 1 << (pk & 7)
+                    self.bits[facet][value] = int.from_bytes(buffer, 'little')
+                    if facet == 'category':
+                        self.all |= self.bits[facet][value]
+            self.articles = articles
+            self.seen = seen
+            self.synced_at = self.pruned_at = now
+
+    # Re-reads articles by ids: published ones are (re)indexed, the rest dropped.
+    def refresh(self, pks):
+        rows = {pk: columns for pk, *columns in Article.objects.filter(pk__in=pks).values_list(*COLUMNS)}
+        with self.lock:
+            for pk in pks:
+                self._remove(pk)
+                if pk in rows and rows[pk][0]:
+                    self._add(pk, _facet_values(*rows[pk][1:]))
+
+    # Applies changes of all processes since the last sync, at most once in FACET_SYNC_INTERVAL.
+    # Changes of the last FACET_SYNC_LAG seconds are re-read every time, because a transaction
+    # can commit its change row later than rows written after it (and replicas lag); replay is idempotent.
+    def sync(self):
+        with self.sync_lock:
+            self._sync()
+
+    def _sync(self):
+        now = timezone.now()
+        lag = timedelta(seconds=settings.FACET_SYNC_LAG)
+        keep = timedelta(seconds=settings.FACET_CHANGE_KEEP)
+        if self.synced_at is None or now - self.synced_at > keep - lag:
+            # First use, or changes since the last sync may already be deleted.
+            self.rebuild()
+            return
+        if now - self.synced_at < timedelta(seconds=settings.FACET_SYNC_INTERVAL):
+            return
+        rows = list(FacetChange.objects.filter(created_at__gte=self.synced_at - lag).values_list('pk', 'article_id'))
+        changed = {article for pk, article in rows if pk not in self.seen}
+        if changed:
+            self.refresh(changed)
+        with self.lock:
+            self.seen = {pk for pk, article in rows}
+            self.synced_at = now
+        if now - self.pruned_at > keep:
+            FacetChange.objects.filter(created_at__lt=now - keep).delete()
+            self.pruned_at = now
+
+    # Counts of values of a facet among articles in `base`, most frequent first.
+    def _counts(self, facet, base):
+        index = FACETS.index(facet)
+        if popcount(base) <= settings.FACET_SCAN_LIMIT:
+            # Few matches: counting their values is cheaper than ANDing every value's bitset.
+            counts = Counter(value for pk in Matches(base) for value in self.articles[pk][index])
+        else:
+            counts = Counter({value: popcount(bits & base) for value, bits in self.bits[facet].items()})
+        return [(value, count) for value, count in counts.most_common() if count]
+
+    # selection: {facet: set of values}. Values of one facet are OR-ed, facets are AND-ed.
+    # Counts of a facet are computed under the filters of the other facets, so every listed
+    # value tells how many articles selecting it would give (added to the values already selected).
+    # Returns (matching articles, {facet: [(value, count)]}).
+    def search(self, selection):
+        with self.lock:
+            filters = {}
+            for facet, values in selection.items():
+                if values:
+                    bits = 0
+                    for value in values:
+                        bits |= self.bits[facet].get(value, 0)
+                    filters[facet] = bits
+            counts = {}
+            for facet in FACETS:
+                base = self.all
+                for other, bits in filters.items():
+                    if other != facet:
+                        base &= bits
+                counts[facet] = self._counts(facet, base)
+            matches = self.all
+            for bits in filters.values():
+                matches &= bits
+        return Matches(matches), counts
+
+
+index = FacetIndex()
+
+
+def get_index():
+    index.sync()
+    return index
+
+
+# Selection from query parameters: ?category=1&tag=django&tag=python&rating_min=3...
+# rating_min and rating_max (whole points) select the rating buckets between them.
+def parse_selection(query):
+    selection = {facet: set(value for value in query.getlist(facet) if value) for facet in FACETS}
+    for facet in ('category', 'rating'):
+        selection[facet] = {parse_int(value) for value in selection[facet]} - {None}
+    low, high = parse_int(query.get('rating_min')), parse_int(query.get('rating_max'))
+    if low is not None or high is not None:
+        low = 0 if low is None else low
+        high = RATING_BUCKETS[-1] + 1 if high is None else high
+        selection['rating'] |= {bucket for bucket in RATING_BUCKETS if low <= bucket < high}
+    return selection
+
+
+def _labels(facet, values):
+    from django_countries import countries
+    from .models import Category
+    if facet == 'category':
+        names = dict(Category.objects.filter(pk__in=values).values_list('pk', 'name'))
+        return {value: names.get(value, value) for value in values}
+    if facet == 'country':
+        return {value: countries.name(value) or value for value in values}
+    if facet == 'rating':
+        return {value: f'{value}–{value + 1}' for value in values}
+    return {value: value for value in values}
+
+
+# Facets for the template: [{'name', 'title', 'values': [{'value', 'label', 'count', 'selected', 'url'}]}].
+# Selected values come first, so they can always be unselected; at most FACET_VALUES_SHOWN others follow.
+def describe(counts, selection, query):
+    result = []
+    for facet in FACETS:
+        found = dict(counts[facet])
+        selected = sorted(selection[facet], key=str)
+        values = selected + [value for value, count in counts[facet] if value not in selection[facet]][:settings.FACET_VALUES_SHOWN]
+        if facet == 'rating':
+            values = sorted(values)
+        labels = _labels(facet, values)
+        items = []
+        for value in values:
+            params = query.copy()
+            for name in ('page', 'rating_min', 'rating_max'):
+                params.pop(name, None)
+            # Rating range becomes the buckets it selected.
+            params.setlist('rating', sorted(map(str, selection['rating'])))
+            chosen = set(map(str, selection[facet])) ^ {str(value)}
+            params.setlist(facet, sorted(chosen))
+            items.append({'value': value, 'label': labels[value], 'count': found.get(value, 0),
+                          'selected': value in selection[facet], 'url': '?' + params.urlencode()})
+        result.append({'name': facet, 'title': FACET_TITLES[facet], 'values': items})
+    return result
+
+
+# Records articles whose facets changed for the indexes of all processes.
+# Written in the caller's transaction, so rolled back changes aren't replayed.
+def record_changes(pks):
+    now = timezone.now()
+    FacetChange.objects.bulk_create([FacetChange(article_id=pk, created_at=now) for pk in set(pks)])
+
+
+# Article fields its facets depend on.
+FACET_FIELDS = ('is_active', 'category_id', 'tags', 'rating', 'author_id')
+
+
+# post_save and post_delete receiver for Article: only published (or unpublished) articles matter.
+# A field deferred when loaded and set since counts as changed.
+def article_facets_changed(sender, instance, created=False, **kwargs):
+    old = None if created else loaded(instance, *FACET_FIELDS)
+    new = current(instance, *FACET_FIELDS)
+    deleted = kwargs.get('signal') is post_delete
+    if (deleted or old != new) and (new[0] or (old and old[0])):
+        record_changes([instance.pk])
+
+
+# post_save receiver for AdvUser: country and city of the author are facets of their articles.
+def user_location_changed(sender, instance, created, **kwargs):
+    old, new = loaded(instance, 'country', 'city'), current(instance, 'country', 'city')
+    if not created and old != new and DEFERRED not in new:
+        record_changes(Article.objects.filter(author=instance, is_active=True).values_list('pk', flat=True))
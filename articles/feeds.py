@@ -0,0 +1,158 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.syndication.views import Feed
+from django.core.cache import cache
+from django.http import Http404, HttpResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.feedgenerator import Atom1Feed
+from tagging.models import Tag
+from tagging.utils import parse_tag_input
+
+from .conditional import listing_version
+from .metrics import record_cache
+from .models import AdvUser, Article, Category
+from .views import category_articles, tag_articles
+
+
+# Feed which XML is cached until an article of its listing changes.
+# The cache key and ETag come from the listing version stamp (articles/conditional.py),
+# so neither a cached response nor a 304 costs more than one small query.
+class CachedFeed(Feed):
+    listing = None
+
+    # Returns key of listing version: the only URL argument (tag name). Listings versioned
+    # by id (categories, authors) look it up.
+    def listing_key(self, **kwargs):
+        key, = kwargs.values()
+        return key
+
+    def __call__(self, request, *args, **kwargs):
+        key = self.listing_key(**kwargs)
+        stamp = '%s:%s:%s:%s' % (type(self).__name__, self.listing, key, listing_version(self.listing, key))
+        digest = hashlib.sha1(stamp.encode('utf-8')).hexdigest()
+        etag = '"%s"' % digest
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            cached = cache.get('feed:' + digest)
+            record_cache('feed', cached is not None)
+            if cached is None:
+                response = super().__call__(request, *args, **kwargs)
+                cached = (response.content, response['Content-Type'], response.get('Last-Modified'))
+                cache.set('feed:' + digest, cached, settings.FEED_CACHE_TIMEOUT)
+            response = HttpResponse(cached[0], content_type=cached[1])
+            if cached[2]:
+                response['Last-Modified'] = cached[2]
+        response['ETag'] = etag
+        patch_cache_control(response, public=True, max_age=settings.FEED_MAX_AGE)
+        return response
+
+    def items(self, obj):
+        return self.get_articles(obj).filter(is_active=True).select_related('author').order_by('-created_at')[:settings.FEED_ITEMS]
+
+    def item_title(self, item):
+        return item.title
+
+    def item_description(self, item):
+        return item.card_text
+
+    def item_link(self, item):
+        return reverse('articles:article', kwargs={'pk': item.pk})
+
+    def item_author_name(self, item):
+        return item.author.username
+
+    def item_pubdate(self, item):
+        return item.created_at
+
+    def item_updateddate(self, item):
+        return item.updated_at
+
+    def item_categories(self, item):
+        return parse_tag_input(item.tags or '')
+
+
+class CategoryFeed(CachedFeed):
+    listing = 'category'
+
+    def listing_key(self, category_name):
+        category_id = Category.objects.filter(name=category_name).values_list('pk', flat=True).first()
+        if category_id is None:
+            raise Http404('Feed object does not exist.')
+        return category_id
+
+    def get_object(self, request, category_name):
+        return get_object_or_404(Category, name=category_name)
+
+    def get_articles(self, category):
+        return category_articles(category)
+
+    def title(self, category):
+        return f'{settings.SITE_NAME}: категория {category.name}'
+
+    def link(self, category):
+        return reverse('articles:search_by_category', kwargs={'category_name': category.name})
+
+    def description(self, category):
+        return f'Новые статьи в категории {category.name}'
+
+
+class TagFeed(CachedFeed):
+    listing = 'tag'
+
+    def get_object(self, request, tag):
+        return get_object_or_404(Tag, name=tag)
+
+    def get_articles(self, tag):
+        return tag_articles(tag.name)
+
+    def title(self, tag):
+        return f'{settings.SITE_NAME}: тег {tag.name}'
+
+    def link(self, tag):
+        return reverse('articles:search_by_tag', kwargs={'tag': tag.name})
+
+    def description(self, tag):
+        return f'Новые статьи с тегом {tag.name}'
+
+
+class AuthorFeed(CachedFeed):
+    listing = 'author'
+
+    def listing_key(self, username):
+        author_id = AdvUser.objects.filter(username=username).values_list('pk', flat=True).first()
+        if author_id is None:
+            raise Http404('Feed object does not exist.')
+        return author_id
+
+    def get_object(self, request, username):
+        return get_object_or_404(AdvUser, username=username)
+
+    def get_articles(self, author):
+        return Article.objects.filter(author=author)
+
+    def title(self, author):
+        return f'{settings.SITE_NAME}: статьи {author.username}'
+
+    def link(self, author):
+        return reverse('articles:profile', kwargs={'username': author.username})
+
+    def description(self, author):
+        return f'Новые статьи пользователя {author.username}'
+
+
+class AtomCategoryFeed(CategoryFeed):
+    feed_type = Atom1Feed
+    subtitle = CategoryFeed.description
+
+
+class AtomTagFeed(TagFeed):
+    feed_type = Atom1Feed
+    subtitle = TagFeed.description
+
+
+class AtomAuthorFeed(AuthorFeed):
+    feed_type = Atom1Feed
+    subtitle = AuthorFeed.description
@@ -0,0 +1,227 @@
+from urllib.parse import urljoin, urlparse
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import Signer
+from django.urls import reverse
+from django.utils.http import urlencode
+import certifi
+import urllib3
+
+from .metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+signer = Signer(salt='articles.image_proxy')
+
+# Normalized images are stored either as jpeg or as png (when they have transparency).
+CONTENT_TYPES = {'.jpg': 'image/jpeg', '.png': 'image/png'}
+
+# Bytes stored in the cache directory, kept in the shared cache.
+SIZE_KEY = 'image-proxy-size'
+
+# Share of IMAGE_PROXY_CACHE_SIZE left by eviction, so the cache directory is walked once per
+# tenth of the cache size stored, not on every store.
+EVICT_TO = 0.9
+
+
+class ImageProxyError(Exception):
+    pass
+
+
+# Returns local proxy url for remote image.
+def proxy_url(url):
+    if not url or not url.startswith(('http://', 'https://')):
+        return url
+    return reverse('articles:image_proxy') + '?' + urlencode({'u': signer.sign(url)})
+
+
+def cache_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def cache_path(key, ext):
+    return os.path.join(settings.IMAGE_PROXY_CACHE_DIR, key[:2], key + ext)
+
+
+# Returns (path, content type) of cached image or None.
+# Every hit refreshes mtime, which is used as "last used" time by eviction.
+def get_cached(key):
+    for ext, content_type in CONTENT_TYPES.items():
+        path = cache_path(key, ext)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            continue
+        return path, content_type
+    return None
+
+
+# Resolves the host of the url and checks its addresses. Returns (parsed url, address to connect to).
+def _resolve(url):
+    parsed = urlparse(url)
+    if parsed.scheme not in ('http', 'https') or not parsed.hostname:
+        raise ImageProxyError(f'Unsupported url: {url}')
+    try:
+        addresses = socket.getaddrinfo(parsed.hostname, parsed.port, proto=socket.IPPROTO_TCP)
+    except socket.gaierror:
+        raise ImageProxyError(f'Unknown host: {parsed.hostname}')
+    if not settings.IMAGE_PROXY_ALLOW_PRIVATE:
+        for address in addresses:
+            ip = ipaddress.ip_address(address[4][0])
+            if ip.is_private or ip.is_loopback or ip.is_link_local or ip.is_reserved or ip.is_multicast:
+                raise ImageProxyError(f'Private address is not allowed: {parsed.hostname}')
+    return parsed, addresses[0][4][0]
+
+
+# Sends GET to the checked address, so the host can't be resolved again to another one
+# in between (DNS rebinding). Host header, TLS server name and certificate use the host name.
+def _open(url):
+    parsed, address = _resolve(url)
+    options = {'timeout': settings.IMAGE_PROXY_TIMEOUT, 'retries': False, 'maxsize': 1}
+    if parsed.scheme == 'https':
+        pool = urllib3.HTTPSConnectionPool(address, parsed.port or 443, server_hostname=parsed.hostname,
+                                           assert_hostname=parsed.hostname, cert_reqs='CERT_REQUIRED',
+                                           ca_certs=certifi.where(), **options)
+    else:
+        pool = urllib3.HTTPConnectionPool(address, parsed.port or 80, **options)
+    path = (parsed.path or '/') + ('?' + parsed.query if parsed.query else '')
+    headers = {'Host': parsed.netloc.rpartition('@')[2], 'User-Agent': settings.SITE_NAME + ' image proxy'}
+    try:
+        return pool, pool.urlopen('GET', path, headers=headers, redirect=False, preload_content=False)
+    except (urllib3.exceptions.HTTPError, OSError) as e:
+        pool.close()
+        raise ImageProxyError(str(e))
+
+
+# Downloads remote file with limits on time, size and redirects.
+def download(url):
+    for _ in range(settings.IMAGE_PROXY_MAX_REDIRECTS + 1):
+        pool, response = _open(url)
+        try:
+            location = response.get_redirect_location()
+            if location:
+                url = urljoin(url, location)
+                continue
+            if response.status != 200:
+                raise ImageProxyError(f'Origin returned {response.status}')
+            if int(response.headers.get('Content-Length') or 0) > settings.IMAGE_PROXY_MAX_SIZE:
+                raise ImageProxyError('Image is too large')
+            data = bytearray()
+            for chunk in response.stream(64 * 1024):
+                data += chunk
+                if len(data) > settings.IMAGE_PROXY_MAX_SIZE:
+                    raise ImageProxyError('Image is too large')
+            return bytes(data)
+        except (urllib3.exceptions.HTTPError, OSError) as e:
+            raise ImageProxyError(str(e))
+        finally:
+            response.release_conn()
+            pool.close()
+    raise ImageProxyError('Too many redirects')
+
+
+# Checks that data is a real image and re-encodes it: strips metadata,
+# applies EXIF rotation and limits dimensions. Returns (bytes, extension).
+def normalize(data):
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.verify()
+        image = Image.open(io.BytesIO(data))
+        if image.width * image.height > settings.IMAGE_PROXY_MAX_PIXELS:
+            raise ImageProxyError('Image has too many pixels')
+        image = ImageOps.exif_transpose(image)
+    except ImageProxyError:
+        raise
+    except Exception as e:
+        raise ImageProxyError(f'Not an image: {e}')
+    size = settings.IMAGE_PROXY_MAX_DIMENSION
+    image.thumbnail((size, size), Image.LANCZOS)
+    output = io.BytesIO()
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        image.convert('RGBA').save(output, 'PNG', optimize=True)
+        return output.getvalue(), '.png'
+    image.convert('RGB').save(output, 'JPEG', quality=85, optimize=True, progressive=True)
+    return output.getvalue(), '.jpg'
+
+
+def store(key, data, ext):
+    path = cache_path(key, ext)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+    grow(len(data))
+    return path
+
+
+# Adds stored bytes to the cache size. The directory is only walked when the size is unknown
+# (first store, counter evicted) or over IMAGE_PROXY_CACHE_SIZE; the walk corrects the counter.
+def grow(size):
+    try:
+        total = cache.incr(SIZE_KEY, size)
+    except ValueError:
+        total = None
+    if total is None or total > settings.IMAGE_PROXY_CACHE_SIZE:
+        total = evict(settings.IMAGE_PROXY_CACHE_SIZE, int(settings.IMAGE_PROXY_CACHE_SIZE * EVICT_TO))
+        cache.set(SIZE_KEY, total, None)
+
+
+# Removes least recently used images down to `target` bytes when the cache is over max_size.
+# Returns bytes left.
+def evict(max_size, target=None):
+    target = max_size if target is None else target
+    files = []
+    total = 0
+    for root, dirs, names in os.walk(settings.IMAGE_PROXY_CACHE_DIR):
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+    if total <= max_size:
+        return total
+    for mtime, size, path in sorted(files):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        if total <= target:
+            break
+    return total
+
+
+# Returns (path, content type) of local copy of remote image, downloading it if needed.
+# Failed origins are remembered for a while, so a dead host doesn't stall every page.
+def fetch(url):
+    key = cache_key(url)
+    cached = get_cached(key)
+    record_cache('image_proxy', bool(cached))
+    if cached:
+        return cached
+    failure_key = 'image-proxy-failed:' + key
+    if cache.get(failure_key):
+        raise ImageProxyError('Origin failed recently')
+    try:
+        data, ext = normalize(download(url))
+    except ImageProxyError as e:
+        logger.info('Image proxy failed for %s: %s', url, e)
+        cache.set(failure_key, True, settings.IMAGE_PROXY_FAILURE_TTL)
+        raise
+    return store(key, data, ext), CONTENT_TYPES[ext]
@@ -0,0 +1,167 @@
+from concurrent.futures import ProcessPoolExecutor
+import json
+
+import django
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.db import connections, transaction
+from tagging.forms import TagField
+from tagging.models import Tag, TaggedItem
+
+from .counters import tag_names
+from .models import AdvUser, Article, Category
+from .moderation import count_published, invalidate_listings
+
+# Text fields of a record, validated like ArticleForm does.
+TEXT_FIELDS = ('title', 'content', 'card_text', 'image_url')
+
+
+# Checks one JSONL line without the database, so it can run in a worker process.
+# Returns (line number, cleaned record or None, {field: [errors]}).
+def validate_record(item):
+    number, line = item
+    try:
+        data = json.loads(line)
+    except ValueError as error:
+        return number, None, {'json': [str(error)]}
+    if not isinstance(data, dict):
+        return number, None, {'json': ['Ожидается объект.']}
+    cleaned, errors = {}, {}
+    for name in TEXT_FIELDS:
+        try:
+            cleaned[name] = Article._meta.get_field(name).formfield().clean(data.get(name))
+        except ValidationError as error:
+            errors[name] = error.messages
+    tags = data.get('tags') or ''
+    if isinstance(tags, list):
+        tags = ', '.join(map(str, tags))
+    try:
+        cleaned['tags'] = TagField(required=False).clean(tags)
+    except ValidationError as error:
+        errors['tags'] = error.messages
+    for name in ('category', 'author'):
+        value = data.get(name)
+        if not isinstance(value, str) or not value.strip():
+            errors[name] = ['Обязательное поле.']
+        else:
+            cleaned[name] = value.strip()
+    return number, (None if errors else cleaned), errors
+
+
+# Ids of tags by name, missing tags are created with one bulk insert.
+def resolve_tags(names):
+    names = set(names)
+    found = dict(Tag.objects.filter(name__in=names).values_list('name', 'pk'))
+    missing = names - set(found)
+    if missing:
+        Tag.objects.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True)
+        found.update(Tag.objects.filter(name__in=missing).values_list('name', 'pk'))
+    # Case insensitive collations (MySQL) return the existing spelling of a tag.
+    folded = {name.lower(): pk for name, pk in found.items()}
+    return {name: found.get(name) or folded.get(name.lower()) for name in names}
+
+
+# Primary keys of just inserted articles. PostgreSQL returns them from bulk_create, other
+# databases don't: the rows are then found after `last_pk` by author and title, in insert order.
+def _inserted_pks(articles, last_pk):
+    if all(article.pk for article in articles):
+        return [article.pk for article in articles]
+    found = {}
+    rows = (Article.objects.filter(pk__gt=last_pk, author_id__in={a.author_id for a in articles})
+            .order_by('pk').values_list('pk', 'author_id', 'title'))
+    for pk, author, title in rows:
+        found.setdefault((author, title), []).append(pk)
+    return [found[(a.author_id, a.title)].pop(0) for a in articles]
+
+
+# Inserts one batch of valid records: categories, authors and tags are resolved with
+# a few set-based queries, articles and TaggedItem rows are bulk inserted.
+# records: [(line number, cleaned record)]. Returns (inserted, {line number: errors}).
+def insert_batch(records, active=False, dry_run=False):
+    categories = dict(Category.objects.filter(name__in={r['category'] for n, r in records}).values_list('name', 'pk'))
+    authors = dict(AdvUser.objects.filter(username__in={r['author'] for n, r in records}).values_list('username', 'pk'))
+    errors, valid = {}, []
+    for number, record in records:
+        problems = {}
+        if record['category'] not in categories:
+            problems['category'] = [f'Категория «{record["category"]}» не найдена.']
+        if record['author'] not in authors:
+            problems['author'] = [f'Пользователь «{record["author"]}» не найден.']
+        if problems:
+            errors[number] = problems
+        else:
+            valid.append(record)
+    if not valid or dry_run:
+        return (len(valid) if dry_run else 0), errors
+
+    with transaction.atomic():
+        tags = resolve_tags(name for record in valid for name in tag_names(record['tags']))
+        last_pk = Article.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        articles = [
+            Article(category_id=categories[record['category']], author_id=authors[record['author']],
+                    is_active=active, **{name: record[name] for name in TEXT_FIELDS + ('tags', )})
+            for record in valid
+        ]
+        Article.objects.bulk_create(articles)
+        pks = _inserted_pks(articles, last_pk)
+        content_type = ContentType.objects.get_for_model(Article)
+        TaggedItem.objects.bulk_create([
+            TaggedItem(tag_id=tags[name], content_type=content_type, object_id=pk)
+            for pk, record in zip(pks, valid) for name in tag_names(record['tags'])
+        ], ignore_conflicts=True)
+        rows = [(pk, a.author_id, a.category_id, a.tags, a.views, a.rating) for pk, a in zip(pks, articles)]
+        if active:
+            count_published(rows)
+    invalidate_listings(rows)
+    return len(valid), errors
+
+
+def _batches(lines, size):
+    batch = []
+    for number, line in enumerate(lines, 1):
+        if line.strip():
+            batch.append((number, line))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# Imports JSONL lines batch by batch. Records are validated in `workers` processes
+# (in this one when 0); the next batch is validated while the current one is inserted.
+# Database work stays in this process. Yields (records read, inserted, {line number: errors}) per batch.
+def import_lines(lines, batch_size=1000, workers=0, active=False, dry_run=False):
+    pool = None
+    if workers:
+        # Forked workers must not share the parent's database connections.
+        connections.close_all()
+        pool = ProcessPoolExecutor(workers, initializer=django.setup)
+
+    def validate(batch):
+        if batch is None:
+            return None
+        if pool is None:
+            return batch, map(validate_record, batch)
+        # Submits the whole batch right away.
+        return batch, pool.map(validate_record, batch, chunksize=max(1, len(batch) // (workers * 4)))
+
+    try:
+        batches = _batches(lines, batch_size)
+        pending = validate(next(batches, None))
+        while pending is not None:
+            batch, results = pending
+            results = list(results)
+            pending = validate(next(batches, None))
+            records, errors = [], {}
+            for number, record, problems in results:
+                if record is None:
+                    errors[number] = problems
+                else:
+                    records.append((number, record))
+            inserted, problems = insert_batch(records, active, dry_run) if records else (0, {})
+            errors.update(problems)
+            yield len(batch), inserted, errors
+    finally:
+        if pool is not None:
+            pool.shutdown()
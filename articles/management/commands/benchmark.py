@@ -0,0 +1,138 @@
+import json
+import math
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+from tagging.models import Tag
+
+from articles.models import AdvUser, Article, Category
+from articles.profiling import profile_queries
+from private_messages.models import Dialog
+
+
+# Nearest-rank percentile of sorted values.
+def percentile(values, percent):
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+# Drives the hot views in process with the test client and reports latency
+# percentiles and queries per request. Run it against a database filled by seed_data.
+class Command(BaseCommand):
+    help = 'Измеряет время ответа и количество запросов к БД основных страниц.'
+
+    # name: (needs logged in user, url builder)
+    SCENARIOS = {
+        'index': (False, lambda s: reverse('articles:index')),
+        'index_user': (True, lambda s: reverse('articles:index')),
+        'detail': (False, lambda s: reverse('articles:article', kwargs={'pk': s.choice(s.articles)})),
+        'search_tag': (False, lambda s: reverse('articles:search_by_tag', kwargs={'tag': s.choice(s.tags)})),
+        'search_category': (False, lambda s: reverse('articles:search_by_category', kwargs={'category_name': s.choice(s.categories)})),
+        'profile': (True, lambda s: reverse('articles:profile', kwargs={'username': s.choice(s.usernames)})),
+        'notify_user': (True, lambda s: reverse('articles:notify_user')),
+        'api_articles': (False, lambda s: reverse('articles:api_list', kwargs={'resource': 'articles'})),
+        'dialogs': (True, lambda s: reverse('private_messages:dialogs')),
+        'dialog_page': (True, lambda s: reverse('private_messages:dialog_page', kwargs={'dlg_id': s.choice(s.dialogs)})),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Запросов на сценарий.')
+        parser.add_argument('--warmup', type=int, default=10)
+        parser.add_argument('--scenario', action='append', choices=sorted(self.SCENARIOS), help='Сценарий (можно несколько).')
+        parser.add_argument('--user', help='Пользователь для сценариев с авторизацией.')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--sample', type=int, default=1000, help='Сколько статей, тегов и пользователей выбрать для запросов.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Вывести результат в JSON.')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests должно быть больше нуля.')
+        self.random = random.Random(options['seed'])
+        self.load_targets(options['sample'])
+        anonymous = Client(HTTP_HOST=options['host'])
+        logged_in = Client(HTTP_HOST=options['host'])
+        user = self.get_user(options['user'])
+        logged_in.force_login(user)
+        self.dialogs = list(Dialog.objects.filter(members=user).values_list('pk', flat=True)[:options['sample']])
+
+        scenarios = options['scenario'] or list(self.SCENARIOS)
+        if not self.dialogs and 'dialog_page' in scenarios:
+            if options['scenario']:
+                raise CommandError(f'У пользователя {user.username} нет диалогов.')
+            scenarios.remove('dialog_page')
+
+        results = []
+        for name in scenarios:
+            needs_user, url = self.SCENARIOS[name]
+            client = logged_in if needs_user else anonymous
+            for i in range(options['warmup']):
+                self.request(client, url(self))
+            results.append(self.run(name, client, url, options['requests']))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write('%-16s %6s %8s %8s %8s %8s %8s %8s' % ('scenario', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'queries', 'max q'))
+        for r in results:
+            self.stdout.write('%-16s %6d %8.1f %8.1f %8.1f %8.1f %8.1f %8d' % (
+                r['scenario'], r['requests'], r['p50'], r['p90'], r['p99'], r['max'], r['queries'], r['max_queries']))
+
+    def load_targets(self, sample):
+        self.articles = self.sample(Article.objects.filter(is_active=True), 'pk', sample)
+        self.categories = self.sample(Category.objects.all(), 'name', sample)
+        self.tags = self.sample(Tag.objects.all(), 'name', sample)
+        self.usernames = self.sample(AdvUser.objects.filter(is_active=True), 'username', sample)
+        if not (self.articles and self.categories and self.tags and self.usernames):
+            raise CommandError('Нет данных для запросов, сначала выполните seed_data.')
+
+    # Random rows of a table without ORDER BY RANDOM() over the whole table.
+    def sample(self, queryset, field, count):
+        last = queryset.order_by('-pk').values_list('pk', flat=True).first()
+        if last is None:
+            return []
+        pks = [self.random.randint(1, last) for i in range(count)]
+        values = list(queryset.filter(pk__in=pks).values_list(field, flat=True))
+        return values or list(queryset.values_list(field, flat=True)[:count])
+
+    def get_user(self, username):
+        if username:
+            try:
+                return AdvUser.objects.get(username=username)
+            except AdvUser.DoesNotExist:
+                raise CommandError(f'Пользователь {username} не найден.')
+        # Prefer a user with dialogs, so dialog pages can be measured too.
+        user = AdvUser.objects.filter(username__in=self.usernames, members__isnull=False).first()
+        return user or AdvUser.objects.get(username=self.random.choice(self.usernames))
+
+    def choice(self, values):
+        return self.random.choice(values)
+
+    def request(self, client, url):
+        response = client.get(url)
+        if response.status_code >= 400:
+            raise CommandError(f'{url}: {response.status_code}')
+
+    def run(self, name, client, url, count):
+        timings = []
+        queries = []
+        for i in range(count):
+            path = url(self)
+            with profile_queries() as profile:
+                start = time.perf_counter()
+                self.request(client, path)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(profile.count)
+        timings.sort()
+        return {
+            'scenario': name,
+            'requests': count,
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'max': timings[-1],
+            'queries': sum(queries) / count,
+            'max_queries': max(queries),
+        }
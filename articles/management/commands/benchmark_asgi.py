@@ -0,0 +1,101 @@
+import asyncio
+import json
+import random
+import time
+
+from asgiref.sync import async_to_sync
+from channels.http import AsgiHandler
+from channels.testing import HttpCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+from articles.async_views import AsyncViewRouter
+from articles.models import AdvUser
+from .benchmark import percentile
+
+
+# Sends concurrent requests to the ASGI application in process and compares latency of
+# the sync views (AsgiHandler) with their async consumers. Run it against a database
+# filled by seed_data, ideally PostgreSQL: SQLite serializes most of the work anyway.
+class Command(BaseCommand):
+    help = 'Сравнивает время ответа синхронных и асинхронных страниц при параллельных запросах.'
+
+    # name: (needs logged in user, url builder)
+    SCENARIOS = {
+        'index': (False, lambda s: reverse('articles:index')),
+        'index_user': (True, lambda s: reverse('articles:index')),
+        'profile': (True, lambda s: reverse('articles:profile', kwargs={'username': s.random.choice(s.usernames)})),
+    }
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Запросов на сценарий.')
+        parser.add_argument('--concurrency', type=int, default=20, help='Одновременных запросов.')
+        parser.add_argument('--scenario', action='append', choices=sorted(self.SCENARIOS), help='Сценарий (можно несколько).')
+        parser.add_argument('--user', help='Пользователь для сценариев с авторизацией.')
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--timeout', type=float, default=60, help='Таймаут одного запроса, секунд.')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--json', action='store_true', help='Вывести результат в JSON.')
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--requests и --concurrency должны быть больше нуля.')
+        self.options = options
+        self.random = random.Random(options['seed'])
+        self.usernames = list(AdvUser.objects.filter(is_active=True).values_list('username', flat=True)[:1000])
+        if not self.usernames:
+            raise CommandError('Нет пользователей, сначала выполните seed_data.')
+        user = AdvUser.objects.filter(username=options['user'] or self.usernames[0]).first()
+        if user is None:
+            raise CommandError(f'Пользователь {options["user"]} не найден.')
+        client = Client(HTTP_HOST=options['host'])
+        client.force_login(user)
+        self.session = client.cookies[settings.SESSION_COOKIE_NAME].value
+
+        results = []
+        for name in options['scenario'] or list(self.SCENARIOS):
+            for variant, application in (('sync', AsgiHandler), ('async', AsyncViewRouter())):
+                results.append(dict(async_to_sync(self.run)(application, name), scenario=name, variant=variant))
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        self.stdout.write('%-12s %-6s %6s %8s %8s %8s %8s %8s' % ('scenario', 'views', 'n', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'req/s'))
+        for r in results:
+            self.stdout.write('%-12s %-6s %6d %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+                r['scenario'], r['variant'], r['requests'], r['p50'], r['p90'], r['p99'], r['max'], r['rps']))
+
+    async def request(self, application, path, needs_user):
+        headers = [(b'host', self.options['host'].encode())]
+        if needs_user:
+            headers.append((b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.session}'.encode()))
+        communicator = HttpCommunicator(application, 'GET', path, headers=headers)
+        start = time.perf_counter()
+        response = await communicator.get_response(timeout=self.options['timeout'])
+        elapsed = (time.perf_counter() - start) * 1000
+        if response['status'] >= 400:
+            raise CommandError(f'{path}: {response["status"]}')
+        return elapsed
+
+    async def run(self, application, name):
+        needs_user, url = self.SCENARIOS[name]
+        count = self.options['requests']
+        semaphore = asyncio.Semaphore(self.options['concurrency'])
+
+        async def one():
+            async with semaphore:
+                return await self.request(application, url(self), needs_user)
+        await one()  # warm up
+        start = time.perf_counter()
+        timings = sorted(await asyncio.gather(*(one() for i in range(count))))
+        total = time.perf_counter() - start
+        return {
+            'requests': count,
+            'p50': percentile(timings, 50),
+            'p90': percentile(timings, 90),
+            'p99': percentile(timings, 99),
+            'max': timings[-1],
+            'rps': count / total,
+        }
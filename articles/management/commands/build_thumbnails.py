@@ -0,0 +1,53 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from articles.models import AdvUser, Article
+from articles.thumbnails import has_variants, make_variants
+
+
+# Builds resized variants for images uploaded before the thumbnail pipeline existed.
+class Command(BaseCommand):
+    help = 'Создает уменьшенные копии загруженных изображений статей и профилей.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Пересоздать уже существующие копии.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Количество процессов.')
+
+    def handle(self, *args, **options):
+        built = skipped = failed = 0
+        pending = set()
+        with ProcessPoolExecutor(max_workers=options['workers']) as pool:
+            for name in self.image_names():
+                if not options['force'] and has_variants(name):
+                    skipped += 1
+                    continue
+                pending.add(pool.submit(make_variants, settings.MEDIA_ROOT, name, settings.THUMBNAIL_WIDTHS,
+                                        settings.THUMBNAIL_FORMATS, settings.THUMBNAIL_QUALITY))
+                # Keep a bounded number of queued images, so memory doesn't grow with the table.
+                if len(pending) >= options['workers'] * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    b, f = self.count(done)
+                    built, failed = built + b, failed + f
+            b, f = self.count(wait(pending).done)
+            built, failed = built + b, failed + f
+        self.stdout.write(f'Built: {built}, skipped: {skipped}, failed: {failed}')
+
+    def image_names(self):
+        for model, field in ((Article, 'image'), (AdvUser, 'account_image')):
+            names = model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True}).values_list(field, flat=True)
+            for name in names.iterator(chunk_size=2000):
+                if os.path.exists(os.path.join(settings.MEDIA_ROOT, name)):
+                    yield name
+
+    def count(self, futures):
+        built = failed = 0
+        for future in futures:
+            if future.exception() is None:
+                built += 1
+            else:
+                failed += 1
+                self.stderr.write(str(future.exception()))
+        return built, failed
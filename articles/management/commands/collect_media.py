@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from articles.storage import collect_garbage, recount_references
+
+
+# Removes uploaded files which aren't used by any article or user.
+class Command(BaseCommand):
+    help = 'Удаляет загруженные файлы, на которые не ссылается ни одна запись.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recount', action='store_true', help='Пересчитать счетчики ссылок перед удалением.')
+        parser.add_argument('--min-age', type=int, default=3600, help='Не удалять файлы моложе указанного числа секунд.')
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Только показать количество файлов.')
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            counts = recount_references()
+            self.stdout.write(f'Referenced files: {len(counts)}')
+        checked, deleted = collect_garbage(min_age=options['min_age'], batch_size=options['batch_size'], dry_run=options['dry_run'])
+        action = 'Would delete' if options['dry_run'] else 'Deleted'
+        self.stdout.write(f'Checked: {checked}. {action}: {deleted}')
@@ -0,0 +1,31 @@
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from articles.exports import DATASETS, FORMATS, export_chunks
+
+
+# Streams a dataset to a file or stdout in constant memory, e.g.
+#     manage.py export_data votes --format jsonl --gzip -o votes.jsonl.gz
+class Command(BaseCommand):
+    help = 'Выгружает статьи, пользователей, голоса или просмотры в CSV или JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('dataset', choices=sorted(DATASETS))
+        parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+        parser.add_argument('--gzip', action='store_true', help='Сжать gzip.')
+        parser.add_argument('-o', '--output', default='-', help='Файл (по умолчанию stdout).')
+        parser.add_argument('--chunk-size', type=int, default=settings.EXPORT_CHUNK_SIZE, help='Строк в одном запросе.')
+
+    def handle(self, *args, **options):
+        chunks = export_chunks(options['dataset'], options['format'], options['gzip'], options['chunk_size'])
+        output = sys.stdout.buffer if options['output'] == '-' else open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is sys.stdout.buffer:
+                output.flush()
+            else:
+                output.close()
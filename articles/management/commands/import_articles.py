@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from articles.importer import import_lines
+
+
+# Bulk import of articles from JSONL, one object per line:
+#     {"title": "...", "content": "...", "category": "python", "author": "username",
+#      "tags": "django, orm" or ["django", "orm"], "card_text": "...", "image_url": "..."}
+# Categories and authors must exist, missing tags are created. Invalid records are
+# skipped and reported with their line numbers.
+class Command(BaseCommand):
+    help = 'Импортирует статьи из JSONL пакетами.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл JSONL ("-" - stdin).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Статей в одной транзакции.')
+        parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                            help='Процессов для проверки записей (0 - в этом процессе).')
+        parser.add_argument('--active', action='store_true', help='Сразу опубликовать статьи.')
+        parser.add_argument('--dry-run', action='store_true', help='Только проверить записи.')
+        parser.add_argument('--errors', help='Файл JSONL для ошибок (по умолчанию stderr).')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1 or options['workers'] < 0:
+            raise CommandError('--batch-size должен быть больше нуля, --workers не меньше нуля.')
+        source = sys.stdin if options['path'] == '-' else open(options['path'], encoding='utf-8')
+        errors_file = open(options['errors'], 'w', encoding='utf-8') if options['errors'] else None
+        read = inserted = failed = 0
+        start = time.perf_counter()
+        try:
+            batches = import_lines(source, options['batch_size'], options['workers'], options['active'], options['dry_run'])
+            for count, done, errors in batches:
+                read, inserted, failed = read + count, inserted + done, failed + len(errors)
+                for number, problems in sorted(errors.items()):
+                    line = json.dumps({'line': number, 'errors': problems}, ensure_ascii=False)
+                    if errors_file:
+                        errors_file.write(line + '\n')
+                    else:
+                        self.stderr.write(line)
+                elapsed = time.perf_counter() - start
+                self.stdout.write(f'{read} records, {inserted} imported, {failed} failed, {read / elapsed:.0f} records/s')
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if errors_file:
+                errors_file.close()
+        elapsed = time.perf_counter() - start
+        verb = 'valid' if options['dry_run'] else 'imported'
+        self.stdout.write(f'Done in {elapsed:.1f}s: {inserted} {verb}, {failed} failed, {read / elapsed if elapsed else 0:.0f} records/s')
@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from articles.revisions import prune_all
+
+
+# Drops old article revisions, keeping the last ones of every article.
+class Command(BaseCommand):
+    help = 'Удаляет старые версии статей, оставляя последние.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--keep', type=int, default=settings.ARTICLE_REVISION_KEEP,
+                            help='Сколько последних версий оставить у каждой статьи.')
+
+    def handle(self, *args, **options):
+        deleted = prune_all(options['keep'])
+        self.stdout.write(f'Deleted revisions: {deleted}')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from articles.counters import rebuild_counters
+
+
+# Recomputes category and tag counters from published articles, e.g. after
+# raw SQL that bypasses the incremental updates.
+class Command(BaseCommand):
+    help = 'Пересчитывает счетчики статей по категориям и тегам.'
+
+    def handle(self, *args, **options):
+        categories, tags = rebuild_counters()
+        self.stdout.write(f'Rebuilt categories: {categories}, tags: {tags}')
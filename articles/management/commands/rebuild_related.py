@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from articles.related import rebuild_related
+
+
+# Recomputes TF-IDF vectors and related articles of all published articles.
+# Run it periodically (e.g. nightly): new articles get neighbours on publication,
+# but document frequencies and vectors of older articles are only updated here.
+class Command(BaseCommand):
+    help = 'Пересчитывает похожие статьи.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=None, help='Статей в одной порции записи.')
+
+    def handle(self, *args, **options):
+        count = rebuild_related(options['chunk_size'])
+        self.stdout.write(f'Rebuilt related articles: {count}')
@@ -0,0 +1,48 @@
+import multiprocessing
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from articles.task_queue import Worker
+
+
+def run_worker(queues, concurrency, poll_interval, once):
+    worker = Worker(queues, concurrency, poll_interval)
+    # SIGTERM and Ctrl+C stop taking new tasks, running ones are finished.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: worker.stop())
+    return worker.run(once=once)
+
+
+# Background task worker: `--processes` processes with `--concurrency` threads each.
+class Command(BaseCommand):
+    help = 'Выполняет фоновые задачи из очереди в базе данных.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--queue', action='append', help='Очередь (можно несколько), по умолчанию все из TASK_QUEUES.')
+        parser.add_argument('--processes', type=int, default=1)
+        parser.add_argument('--concurrency', type=int, default=settings.TASK_WORKER_CONCURRENCY, help='Потоков на процесс.')
+        parser.add_argument('--poll-interval', type=float, default=settings.TASK_POLL_INTERVAL)
+        parser.add_argument('--once', action='store_true', help='Выполнить готовые задачи и выйти.')
+
+    def handle(self, *args, **options):
+        if options['processes'] < 1 or options['concurrency'] < 1:
+            raise CommandError('--processes и --concurrency должны быть больше нуля.')
+        unknown = set(options['queue'] or ()) - set(settings.TASK_QUEUES)
+        if unknown:
+            raise CommandError(f'Неизвестные очереди: {", ".join(sorted(unknown))}.')
+        worker_args = (options['queue'], options['concurrency'], options['poll_interval'], options['once'])
+        if options['processes'] == 1:
+            processed = run_worker(*worker_args)
+            self.stdout.write(f'Processed tasks: {processed}')
+            return
+        # Children must not share the parent's database connections.
+        connections.close_all()
+        processes = [multiprocessing.Process(target=run_worker, args=worker_args) for i in range(options['processes'])]
+        for process in processes:
+            process.start()
+        signal.signal(signal.SIGTERM, lambda *args: [process.terminate() for process in processes])
+        for process in processes:
+            process.join()
@@ -0,0 +1,218 @@
+from datetime import datetime
+import random
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+from tagging.models import Tag, TaggedItem
+
+from articles.counters import rebuild_counters
+from articles.models import AdvUser, Article, Category, Notifications
+from private_messages.models import Dialog, Message
+
+WORDS = ('python', 'django', 'postgres', 'linux', 'docker', 'rust', 'go', 'javascript', 'react', 'css',
+         'алгоритмы', 'базы', 'данных', 'сети', 'безопасность', 'тестирование', 'карьера', 'стартап',
+         'облако', 'kubernetes', 'git', 'api', 'очереди', 'кэш', 'производительность', 'мониторинг')
+
+
+# Yields lists of at most `size` items, so rows are never all in memory.
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Generates a large dataset for load tests and benchmarks (see the benchmark command).
+# Everything is inserted with chunked bulk_create, signals aren't sent; the category and
+# tag counters are rebuilt at the end.
+class Command(BaseCommand):
+    help = 'Заполняет базу тестовыми пользователями, подписками, статьями, тегами, голосами, просмотрами и уведомлениями.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--articles', type=int, default=10000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--tags', type=int, default=500, help='Размер словаря тегов.')
+        parser.add_argument('--follows', type=int, default=20, help='Подписок на пользователя.')
+        parser.add_argument('--views', type=int, default=30, help='Просмотров на статью (в среднем).')
+        parser.add_argument('--votes', type=int, default=5, help='Голосов на статью (в среднем).')
+        parser.add_argument('--notifications', type=int, default=10, help='Уведомлений на пользователя.')
+        parser.add_argument('--dialogs', type=int, default=3, help='Диалогов на пользователя.')
+        parser.add_argument('--messages', type=int, default=20, help='Сообщений в диалоге (в среднем).')
+        parser.add_argument('--chunk-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--prefix', default='seed', help='Префикс имен пользователей.')
+
+    def handle(self, *args, **options):
+        self.random = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        prefix = options['prefix']
+
+        categories = self.create_categories(options['categories'], prefix)
+        tags = self.create_tags(options['tags'], prefix)
+        users = self.create_users(options['users'], prefix)
+        if not users:
+            return
+        self.create_follows(users, options['follows'])
+        articles = self.create_articles(options['articles'], users, categories, tags)
+        self.create_views(articles, users, options['views'])
+        self.create_votes(articles, users, options['votes'])
+        self.create_notifications(users, options['notifications'])
+        self.create_dialogs(users, options['dialogs'], options['messages'])
+        # Category and tag counters are kept by signals, which bulk_create doesn't send.
+        categories, tags = rebuild_counters()
+        self.stdout.write(f'Rebuilt counters: categories {categories}, tags {tags}')
+
+    def insert(self, model, rows, **kwargs):
+        total = 0
+        for chunk in chunked(rows, self.chunk_size):
+            model.objects.bulk_create(chunk, **kwargs)
+            total += len(chunk)
+        self.stdout.write(f'{model._meta.label}: {total}')
+        return total
+
+    # Primary keys of rows inserted after `last_pk` (bulk_create doesn't return them on every backend).
+    def new_pks(self, model, last_pk):
+        return list(model.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', flat=True))
+
+    def last_pk(self, model):
+        return model.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+
+    def create_categories(self, count, prefix):
+        self.insert(Category, (Category(name=f'{prefix}-{i}', order=i) for i in range(count)), ignore_conflicts=True)
+        return list(Category.objects.filter(name__startswith=f'{prefix}-').values_list('pk', flat=True))
+
+    def create_tags(self, count, prefix):
+        names = [f'{WORDS[i % len(WORDS)]}{i // len(WORDS) or ""}' for i in range(count)]
+        self.insert(Tag, (Tag(name=name) for name in names), ignore_conflicts=True)
+        return list(Tag.objects.filter(name__in=names).values_list('pk', 'name'))
+
+    def create_users(self, count, prefix):
+        # Password hashing is deliberately slow, so all generated users share one hash of "password".
+        password = make_password('password')
+        last_pk = self.last_pk(AdvUser)
+        start = AdvUser.objects.filter(username__startswith=f'{prefix}_user').count()
+        self.insert(AdvUser, (
+            AdvUser(username=f'{prefix}_user{i}', email=f'{prefix}_user{i}@example.com', password=password,
+                    first_name=self.random.choice(WORDS).title(), is_active=True, is_activated=True)
+            for i in range(start, start + count)
+        ))
+        users = AdvUser.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'username')
+        self.usernames = dict(users)
+        return list(self.usernames)
+
+    def create_follows(self, users, follows):
+        Through = AdvUser.user_subscriptions.through
+        follows = min(follows, len(users) - 1)
+
+        # Popular authors get more followers: targets are skewed to the start of the list.
+        def rows():
+            for user in users:
+                targets = {users[int(len(users) * self.random.random() ** 2)] for i in range(follows)}
+                targets.discard(user)
+                for target in targets:
+                    # Subscriptions are symmetrical, both directions are stored.
+                    yield Through(from_advuser_id=user, to_advuser_id=target)
+                    yield Through(from_advuser_id=target, to_advuser_id=user)
+        self.insert(Through, rows(), ignore_conflicts=True)
+
+    def create_articles(self, count, users, categories, tags):
+        last_pk = self.last_pk(Article)
+        tag_choices = []
+
+        def rows():
+            for i in range(count):
+                article_tags = self.random.sample(tags, min(len(tags), self.random.randint(1, 4)))
+                tag_choices.append([pk for pk, name in article_tags])
+                words = ' '.join(self.random.choice(WORDS) for j in range(self.random.randint(50, 400)))
+                yield Article(category_id=self.random.choice(categories), author_id=self.random.choice(users),
+                              title=f'Статья {i}: {self.random.choice(WORDS)}', content=words, card_text=words[:200],
+                              tags=' '.join(name for pk, name in article_tags), is_active=self.random.random() < 0.9)
+        self.insert(Article, rows())
+        articles = self.new_pks(Article, last_pk)
+
+        # TagField is filled by post_save, which bulk_create doesn't send.
+        content_type = ContentType.objects.get_for_model(Article)
+        self.insert(TaggedItem, (
+            TaggedItem(tag_id=tag, content_type=content_type, object_id=article)
+            for article, article_tags in zip(articles, tag_choices) for tag in article_tags
+        ), ignore_conflicts=True)
+        return articles
+
+    # Random users for every article, number of them is exponentially distributed around `average`.
+    def sample_users(self, users, average):
+        count = int(self.random.expovariate(1 / average)) if average else 0
+        return self.random.sample(users, min(len(users), count))
+
+    def create_views(self, articles, users, average):
+        Through = Article.viewed_users.through
+        self.insert(Through, (
+            Through(article_id=article, advuser_id=user)
+            for article in articles for user in self.sample_users(users, average)
+        ))
+        # Anonymous readers are counted too, so views >= readers.
+        for chunk in chunked(articles, self.chunk_size):
+            counts = dict(Through.objects.filter(article_id__in=chunk).values('article_id').annotate(n=Count('pk')).values_list('article_id', 'n'))
+            Article.objects.bulk_update([
+                Article(pk=pk, views=counts.get(pk, 0) + self.random.randint(0, 50)) for pk in chunk
+            ], ('views',))
+
+    def create_votes(self, articles, users, average):
+        Through = Article.rated_users.through
+        ratings = []
+
+        def rows():
+            for article in articles:
+                voters = self.sample_users(users, average)
+                if voters:
+                    marks = [self.random.randint(1, 5) for voter in voters]
+                    ratings.append(Article(pk=article, total_rating=sum(marks), rating=round(sum(marks) / len(marks), 2)))
+                for voter in voters:
+                    yield Through(article_id=article, advuser_id=voter)
+                if len(ratings) >= self.chunk_size:
+                    self.update_ratings(ratings)
+        self.insert(Through, rows())
+        self.update_ratings(ratings)
+
+    def update_ratings(self, ratings):
+        Article.objects.bulk_update(ratings, ('total_rating', 'rating'))
+        ratings.clear()
+
+    def create_notifications(self, users, count):
+        created_at = datetime.now().strftime('%H:%M:%S %m/%d/%Y')
+
+        def rows():
+            for user in users:
+                for i in range(count):
+                    sender = self.usernames[self.random.choice(users)]
+                    yield Notifications(user_id=user, sender=f'/accounts/profile/{sender}',
+                                        n_type='Новый подписчик!', content=f'Уведомление {i}',
+                                        created_at=created_at, viewed=self.random.random() < 0.5)
+        self.insert(Notifications, rows())
+
+    def create_dialogs(self, users, per_user, average):
+        pairs = [(user, self.random.choice(users)) for user in users for i in range(per_user)]
+        pairs = [(a, b) for a, b in pairs if a != b]
+        last_pk = self.last_pk(Dialog)
+        self.insert(Dialog, (Dialog() for pair in pairs))
+        dialogs = self.new_pks(Dialog, last_pk)
+
+        Through = Dialog.members.through
+        self.insert(Through, (
+            Through(dialog_id=dialog, advuser_id=member)
+            for dialog, pair in zip(dialogs, pairs) for member in pair
+        ))
+
+        def rows():
+            for dialog, pair in zip(dialogs, pairs):
+                for i in range(int(self.random.expovariate(1 / average)) if average else 0):
+                    sender, receiver = pair if self.random.random() < 0.5 else pair[::-1]
+                    yield Message(dialog_id=dialog, sender=self.usernames[sender], receiver=self.usernames[receiver],
+                                  message=' '.join(self.random.choice(WORDS) for j in range(self.random.randint(1, 30))))
+        self.insert(Message, rows())
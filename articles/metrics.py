@@ -0,0 +1,84 @@
+import hmac
+import os
+import time
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+
+from .profiling import profile_queries
+
+# With several worker processes (gunicorn, daphne) set prometheus_multiproc_dir
+# environment variable to an empty directory, cleaned up on every deploy: each
+# process then writes its values to mmap files there and /metrics sums them.
+# Gunicorn should call multiprocess.mark_process_dead(worker.pid) in child_exit hook,
+# so gauges of dead workers are dropped.
+
+REQUEST_LATENCY = Histogram('articlesboard_request_duration_seconds', 'Время обработки запроса',
+                            ['view', 'method', 'status'],
+                            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+DB_QUERIES = Histogram('articlesboard_db_queries_per_request', 'Запросов к БД на HTTP запрос', ['view'],
+                       buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200))
+DB_TIME = Counter('articlesboard_db_seconds', 'Время выполнения запросов к БД', ['view'])
+CACHE_REQUESTS = Counter('articlesboard_cache_requests', 'Обращения к кэшу', ['cache', 'result'])
+TASK_DURATION = Histogram('articlesboard_task_duration_seconds', 'Время выполнения фоновой задачи', ['task', 'status'],
+                          buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+TASK_WAIT = Histogram('articlesboard_task_wait_seconds', 'Ожидание фоновой задачи в очереди', ['queue'],
+                      buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800))
+TASKS_RUNNING = Gauge('articlesboard_tasks_running', 'Выполняемые фоновые задачи', ['queue'], multiprocess_mode='livesum')
+WEBSOCKETS = Gauge('articlesboard_websocket_connections', 'Открытые websocket соединения', ['consumer'],
+                   multiprocess_mode='livesum')
+
+
+# Counts a cache lookup, hit ratio is rate(hit) / rate(hit + miss).
+def record_cache(name, hit):
+    CACHE_REQUESTS.labels(name, 'hit' if hit else 'miss').inc()
+
+
+# Records latency, status and DB usage of every request by view name.
+# DB numbers come from SQLProfilerMiddleware when it is enabled, so queries are wrapped once.
+class MetricsMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        start = time.perf_counter()
+        if settings.SQL_PROFILER:
+            response = self.get_response(request)
+            profile = getattr(request, 'query_profile', None)
+        else:
+            with profile_queries() as profile:
+                response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unresolved'
+        REQUEST_LATENCY.labels(view, request.method, response.status_code).observe(duration)
+        if profile is not None:
+            DB_QUERIES.labels(view).observe(profile.count)
+            DB_TIME.labels(view).inc(profile.duration)
+        return response
+
+
+def _registry():
+    if 'prometheus_multiproc_dir' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def _allowed(request):
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    token = settings.METRICS_TOKEN
+    return bool(token) and hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token)
+
+
+# Metrics in Prometheus text format. Scraper authenticates with
+# "Authorization: Bearer <METRICS_TOKEN>", staff users can open it in a browser.
+def metrics_view(request):
+    if not _allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(generate_latest(_registry()), content_type=CONTENT_TYPE_LATEST)
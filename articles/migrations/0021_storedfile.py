@@ -0,0 +1,39 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:18
+
+from django.db import migrations, models
+
+
+# Files uploaded before content addressed storage get their reference counters.
+def count_references(apps, schema_editor):
+    StoredFile = apps.get_model('articles', 'StoredFile')
+    counts = {}
+    for model_name, field in (('Article', 'image'), ('AdvUser', 'account_image')):
+        model = apps.get_model('articles', model_name)
+        names = model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True}).values_list(field, flat=True)
+        for name in names.iterator():
+            counts[name] = counts.get(name, 0) + 1
+    StoredFile.objects.bulk_create([StoredFile(name=name, ref_count=count) for name, count in counts.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0020_auto_20190625_1529'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Путь')),
+                ('ref_count', models.IntegerField(db_index=True, default=0, verbose_name='Количество ссылок')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')),
+            ],
+            options={
+                'verbose_name': 'Файл',
+                'verbose_name_plural': 'Файлы',
+            },
+        ),
+        migrations.RunPython(count_references, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0021_storedfile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='advuser',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Изменен'),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='article',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now, verbose_name='Изменена'),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0022_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SlowQuery',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sql', models.TextField(verbose_name='Запрос')),
+                ('params', models.TextField(blank=True, default='', verbose_name='Параметры')),
+                ('duration', models.FloatField(verbose_name='Время, с')),
+                ('database', models.CharField(default='default', max_length=50, verbose_name='База данных')),
+                ('view', models.CharField(blank=True, db_index=True, default='', max_length=200, verbose_name='Представление')),
+                ('path', models.TextField(blank=True, default='', verbose_name='Адрес')),
+                ('plan', models.TextField(blank=True, default='', verbose_name='План запроса')),
+                ('analyzed', models.BooleanField(default=False, verbose_name='EXPLAIN ANALYZE')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Время')),
+            ],
+            options={
+                'verbose_name': 'Медленный запрос',
+                'verbose_name_plural': 'Медленные запросы',
+                'ordering': ('-pk',),
+            },
+        ),
+    ]
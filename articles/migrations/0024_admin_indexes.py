@@ -0,0 +1,48 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:35
+
+from django.db import migrations, models
+
+# Trigram indexes serve admin search: icontains is UPPER(column::text) LIKE UPPER(%...%),
+# which a b-tree index can't help.
+# PostgreSQL only: pg_trgm is a PostgreSQL extension.
+TRIGRAM_INDEXES = (
+    ('articles_article_title_trgm', 'articles_article', 'title'),
+    ('articles_advuser_username_trgm', 'articles_advuser', 'username'),
+    ('articles_advuser_email_trgm', 'articles_advuser', 'email'),
+    ('articles_advuser_first_name_trgm', 'articles_advuser', 'first_name'),
+    ('articles_advuser_last_name_trgm', 'articles_advuser', 'last_name'),
+)
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} USING gin (UPPER({column}::text) gin_trgm_ops)')
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for name, table, column in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {name}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0023_slowquery'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='advuser',
+            index=models.Index(fields=['date_joined'], name='articles_advuser_joined_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='article',
+            index=models.Index(fields=['is_active', 'created_at'], name='articles_active_created_idx'),
+        ),
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0024_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArticleRevision',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(verbose_name='Номер')),
+                ('is_snapshot', models.BooleanField(default=False, verbose_name='Полная копия')),
+                ('data', models.BinaryField(verbose_name='Данные')),
+                ('size', models.PositiveIntegerField(default=0, verbose_name='Размер, байт')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Сохранена')),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='revisions', to='articles.Article', verbose_name='Статья')),
+                ('editor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL, verbose_name='Автор правки')),
+            ],
+            options={
+                'verbose_name': 'Версия статьи',
+                'verbose_name_plural': 'Версии статей',
+                'ordering': ('article', 'number'),
+                'unique_together': {('article', 'number')},
+            },
+        ),
+    ]
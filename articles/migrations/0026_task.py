@@ -0,0 +1,42 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:45
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0025_articlerevision'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Task',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=200, verbose_name='Задача')),
+                ('queue', models.CharField(default='default', max_length=50, verbose_name='Очередь')),
+                ('payload', models.TextField(default='{}', verbose_name='Аргументы')),
+                ('status', models.CharField(choices=[('queued', 'В очереди'), ('running', 'Выполняется'), ('done', 'Выполнена'), ('failed', 'Ошибка')], default='queued', max_length=10, verbose_name='Состояние')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')),
+                ('max_attempts', models.PositiveSmallIntegerField(default=3, verbose_name='Максимум попыток')),
+                ('run_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Запустить после')),
+                ('worker', models.CharField(blank=True, default='', max_length=100, verbose_name='Обработчик')),
+                ('started_at', models.DateTimeField(blank=True, null=True, verbose_name='Начата')),
+                ('finished_at', models.DateTimeField(blank=True, null=True, verbose_name='Завершена')),
+                ('duration', models.FloatField(blank=True, null=True, verbose_name='Время, с')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Ошибка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Создана')),
+            ],
+            options={
+                'verbose_name': 'Фоновая задача',
+                'verbose_name_plural': 'Фоновые задачи',
+                'ordering': ('-pk',),
+            },
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'queue', 'run_at'], name='articles_task_pending_idx'),
+        ),
+    ]
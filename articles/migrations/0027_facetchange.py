@@ -0,0 +1,26 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:54
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0026_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacetChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('article_id', models.IntegerField(verbose_name='Статья')),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Время')),
+            ],
+            options={
+                'verbose_name': 'Изменение фасетов',
+                'verbose_name_plural': 'Изменения фасетов',
+            },
+        ),
+    ]
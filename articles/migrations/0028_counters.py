@@ -0,0 +1,58 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:05
+
+from collections import Counter
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+from tagging import settings as tagging_settings
+from tagging.utils import parse_tag_input
+
+
+# Counters of existing articles, later kept up to date by articles/counters.py.
+def fill_counters(apps, schema_editor):
+    Article = apps.get_model('articles', 'Article')
+    CategoryCount = apps.get_model('articles', 'CategoryCount')
+    TagCount = apps.get_model('articles', 'TagCount')
+    published = Article.objects.filter(is_active=True)
+    categories = published.order_by().values('category').annotate(count=Count('pk')).values_list('category', 'count')
+    CategoryCount.objects.bulk_create([CategoryCount(category_id=pk, articles=n) for pk, n in categories], batch_size=1000)
+    tags = Counter()
+    for value in published.values_list('tags', flat=True).iterator():
+        names = parse_tag_input(value or '')
+        tags.update({name.lower() for name in names} if tagging_settings.FORCE_LOWERCASE_TAGS else set(names))
+    TagCount.objects.bulk_create([TagCount(name=name, articles=n) for name, n in tags.items()], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0027_facetchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryCount',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='article_count', serialize=False, to='articles.Category', verbose_name='Категория')),
+                ('articles', models.IntegerField(default=0, verbose_name='Статей')),
+            ],
+            options={
+                'verbose_name': 'Счетчик категории',
+                'verbose_name_plural': 'Счетчики категорий',
+            },
+        ),
+        migrations.CreateModel(
+            name='TagCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True, verbose_name='Тег')),
+                ('articles', models.IntegerField(db_index=True, default=0, verbose_name='Статей')),
+            ],
+            options={
+                'verbose_name': 'Счетчик тега',
+                'verbose_name_plural': 'Счетчики тегов',
+            },
+        ),
+        migrations.RunPython(fill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,62 @@
+# Generated by Django 2.2.13 on 2026-10-19 15:10
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0028_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RelatedTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=60, unique=True, verbose_name='Термин')),
+                ('documents', models.IntegerField(default=0, verbose_name='Статей')),
+            ],
+            options={
+                'verbose_name': 'Частота термина',
+                'verbose_name_plural': 'Частоты терминов',
+            },
+        ),
+        migrations.CreateModel(
+            name='RelatedArticle',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField(verbose_name='Сходство')),
+                ('rank', models.SmallIntegerField(verbose_name='Место')),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='related_links', to='articles.Article', verbose_name='Статья')),
+                ('related', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='articles.Article', verbose_name='Похожая статья')),
+            ],
+            options={
+                'verbose_name': 'Похожая статья',
+                'verbose_name_plural': 'Похожие статьи',
+                'ordering': ('article', 'rank'),
+            },
+        ),
+        migrations.CreateModel(
+            name='ArticleTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(db_index=True, max_length=60, verbose_name='Термин')),
+                ('weight', models.FloatField(verbose_name='Вес')),
+                ('article', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='articles.Article', verbose_name='Статья')),
+            ],
+            options={
+                'verbose_name': 'Термин статьи',
+                'verbose_name_plural': 'Термины статей',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='relatedarticle',
+            index=models.Index(fields=['article', 'rank'], name='articles_related_rank_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='articleterm',
+            unique_together={('article', 'term')},
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 2.2.13 on 2026-10-19 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('articles', '0029_related_articles'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskQueueLock',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False, verbose_name='Очередь')),
+            ],
+            options={
+                'verbose_name': 'Очередь задач',
+                'verbose_name_plural': 'Очереди задач',
+            },
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Последний сигнал'),
+        ),
+    ]
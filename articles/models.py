@@ -1,5 +1,7 @@
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Q, Value
+from django.db.models.signals import m2m_changed
 from django.dispatch import Signal
 from django.utils import timezone
 from django.utils.html import format_html
@@ -11,20 +13,24 @@ from django_countries.fields import CountryField
 from tagging.models import Tag
 from tagging_autocomplete_new.models import TagAutocompleteField
 
-from .utilities import send_activation_notification
+from .snapshots import refresh_fields
+
 import os
 
 
 # Returns image path in media folder.
+# ContentAddressedStorage (articles/storage.py) replaces the name with content hash.
 def get_image_path(instance, filename):
-    return os.path.join('images', str(instance.id), filename)
+    return os.path.join('images', filename)
 
 
 user_registrated = Signal(providing_args=['instance'])
 
 
+# Activation email is sent by a background task (articles/tasks.py).
 def user_registrated_dispatcher(sender, **kwargs):
-    send_activation_notification(kwargs['instance'])
+    from .tasks import send_activation_email
+    send_activation_email.delay(kwargs['instance'].pk)
     
 
 user_registrated.connect(user_registrated_dispatcher)
@@ -85,6 +91,7 @@ class AdvUser (AbstractUser):
     # System.
     is_activated = models.BooleanField(default=True, db_index=True, verbose_name='Активирован?', help_text='Пользователю было отправлено письмо на почту с ссылкой для активации аккаунта.')
     send_messages = models.BooleanField(default=True, verbose_name='Присылать сообщения о новых комментариях?')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменен')
 
     # account_image preview in admin site.
     def admin_image(self):
@@ -95,6 +102,11 @@ class AdvUser (AbstractUser):
     admin_image.short_description = 'Превью'
     admin_image.allow_tags = True
 
+    # Receivers of post_save compared the loaded field values (articles/snapshots.py) with the saved ones.
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        refresh_fields(self, kwargs.get('update_fields'))
+
     def subscribe_user(self, user: 'self'):
         self.user_subscriptions.add(user)
         self.save()
@@ -119,6 +131,51 @@ class AdvUser (AbstractUser):
         self.cat_subscriptions.remove(category)
         self.save()
 
+    # Applies several subscription changes at once.
+    # changes: {'tags_subscriptions': (ids_to_add, ids_to_remove), ...}
+    # Returns {'tags_subscriptions': (added_ids, removed_ids), ...}.
+    def update_subscriptions(self, changes: dict):
+        fields = {name: self._meta.get_field(name) for name in changes}
+        # Current state of every mentioned subscription in one query.
+        current = None
+        for name, (add, remove) in changes.items():
+            field = fields[name]
+            source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+            qs = field.remote_field.through.objects.filter(**{source: self.pk, target + '__in': set(add) | set(remove)})
+            qs = qs.annotate(relation=Value(name, output_field=models.CharField())).values_list('relation', target)
+            current = qs if current is None else current.union(qs, all=True)
+        existing = {name: set() for name in changes}
+        if current is not None:
+            for name, pk in current:
+                existing[name].add(pk)
+
+        result = {}
+        with transaction.atomic():
+            for name, (add, remove) in changes.items():
+                field = fields[name]
+                through = field.remote_field.through
+                source, target = field.m2m_field_name(), field.m2m_reverse_field_name()
+                to_add = set(add) - existing[name]
+                to_remove = (set(remove) - set(add)) & existing[name]
+                symmetrical = field.remote_field.symmetrical
+                if to_add:
+                    rows = [through(**{source + '_id': self.pk, target + '_id': pk}) for pk in to_add]
+                    # Symmetrical relation (user <-> user) keeps both directions, like .add() does.
+                    if symmetrical:
+                        rows += [through(**{source + '_id': pk, target + '_id': self.pk}) for pk in to_add]
+                    through.objects.bulk_create(rows, ignore_conflicts=True)
+                    m2m_changed.send(sender=through, instance=self, action='post_add', reverse=False,
+                                     model=field.related_model, pk_set=to_add, using=self._state.db)
+                if to_remove:
+                    condition = Q(**{source: self.pk, target + '__in': to_remove})
+                    if symmetrical:
+                        condition |= Q(**{source + '__in': to_remove, target: self.pk})
+                    through.objects.filter(condition).delete()
+                    m2m_changed.send(sender=through, instance=self, action='post_remove', reverse=False,
+                                     model=field.related_model, pk_set=to_remove, using=self._state.db)
+                result[name] = (to_add, to_remove)
+        return result
+
     def change_rating(self, rating: int, articles):
         total_rating = 0
         for article in articles:
@@ -126,9 +183,17 @@ class AdvUser (AbstractUser):
         self.rating = round(total_rating/len(articles), 0)
         self.save()
 
+    # Author rating: the mean rating of their articles. Authors without articles keep theirs.
+    def recompute_rating(self):
+        rating = Article.objects.filter(author=self).aggregate(rating=models.Avg('rating'))['rating']
+        if rating is not None:
+            self.rating = round(rating)
+            self.save(update_fields=['rating'])
+
     class Meta :
        verbose_name = 'Пользователь'
        verbose_name_plural = 'Пользователи'
+       indexes = [models.Index(fields=['date_joined'], name='articles_advuser_joined_idx')]
 
 
 class Notifications(models.Model):
@@ -145,6 +210,125 @@ class Notifications(models.Model):
         verbose_name_plural = 'Уведомления'
 
 
+# File in content addressed storage and number of objects using it.
+class StoredFile(models.Model):
+    name = models.CharField(max_length=255, unique=True, verbose_name='Путь')
+    ref_count = models.IntegerField(default=0, db_index=True, verbose_name='Количество ссылок')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Дата загрузки')
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
+
+# Background task (articles/task_queue.py), executed by `manage.py run_tasks` workers.
+class Task(models.Model):
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = (
+        (QUEUED, 'В очереди'),
+        (RUNNING, 'Выполняется'),
+        (DONE, 'Выполнена'),
+        (FAILED, 'Ошибка'),
+    )
+
+    name = models.CharField(max_length=200, verbose_name='Задача')
+    queue = models.CharField(max_length=50, default='default', verbose_name='Очередь')
+    # JSON: {"args": [...], "kwargs": {...}}.
+    payload = models.TextField(default='{}', verbose_name='Аргументы')
+    status = models.CharField(max_length=10, choices=STATUSES, default=QUEUED, verbose_name='Состояние')
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name='Попыток')
+    max_attempts = models.PositiveSmallIntegerField(default=3, verbose_name='Максимум попыток')
+    run_at = models.DateTimeField(default=timezone.now, verbose_name='Запустить после')
+    worker = models.CharField(max_length=100, default='', blank=True, verbose_name='Обработчик')
+    started_at = models.DateTimeField(null=True, blank=True, verbose_name='Начата')
+    # Refreshed by the worker while the task runs (task_queue.requeue_stale).
+    heartbeat_at = models.DateTimeField(null=True, blank=True, verbose_name='Последний сигнал')
+    finished_at = models.DateTimeField(null=True, blank=True, verbose_name='Завершена')
+    duration = models.FloatField(null=True, blank=True, verbose_name='Время, с')
+    error = models.TextField(default='', blank=True, verbose_name='Ошибка')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Создана')
+
+    def __str__(self):
+        return f'{self.name} #{self.pk}'
+
+    class Meta:
+        verbose_name = 'Фоновая задача'
+        verbose_name_plural = 'Фоновые задачи'
+        ordering = ('-pk',)
+        indexes = [models.Index(fields=['status', 'queue', 'run_at'], name='articles_task_pending_idx')]
+
+
+# Row of a task queue, locked while a worker claims its tasks, so the TASK_QUEUES
+# limit holds over all workers (task_queue.claim).
+class TaskQueueLock(models.Model):
+    name = models.CharField(max_length=50, primary_key=True, verbose_name='Очередь')
+
+    class Meta:
+        verbose_name = 'Очередь задач'
+        verbose_name_plural = 'Очереди задач'
+
+
+# Article whose facets changed (articles/facets.py). Every process replays recent
+# changes into its in-memory facet index; rows older than FACET_CHANGE_KEEP are deleted.
+class FacetChange(models.Model):
+    article_id = models.IntegerField(verbose_name='Статья')
+    created_at = models.DateTimeField(default=timezone.now, db_index=True, verbose_name='Время')
+
+    class Meta:
+        verbose_name = 'Изменение фасетов'
+        verbose_name_plural = 'Изменения фасетов'
+
+
+# Published articles of a category (articles/counters.py), kept up to date on every change.
+# rebuild_counters command repairs the drift.
+class CategoryCount(models.Model):
+    category = models.OneToOneField(Category, primary_key=True, on_delete=models.CASCADE, related_name='article_count', verbose_name='Категория')
+    articles = models.IntegerField(default=0, verbose_name='Статей')
+
+    class Meta:
+        verbose_name = 'Счетчик категории'
+        verbose_name_plural = 'Счетчики категорий'
+
+
+# Published articles with a tag (articles/counters.py). Keyed by name as written in
+# Article.tags, so it doesn't wait for tagging to create the Tag.
+class TagCount(models.Model):
+    name = models.CharField(max_length=50, unique=True, verbose_name='Тег')
+    articles = models.IntegerField(default=0, db_index=True, verbose_name='Статей')
+
+    class Meta:
+        verbose_name = 'Счетчик тега'
+        verbose_name_plural = 'Счетчики тегов'
+
+
+# Query slower than SLOW_QUERY_THRESHOLD with its plan (articles/slow_queries.py).
+# Only the last SLOW_QUERY_LOG_SIZE records are kept.
+class SlowQuery(models.Model):
+    sql = models.TextField(verbose_name='Запрос')
+    params = models.TextField(default='', blank=True, verbose_name='Параметры')
+    duration = models.FloatField(verbose_name='Время, с')
+    database = models.CharField(max_length=50, default='default', verbose_name='База данных')
+    view = models.CharField(max_length=200, default='', blank=True, db_index=True, verbose_name='Представление')
+    path = models.TextField(default='', blank=True, verbose_name='Адрес')
+    plan = models.TextField(default='', blank=True, verbose_name='План запроса')
+    analyzed = models.BooleanField(default=False, verbose_name='EXPLAIN ANALYZE')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Время')
+
+    def __str__(self):
+        return self.sql[:100]
+
+    class Meta:
+        verbose_name = 'Медленный запрос'
+        verbose_name_plural = 'Медленные запросы'
+        ordering = ('-pk',)
+
+
 # Article model.
 class Article (models.Model):
     category = models.ForeignKey(Category, default=None, on_delete=models.PROTECT, verbose_name='Категория')
@@ -180,12 +364,18 @@ class Article (models.Model):
     # System.
     is_active = models.BooleanField(default=False, verbose_name='Прошла ли модерацию?')
     created_at = models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='Опубликовано')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Изменена')
     
     def __str__(self):
         return self.title
     
     def delete(self, *args, **kwargs):
         super().delete(*args, **kwargs)
+
+    # Receivers of post_save compared the loaded field values (articles/snapshots.py) with the saved ones.
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        refresh_fields(self, kwargs.get('update_fields'))
     
     # When user press rating button.
     def change_rating(self, rating, user):
@@ -201,3 +391,66 @@ class Article (models.Model):
     class Meta:
         verbose_name = 'Статья'
         verbose_name_plural = 'Статьи'
+        # Admin changelist: moderation filter with date drilldown.
+        indexes = [models.Index(fields=['is_active', 'created_at'], name='articles_active_created_idx')]
+
+
+# Article revision (articles/revisions.py). Every ARTICLE_REVISION_SNAPSHOT_EVERY-th revision
+# keeps the full text, others keep a line delta against the previous revision, zlib compressed.
+class ArticleRevision(models.Model):
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='revisions', verbose_name='Статья')
+    number = models.PositiveIntegerField(verbose_name='Номер')
+    editor = models.ForeignKey(AdvUser, null=True, blank=True, on_delete=models.SET_NULL, verbose_name='Автор правки')
+    is_snapshot = models.BooleanField(default=False, verbose_name='Полная копия')
+    data = models.BinaryField(verbose_name='Данные')
+    # Length of the uncompressed text of the revision, for storage statistics.
+    size = models.PositiveIntegerField(default=0, verbose_name='Размер, байт')
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name='Сохранена')
+
+    def __str__(self):
+        return f'{self.article_id} #{self.number}'
+
+    class Meta:
+        verbose_name = 'Версия статьи'
+        verbose_name_plural = 'Версии статей'
+        ordering = ('article', 'number')
+        unique_together = (('article', 'number'), )
+
+
+# Row of the sparse TF-IDF matrix of published articles (articles/related.py): the
+# RELATED_TERMS_PER_ARTICLE heaviest terms of an article, L2 normalized. Indexed by term,
+# so articles sharing terms with a new one are found without rebuilding the matrix.
+class ArticleTerm(models.Model):
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='terms', verbose_name='Статья')
+    term = models.CharField(max_length=60, db_index=True, verbose_name='Термин')
+    weight = models.FloatField(verbose_name='Вес')
+
+    class Meta:
+        verbose_name = 'Термин статьи'
+        verbose_name_plural = 'Термины статей'
+        unique_together = (('article', 'term'), )
+
+
+# Number of published articles with a term as of the last rebuild_related (IDF of new articles).
+class RelatedTerm(models.Model):
+    term = models.CharField(max_length=60, unique=True, verbose_name='Термин')
+    documents = models.IntegerField(default=0, verbose_name='Статей')
+
+    class Meta:
+        verbose_name = 'Частота термина'
+        verbose_name_plural = 'Частоты терминов'
+
+
+# Precomputed neighbours of an article by cosine similarity, rank 0 is the closest.
+class RelatedArticle(models.Model):
+    article = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='related_links', verbose_name='Статья')
+    related = models.ForeignKey(Article, on_delete=models.CASCADE, related_name='+', verbose_name='Похожая статья')
+    score = models.FloatField(verbose_name='Сходство')
+    rank = models.SmallIntegerField(verbose_name='Место')
+
+    class Meta:
+        verbose_name = 'Похожая статья'
+        verbose_name_plural = 'Похожие статьи'
+        ordering = ('article', 'rank')
+        # Detail page reads the neighbours of one article in rank order.
+        indexes = [models.Index(fields=['article', 'rank'], name='articles_related_rank_idx')]
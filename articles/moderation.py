@@ -0,0 +1,115 @@
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+
+from companies.stats import apply_deltas, article_counters
+
+from .conditional import bump_listing_versions
+from .counters import apply_counts, article_counts, tag_names
+from .facets import record_changes
+from .models import AdvUser, Article, Notifications
+from .profiles import invalidate_profiles_by_id
+from .related import refresh_related
+
+
+def _progress_key(job):
+    return 'moderation-progress:%s' % job
+
+
+def get_progress(job):
+    return cache.get(_progress_key(job))
+
+
+def set_progress(job, done, total, finished=False):
+    if job:
+        cache.set(_progress_key(job), {'done': done, 'total': total, 'finished': finished}, 60 * 60)
+
+
+# Pending articles in queue order, one keyset page: pk > after.
+def pending_page(after=0, limit=None):
+    limit = limit or settings.MODERATION_PAGE_SIZE
+    queryset = Article.objects.filter(is_active=False, pk__gt=after).select_related('author', 'category').order_by('pk')
+    return list(queryset.only('pk', 'title', 'created_at', 'author', 'author__username', 'category', 'category__name')[:limit])
+
+
+# Ids of all pending articles, read in keyset batches (no OFFSET, no huge IN list).
+def iter_pending_ids(batch_size):
+    after = 0
+    while True:
+        ids = list(Article.objects.filter(is_active=False, pk__gt=after).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return
+        yield ids
+        after = ids[-1]
+
+
+def _batches(ids, batch_size):
+    ids = list(ids)
+    for i in range(0, len(ids), batch_size):
+        yield ids[i:i + batch_size]
+
+
+# Bookkeeping of articles published by bulk queries, which send no signals: company stats,
+# facets, category and tag counters, related articles. Runs in the transaction of the change. rows: (pk, author_id, category_id, tags, views, rating).
+def count_published(rows):
+    companies = dict(AdvUser.objects.filter(pk__in={row[1] for row in rows}).values_list('pk', 'company_id'))
+    deltas = defaultdict(Counter)
+    for pk, author, category, tags, views, rating in rows:
+        deltas[companies[author]].update(article_counters(True, views, rating))
+    apply_deltas(deltas)
+    record_changes(row[0] for row in rows)
+    apply_counts(*article_counts((row[2], row[3]) for row in rows))
+    refresh_related.delay([row[0] for row in rows])
+
+
+# Cached listings and profiles of articles changed by bulk queries. Runs after the commit,
+# so a concurrent request can't cache the old state again.
+def invalidate_listings(rows):
+    bump_listing_versions('category', {row[2] for row in rows})
+    bump_listing_versions('author', {row[1] for row in rows})
+    bump_listing_versions('tag', {tag for row in rows for tag in tag_names(row[3])})
+    invalidate_profiles_by_id({row[1] for row in rows})
+
+
+# Publishes one batch: one UPDATE ... WHERE id IN (...) and one bulk insert of notifications.
+# Returns number of published articles.
+def approve_batch(ids):
+    with transaction.atomic():
+        rows = list(Article.objects.select_for_update().filter(pk__in=ids, is_active=False)
+                    .values_list('pk', 'author_id', 'category_id', 'tags', 'views', 'rating'))
+        if not rows:
+            return 0
+        Article.objects.filter(pk__in=[row[0] for row in rows]).update(is_active=True, updated_at=timezone.now())
+        count_published(rows)
+        created_at = datetime.now().strftime('%H:%M:%S %m/%d/%Y')
+        Notifications.objects.bulk_create([
+            Notifications(user_id=row[1], sender=f'articles/{row[0]}/', n_type='Статья опубликована',
+                          content='Ваша статья была опубликована', created_at=created_at)
+            for row in rows
+        ])
+    invalidate_listings(rows)
+    return len(rows)
+
+
+# Publishes articles by ids, or the whole queue when ids is None.
+# Progress of a job is kept in the cache, so the queue page can poll it.
+def approve_articles(ids=None, job=None, batch_size=None):
+    batch_size = batch_size or settings.MODERATION_BATCH_SIZE
+    if ids is None:
+        total = Article.objects.filter(is_active=False).count()
+        batches = iter_pending_ids(batch_size)
+    else:
+        total = len(ids)
+        batches = _batches(ids, batch_size)
+    done = approved = 0
+    set_progress(job, done, total)
+    for batch in batches:
+        approved += approve_batch(batch)
+        done += len(batch)
+        set_progress(job, done, total)
+    set_progress(job, done, total, finished=True)
+    return approved
@@ -0,0 +1,40 @@
+import json
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+
+# Planner's row estimate of the whole table, None when the table was never analyzed.
+def table_estimate(connection, table):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+        row = cursor.fetchone()
+    return int(row[0]) if row and row[0] > 0 else None
+
+
+# Planner's row estimate of a filtered queryset, from EXPLAIN without running it.
+def query_estimate(connection, queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+# Paginator for admin changelists of big tables. On PostgreSQL, when the table has more
+# than ADMIN_ESTIMATED_COUNT_THRESHOLD rows, the count is the planner's estimate instead
+# of COUNT(*), which scans the whole table. Small tables and other databases get exact counts.
+class EstimatedCountPaginator(Paginator):
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql':
+            estimate = table_estimate(connection, queryset.model._meta.db_table)
+            if estimate is not None and estimate >= settings.ADMIN_ESTIMATED_COUNT_THRESHOLD:
+                return estimate if not queryset.query.where else query_estimate(connection, queryset)
+        return super().count
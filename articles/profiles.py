@@ -0,0 +1,112 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Sum
+from django.utils import timezone
+
+from .metrics import record_cache
+from .snapshots import DEFERRED, current, loaded
+
+
+def _profile_key(username):
+    return 'profile:' + hashlib.md5(username.encode('utf-8')).hexdigest()
+
+
+# Parts of the profile projection; they don't depend on each other,
+# so the async profile (articles/async_views.py) reads them concurrently.
+def profile_user(username):
+    from .models import AdvUser
+    return (AdvUser.objects.select_related('company')
+            .annotate(tag_subscriptions=Count('tags_subscriptions', distinct=True),
+                      category_subscriptions=Count('cat_subscriptions', distinct=True))
+            .filter(username=username).first())
+
+
+def profile_stats(username):
+    from .models import Article
+    return Article.objects.filter(author__username=username, is_active=True).aggregate(count=Count('pk'), views=Sum('views'))
+
+
+# Subscriptions are symmetrical, so `subscribers` also tells whether a viewer is subscribed.
+def profile_subscribers(username):
+    from .models import AdvUser
+    return list(AdvUser.objects.filter(user_subscriptions__username=username).order_by('username')
+                .values_list('username', flat=True))
+
+
+PROFILE_PARTS = (profile_user, profile_stats, profile_subscribers)
+
+
+# Everything the profile page shows about a user, from the results of PROFILE_PARTS.
+def make_profile(user, stats, subscribers):
+    if user is None:
+        return None
+    return {
+        'user': user,
+        'subscribers': subscribers,
+        'article_count': stats['count'],
+        'total_views': stats['views'] or 0,
+        'built_at': timezone.now(),
+    }
+
+
+def build_profile(username):
+    return make_profile(*(read(username) for read in PROFILE_PARTS))
+
+
+def cached_profile(username):
+    data = cache.get(_profile_key(username))
+    record_cache('profile', data is not None)
+    return data
+
+
+def cache_profile(username, data):
+    if data is not None:
+        cache.set(_profile_key(username), data, settings.PROFILE_CACHE_TIMEOUT)
+
+
+# Cached profile projection. Invalidated by the receivers below; view counters
+# are updated in place, so total views may be PROFILE_CACHE_TIMEOUT old.
+def get_profile(username):
+    data = cached_profile(username)
+    if data is None:
+        data = build_profile(username)
+        cache_profile(username, data)
+    return data
+
+
+def invalidate_profiles(usernames):
+    cache.delete_many([_profile_key(username) for username in usernames if username])
+
+
+def invalidate_profiles_by_id(pks):
+    from .models import AdvUser
+    pks = {pk for pk in pks if pk is not None}
+    if pks:
+        invalidate_profiles(AdvUser.objects.filter(pk__in=pks).values_list('username', flat=True))
+
+
+# post_save and post_delete receiver for AdvUser: renamed user's old profile must be dropped too.
+def user_changed(sender, instance, **kwargs):
+    invalidate_profiles({name for name in loaded(instance, 'username') + (instance.username, ) if name is not DEFERRED})
+
+
+# post_save and post_delete receiver for Article: article count and views of the author.
+def article_changed(sender, instance, **kwargs):
+    authors = loaded(instance, 'author_id') + current(instance, 'author_id')
+    invalidate_profiles_by_id({author for author in authors if author is not DEFERRED})
+
+
+# m2m_changed receiver for subscriptions.
+def subscriptions_changed(sender, instance, action, model, pk_set, **kwargs):
+    from .models import AdvUser
+    if not action.startswith('post_'):
+        return
+    if isinstance(instance, AdvUser):
+        invalidate_profiles([instance.username])
+        pks = set(pk_set or ()) if model is AdvUser else set()
+    else:
+        # Reverse side (tag.tags_subscriptions.add(user)): pk_set are users.
+        pks = set(pk_set or ())
+    invalidate_profiles_by_id(pks)
@@ -0,0 +1,122 @@
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+import logging
+import re
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from . import slow_queries
+
+logger = logging.getLogger('articles.sql')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+_SPACES = re.compile(r'\s+')
+
+
+# Shape of query: the same statement with other parameters has the same shape.
+# Repeated shapes within one request are what N+1 patterns look like.
+def query_shape(sql):
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _IN_LIST.sub('(...)', sql)
+    return _SPACES.sub(' ', sql).strip()
+
+
+# Queries executed while profiling: list of (alias, sql, duration in seconds).
+class QueryProfile:
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append((context['connection'].alias, sql, time.perf_counter() - start))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duration(self):
+        return sum(duration for alias, sql, duration in self.queries)
+
+    # Shapes executed at least `threshold` times: [(shape, times)], most frequent first.
+    def repeated(self, threshold):
+        shapes = Counter(query_shape(sql) for alias, sql, duration in self.queries)
+        return [(shape, times) for shape, times in shapes.most_common() if times >= threshold]
+
+    def report(self):
+        lines = ['%.1fms %s: %s' % (duration * 1000, alias, sql) for alias, sql, duration in self.queries]
+        return '\n'.join(lines)
+
+
+# Records every query of all database connections inside the block.
+@contextmanager
+def profile_queries():
+    profile = QueryProfile()
+    with ExitStack() as stack:
+        for alias in connections:
+            stack.enter_context(connections[alias].execute_wrapper(profile))
+        yield profile
+
+
+# Records query count, DB time and repeated query shapes of every request
+# and logs requests over SQL_QUERY_BUDGET, SQL_TIME_BUDGET or SQL_REPEATED_QUERY_LIMIT.
+# With SQL_PROFILER_HEADER the numbers are also sent in Server-Timing header (browser devtools).
+class SQLProfilerMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        slow_queries.current.path = request.get_full_path()
+        try:
+            return self.profile(request)
+        finally:
+            slow_queries.current.view = slow_queries.current.path = ''
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Slow query log tells which view issued the query.
+        slow_queries.current.view = request.resolver_match.view_name
+
+    def profile(self, request):
+        if not settings.SQL_PROFILER:
+            return self.get_response(request)
+        with profile_queries() as profile:
+            request.query_profile = profile
+            response = self.get_response(request)
+        problems = []
+        if profile.count > settings.SQL_QUERY_BUDGET:
+            problems.append('%d queries (budget %d)' % (profile.count, settings.SQL_QUERY_BUDGET))
+        if profile.duration > settings.SQL_TIME_BUDGET:
+            problems.append('%.1fms in DB (budget %.1fms)' % (profile.duration * 1000, settings.SQL_TIME_BUDGET * 1000))
+        for shape, times in profile.repeated(settings.SQL_REPEATED_QUERY_LIMIT + 1):
+            problems.append('%d x %s' % (times, shape))
+        if problems:
+            logger.warning('%s %s: %s', request.method, request.path, '; '.join(problems),
+                           extra={'queries': profile.count, 'db_time': profile.duration})
+        if settings.SQL_PROFILER_HEADER:
+            response['Server-Timing'] = 'db;dur=%.1f;desc="%d queries"' % (profile.duration * 1000, profile.count)
+        return response
+
+
+# Test case mixin: asserts that a block stays within a query budget and
+# doesn't repeat any query shape (N+1).
+# Usage: with self.assertQueryBudget(5): self.client.get(url)
+class QueryBudgetMixin:
+    @contextmanager
+    def assertQueryBudget(self, max_queries, max_repeats=None):
+        if max_repeats is None:
+            max_repeats = settings.SQL_REPEATED_QUERY_LIMIT
+        with profile_queries() as profile:
+            yield profile
+        if profile.count > max_queries:
+            self.fail('%d queries executed, budget is %d:\n%s' % (profile.count, max_queries, profile.report()))
+        repeated = profile.repeated(max_repeats + 1)
+        if repeated:
+            self.fail('Repeated queries (N+1?):\n%s' % '\n'.join('%d x %s' % (times, shape) for shape, times in repeated))
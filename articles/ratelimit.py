@@ -0,0 +1,106 @@
+import hashlib
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse, JsonResponse
+from django.urls import Resolver404, resolve
+
+
+# Client of a request for a bucket kind. 'ip' is the client address. 'user' is the session
+# cookie, known before the session and the user are loaded. A client sending random cookies
+# gets a new session bucket every time; the address bucket bounds it. Requests without a
+# session have only the address bucket.
+def _client(request, kind):
+    if kind == 'ip':
+        return request.META.get(settings.RATE_LIMIT_IP_HEADER or 'REMOTE_ADDR', '').split(',')[0].strip()
+    return request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+
+
+# Buckets of a request under limit `name`: {kind: cache key}.
+def _bucket_keys(request, name, kinds=('user', 'ip')):
+    limits = settings.RATE_LIMITS[name]
+    clients = {kind: _client(request, kind) for kind in kinds if kind in limits}
+    return {
+        kind: 'ratelimit:%s:%s:%s' % (name, kind, hashlib.sha1(client.encode()).hexdigest())
+        for kind, client in clients.items() if client
+    }
+
+
+# Takes a token from every bucket of the request. A bucket holds up to `requests` tokens
+# and refills at requests / seconds per second, so short bursts pass while the sustained rate
+# stays within the limit. Buckets live in RATE_LIMIT_CACHE, shared by all worker processes;
+# reading and writing them isn't atomic, so concurrent requests of one client may get a few
+# extra tokens. Returns seconds to wait when a bucket is empty (nothing is taken then), else 0.
+def take(request, name, now=None, kinds=('user', 'ip')):
+    limits = settings.RATE_LIMITS[name]
+    keys = _bucket_keys(request, name, kinds)
+    if not keys:
+        return 0
+    cache = caches[settings.RATE_LIMIT_CACHE]
+    now = time.time() if now is None else now
+    buckets = cache.get_many(list(keys.values()))
+    wait, updated = 0, {}
+    for kind, key in keys.items():
+        capacity, period = limits[kind]
+        tokens, last = buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - last) * capacity / period)
+        if tokens < 1:
+            wait = max(wait, (1 - tokens) * period / capacity)
+        else:
+            updated[key] = (tokens - 1, now)
+    if wait:
+        return wait
+    # An untouched bucket is full again after its period.
+    cache.set_many(updated, max(limits[kind][1] for kind in keys))
+    return 0
+
+
+def too_many_requests(request, wait):
+    message = 'Слишком много запросов. Попробуйте позже.'
+    if request.is_ajax():
+        response = JsonResponse({'error': message}, status=429)
+    else:
+        response = HttpResponse(message, status=429, content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(math.ceil(wait))
+    return response
+
+
+# 429 response when the request is over limit `name`, None otherwise.
+# A request is counted once per bucket kind, by the middleware or by the decorator.
+def check(request, name, kinds=('user', 'ip')):
+    if name not in settings.RATE_LIMITS:
+        return None
+    checked = request.__dict__.setdefault('_rate_limits', set())
+    kinds = [kind for kind in kinds if (name, kind) not in checked]
+    checked.update((name, kind) for kind in kinds)
+    wait = take(request, name, kinds=kinds) if kinds else 0
+    return too_many_requests(request, wait) if wait else None
+
+
+# Limits a view by RATE_LIMITS[name]. Checked by RateLimitMiddleware before the database
+# is touched; here only when the view runs without it.
+def rate_limit(name):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return check(request, name) or view(request, *args, **kwargs)
+        wrapper.rate_limit = name
+        return wrapper
+    return decorator
+
+
+# Checks limits of rate_limit views before the session, auth and site middleware run,
+# so requests rejected by them never touch the database.
+class RateLimitMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            name = getattr(resolve(request.path_info).func, 'rate_limit', None)
+        except Resolver404:
+            name = None
+        return (name and check(request, name)) or self.get_response(request)
@@ -0,0 +1,244 @@
+from array import array
+from collections import Counter, defaultdict
+import heapq
+import math
+import re
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.html import strip_tags
+from tagging.utils import parse_tag_input
+
+from .conditional import bump_listing_versions
+from .models import Article, ArticleTerm, RelatedArticle, RelatedTerm
+from .snapshots import current, loaded
+from .task_queue import task
+
+WORD = re.compile(r'\w+')
+
+# Words too common to tell articles apart.
+STOP_WORDS = frozenset('''
+    and are but can for from has have how its not one that the their there this was what when which who will
+    with you your also into more than then them they were been about would could should only just all any
+    без был была были было быть вам вас вот все всё всех для его если есть еще ещё жизни или как когда кто
+    ли меня мне может мы над нас нет них оно она они при про себя так там тебя тем теперь то того тоже только
+    том тут уже хотя чем через что чтобы эта эти это этого этой этом этот
+'''.split())
+
+# How many times a word of a field counts. Tags are terms of their own, '#name'.
+FIELD_WEIGHTS = (3, 2, 1)
+TAG_WEIGHT = 3
+
+# Columns of an article its terms are computed from.
+COLUMNS = ('pk', 'title', 'card_text', 'content', 'tags')
+
+# Terms of fewer articles are never dropped as too common, so small sites keep their vocabulary.
+MIN_PRUNED_DF = 50
+
+# Longest term kept (ArticleTerm.term).
+MAX_TERM_LENGTH = 60
+
+
+def _words(text):
+    for word in WORD.findall(strip_tags(text or '').lower()):
+        if 2 < len(word) <= MAX_TERM_LENGTH and not word.isdigit() and word not in STOP_WORDS:
+            yield word
+
+
+# Term counts of an article: words of title, card text and content, weighted by field, and tags.
+def article_terms(title, card_text, content, tags):
+    counts = Counter()
+    for text, weight in zip((title, card_text, content), FIELD_WEIGHTS):
+        for word in _words(text):
+            counts[word] += weight
+    for name in parse_tag_input(tags or ''):
+        term = '#' + name.lower()
+        if len(term) <= MAX_TERM_LENGTH:
+            counts[term] += TAG_WEIGHT
+    return counts
+
+
+# TF-IDF vector of an article, {term: weight}: sublinear tf, smoothed idf, the
+# RELATED_TERMS_PER_ARTICLE heaviest terms, L2 normalized. Terms of more than
+# RELATED_MAX_DF of `documents` articles are dropped.
+def term_vector(counts, df, documents):
+    limit = max(settings.RELATED_MAX_DF * documents, MIN_PRUNED_DF)
+    weights = {}
+    for term, count in counts.items():
+        frequency = df.get(term, 0)
+        if frequency <= limit:
+            weights[term] = (1 + math.log(count)) * (math.log((1 + documents) / (1 + frequency)) + 1)
+    top = heapq.nlargest(settings.RELATED_TERMS_PER_ARTICLE, weights.items(), key=lambda item: (item[1], item[0]))
+    norm = math.sqrt(sum(weight * weight for term, weight in top)) or 1
+    return {term: weight / norm for term, weight in top}
+
+
+# The RELATED_QUERY_TERMS heaviest (term, weight) of a vector.
+def query_terms(vector):
+    return heapq.nlargest(settings.RELATED_QUERY_TERMS, vector.items(), key=lambda item: (item[1], item[0]))
+
+
+# Top-k articles by cosine similarity: dot products of the vector with the matrix
+# columns of its terms. columns: {term: (article ids, weights)}. Only the RELATED_QUERY_TERMS
+# heaviest terms of the vector are multiplied: they carry most of the similarity, and the
+# cost grows with every column read.
+def neighbours(pk, vector, columns, k=None):
+    scores = defaultdict(float)
+    for term, weight in query_terms(vector):
+        ids, weights = columns.get(term, ((), ()))
+        for other, other_weight in zip(ids, weights):
+            scores[other] += weight * other_weight
+    scores.pop(pk, None)
+    best = heapq.nlargest(k or settings.RELATED_ARTICLES, scores, key=scores.__getitem__)
+    return [(other, scores[other]) for other in best]
+
+
+def _links(lists):
+    return [RelatedArticle(article_id=pk, related_id=related, score=score, rank=rank)
+            for pk, items in lists.items() for rank, (related, score) in enumerate(items)]
+
+
+# Published articles in keyset batches, as COLUMNS rows.
+def _published(batch_size):
+    queryset = Article.objects.filter(is_active=True).order_by('pk').values_list(*COLUMNS)
+    last = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last)[:batch_size])
+        if not batch:
+            return
+        yield from batch
+        last = batch[-1][0]
+
+
+# Recomputes the matrix and the neighbours of every published article. Two passes over
+# the articles: document frequencies, then the vectors. Rows and columns of the sparse
+# matrix are kept in typed arrays, so memory is about 24 bytes per stored term; neighbours
+# are computed and written RELATED_CHUNK_SIZE articles at a time. Returns number of articles.
+def rebuild_related(chunk_size=None):
+    chunk_size = chunk_size or settings.RELATED_CHUNK_SIZE
+    df = Counter()
+    for pk, *fields in _published(chunk_size):
+        df.update(article_terms(*fields).keys())
+    documents = Article.objects.filter(is_active=True).count()
+
+    vocabulary = {}
+    pks, rows = array('l'), []
+    columns = defaultdict(lambda: (array('l'), array('f')))
+    for pk, *fields in _published(chunk_size):
+        vector = term_vector(article_terms(*fields), df, documents)
+        ids = array('l', (vocabulary.setdefault(term, len(vocabulary)) for term in vector))
+        weights = array('f', vector.values())
+        pks.append(pk)
+        rows.append((ids, weights))
+        for term, weight in zip(ids, weights):
+            column = columns[term]
+            column[0].append(pk)
+            column[1].append(weight)
+    terms = sorted(vocabulary, key=vocabulary.get)
+
+    for start in range(0, len(pks), chunk_size):
+        chunk = pks[start:start + chunk_size]
+        lists, postings = {}, []
+        for pk, (ids, weights) in zip(chunk, rows[start:start + chunk_size]):
+            lists[pk] = neighbours(pk, dict(zip(ids, weights)), columns)
+            postings += [ArticleTerm(article_id=pk, term=terms[term], weight=weight) for term, weight in zip(ids, weights)]
+        with transaction.atomic():
+            RelatedArticle.objects.filter(article_id__in=chunk).delete()
+            RelatedArticle.objects.bulk_create(_links(lists))
+            ArticleTerm.objects.filter(article_id__in=chunk).delete()
+            ArticleTerm.objects.bulk_create(postings, batch_size=1000)
+        bump_listing_versions('related', chunk)
+    with transaction.atomic():
+        RelatedTerm.objects.all().delete()
+        RelatedTerm.objects.bulk_create([RelatedTerm(term=term, documents=n) for term, n in df.items()], batch_size=1000)
+    # Articles unpublished since the last run.
+    RelatedArticle.objects.exclude(article__is_active=True).delete()
+    ArticleTerm.objects.exclude(article__is_active=True).delete()
+    return len(pks)
+
+
+# Adds an article to the neighbour lists it now belongs to: of the articles it found,
+# those with fewer than RELATED_ARTICLES neighbours or a less similar one.
+def _offer(pk, found):
+    k = settings.RELATED_ARTICLES
+    current = defaultdict(list)
+    rows = RelatedArticle.objects.filter(article_id__in=[other for other, score in found]).values_list('article_id', 'related_id', 'score')
+    for other, related, score in rows:
+        if related != pk:
+            current[other].append((related, score))
+    lists = {}
+    for other, score in found:
+        items = current[other]
+        if len(items) < k or score > min(item[1] for item in items):
+            lists[other] = heapq.nlargest(k, items + [(pk, score)], key=lambda item: (item[1], -item[0]))
+    RelatedArticle.objects.filter(article_id__in=lists).delete()
+    RelatedArticle.objects.bulk_create(_links(lists))
+    bump_listing_versions('related', lists)
+
+
+# Query terms of a refresh: the heaviest ones whose postings (document frequencies of the last
+# rebuild) add up to at most RELATED_MAX_POSTINGS rows; terms that would exceed it are skipped.
+def _refresh_terms(vector, df):
+    terms, postings = [], 0
+    for term, weight in query_terms(vector):
+        if postings + df.get(term, 0) <= settings.RELATED_MAX_POSTINGS:
+            terms.append(term)
+            postings += df.get(term, 0)
+    return terms
+
+
+# Neighbours of new or changed articles without rebuilding the matrix: the article's vector
+# (document frequencies of the last rebuild) is multiplied with the stored rows of its terms,
+# as many as _refresh_terms allows.
+# Other articles keep their vectors until the next rebuild_related; unpublished articles
+# lose their neighbours.
+@task()
+def refresh_related(article_ids):
+    rows = list(Article.objects.filter(pk__in=article_ids, is_active=True).values_list(*COLUMNS))
+    gone = set(article_ids) - {row[0] for row in rows}
+    if gone:
+        RelatedArticle.objects.filter(article_id__in=gone).delete()
+        ArticleTerm.objects.filter(article_id__in=gone).delete()
+        bump_listing_versions('related', gone)
+    if not rows:
+        return
+    documents = Article.objects.filter(is_active=True).count()
+    for pk, *fields in rows:
+        counts = article_terms(*fields)
+        df = dict(RelatedTerm.objects.filter(term__in=list(counts)).values_list('term', 'documents'))
+        vector = term_vector(counts, df, documents)
+        columns = defaultdict(lambda: ([], []))
+        postings = (ArticleTerm.objects.filter(term__in=_refresh_terms(vector, df))
+                    .exclude(article_id=pk).values_list('term', 'article_id', 'weight'))
+        for term, other, weight in postings:
+            columns[term][0].append(other)
+            columns[term][1].append(weight)
+        found = neighbours(pk, vector, columns)
+        with transaction.atomic():
+            ArticleTerm.objects.filter(article_id=pk).delete()
+            ArticleTerm.objects.bulk_create([ArticleTerm(article_id=pk, term=term, weight=weight) for term, weight in vector.items()])
+            RelatedArticle.objects.filter(article_id=pk).delete()
+            RelatedArticle.objects.bulk_create(_links({pk: found}))
+            _offer(pk, found)
+        bump_listing_versions('related', [pk])
+
+
+# Neighbours for the detail page, one query by (article, rank). Changes of the list bump
+# the 'related' listing version of the article, part of the page validators.
+def related_articles(article):
+    links = (RelatedArticle.objects.filter(article=article, related__is_active=True)
+             .select_related('related__category').order_by('rank')[:settings.RELATED_ARTICLES])
+    return [link.related for link in links]
+
+
+# Article fields its neighbours depend on.
+TEXT_FIELDS = ('is_active', 'title', 'card_text', 'content', 'tags')
+
+
+# post_save receiver for Article: published articles whose text changed get neighbours
+# in the background, unpublished ones lose them.
+def article_text_changed(sender, instance, created, **kwargs):
+    old = None if created else loaded(instance, *TEXT_FIELDS)
+    new = current(instance, *TEXT_FIELDS)
+    if old != new and (new[0] or (old and old[0])):
+        refresh_related.delay([instance.pk])
@@ -0,0 +1,163 @@
+import difflib
+import json
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Subquery
+
+from .models import AdvUser, Article, ArticleRevision
+
+# Fields of an article kept in its history.
+FIELDS = ('title', 'category_id', 'tags', 'card_text', 'image', 'image_url', 'content')
+
+
+def _pack(value):
+    return zlib.compress(json.dumps(value, ensure_ascii=False).encode('utf-8'), 9)
+
+
+def _unpack(data):
+    # PostgreSQL returns memoryview for bytea.
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
+
+
+def _size(data):
+    return len(json.dumps(data, ensure_ascii=False).encode('utf-8'))
+
+
+def current_data(article):
+    data = {field: getattr(article, field) for field in FIELDS}
+    data['image'] = article.image.name or None
+    return data
+
+
+# Line delta of a text: [i, j] copies lines i:j of the old text, a string is inserted as is.
+def text_delta(old, new):
+    old_lines, new_lines = old.splitlines(True), new.splitlines(True)
+    ops = []
+    for tag, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(new_lines[j1:j2]))
+    return ops
+
+
+def apply_text_delta(old, ops):
+    old_lines = old.splitlines(True)
+    return ''.join(''.join(old_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+# Delta between two revisions: changed texts are patched, other changed fields are replaced.
+def make_delta(old, new):
+    delta = {'set': {}, 'patch': {}}
+    for field in FIELDS:
+        if old.get(field) == new.get(field):
+            continue
+        if isinstance(old.get(field), str) and isinstance(new.get(field), str):
+            delta['patch'][field] = text_delta(old[field], new[field])
+        else:
+            delta['set'][field] = new.get(field)
+    return delta
+
+
+def apply_delta(data, delta):
+    result = dict(data, **delta['set'])
+    for field, ops in delta['patch'].items():
+        result[field] = apply_text_delta(data[field], ops)
+    return result
+
+
+# Revisions needed to rebuild revision `number` (the latest when None):
+# the closest snapshot and the deltas after it, with one query.
+def _chain(article_id, number=None):
+    revisions = ArticleRevision.objects.filter(article_id=article_id)
+    if number is not None:
+        revisions = revisions.filter(number__lte=number)
+    snapshot = revisions.filter(is_snapshot=True).order_by('-number').values('number')[:1]
+    return list(revisions.filter(number__gte=Subquery(snapshot)).order_by('number').only('number', 'is_snapshot', 'data'))
+
+
+def _replay(chain):
+    data = None
+    for revision in chain:
+        payload = _unpack(revision.data)
+        data = payload if revision.is_snapshot else apply_delta(data, payload)
+    return data
+
+
+# Content of a revision as {field: value}, None when there is no such revision.
+def get_revision(article_id, number):
+    chain = _chain(article_id, number)
+    if not chain or chain[-1].number != number:
+        return None
+    return _replay(chain)
+
+
+# Saves the article's current content as its next revision. Nothing is saved when
+# the content didn't change. Returns the new revision or None.
+def record_revision(article, editor=None, data=None):
+    data = current_data(article) if data is None else data
+    data['image'] = data.get('image') or None
+    with transaction.atomic():
+        # Serializes edits of one article, so revision numbers stay consecutive.
+        list(Article.objects.select_for_update().filter(pk=article.pk).values_list('pk'))
+        chain = _chain(article.pk)
+        previous = _replay(chain)
+        if previous == data:
+            return None
+        number = chain[-1].number + 1 if chain else 1
+        snapshot = not chain or number - chain[0].number >= settings.ARTICLE_REVISION_SNAPSHOT_EVERY
+        return ArticleRevision.objects.create(
+            article=article, number=number, editor=editor, is_snapshot=snapshot,
+            data=_pack(data if snapshot else make_delta(previous, data)), size=_size(data),
+        )
+
+
+# Articles created before revisions existed get their stored content as revision 1,
+# so the first edit has something to be compared with.
+def ensure_history(article):
+    if article.revisions.exists():
+        return
+    stored = Article.objects.filter(pk=article.pk).values('author_id', *FIELDS).first()
+    if stored is not None:
+        author_id = stored.pop('author_id')
+        record_revision(article, editor=AdvUser.objects.filter(pk=author_id).first(), data=stored)
+
+
+# Differences between two revisions: [(field name, unified diff lines)].
+def diff_revisions(old, new):
+    result = []
+    for field in FIELDS:
+        before, after = old.get(field), new.get(field)
+        if before == after:
+            continue
+        lines = difflib.unified_diff(str(before or '').splitlines(), str(after or '').splitlines(), lineterm='', n=2)
+        label = Article._meta.get_field(field[:-3] if field.endswith('_id') else field).verbose_name
+        result.append((label, [line for line in lines if not line.startswith(('---', '+++'))]))
+    return result
+
+
+# Drops all but the last `keep` revisions of an article. The oldest kept revision
+# becomes a snapshot first, so the rest can still be rebuilt. Returns number of deleted revisions.
+def prune_revisions(article_id, keep=None):
+    keep = keep or settings.ARTICLE_REVISION_KEEP
+    with transaction.atomic():
+        oldest = (ArticleRevision.objects.select_for_update().filter(article_id=article_id)
+                  .order_by('-number')[keep - 1:keep].first())
+        if oldest is None:
+            return 0
+        if not oldest.is_snapshot:
+            oldest.data = _pack(get_revision(article_id, oldest.number))
+            oldest.is_snapshot = True
+            oldest.save(update_fields=('data', 'is_snapshot'))
+        deleted, _ = ArticleRevision.objects.filter(article_id=article_id, number__lt=oldest.number).delete()
+    return deleted
+
+
+# Prunes every article that has more than `keep` revisions.
+def prune_all(keep=None):
+    keep = keep or settings.ARTICLE_REVISION_KEEP
+    articles = (ArticleRevision.objects.order_by().values('article').annotate(count=Count('pk'))
+                .filter(count__gt=keep).values_list('article', flat=True))
+    return sum(prune_revisions(article_id, keep) for article_id in articles)
@@ -0,0 +1,57 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save
+
+from .conditional import bump_article_listings, bump_read_articles, touch_subscribed_users
+from .counters import article_counts_changed
+from .facets import article_facets_changed, user_location_changed
+from .models import AdvUser, Article
+from .profiles import article_changed, subscriptions_changed, user_changed
+from .related import article_text_changed
+from .slow_queries import install_hook
+from .snapshots import remember_fields
+from .storage import release_file_reference, update_file_references
+from .thumbnails import build_variants_on_save
+
+
+# Loaded field values compared by the receivers below and those of the companies app.
+post_init.connect(remember_fields, sender=Article)
+post_init.connect(remember_fields, sender=AdvUser)
+
+# Resized variants of uploaded images.
+post_save.connect(build_variants_on_save, sender=Article)
+post_save.connect(build_variants_on_save, sender=AdvUser)
+
+# Reference counters of uploaded files.
+for model in (Article, AdvUser):
+    post_save.connect(update_file_references, sender=model)
+    post_delete.connect(release_file_reference, sender=model)
+
+# Cached profile pages.
+post_save.connect(user_changed, sender=AdvUser)
+post_delete.connect(user_changed, sender=AdvUser)
+post_save.connect(article_changed, sender=Article)
+post_delete.connect(article_changed, sender=Article)
+for field in ('user_subscriptions', 'tags_subscriptions', 'cat_subscriptions'):
+    m2m_changed.connect(subscriptions_changed, sender=getattr(AdvUser, field).through)
+
+# Validators of conditional GET.
+post_save.connect(bump_article_listings, sender=Article)
+post_delete.connect(bump_article_listings, sender=Article)
+for field in ('user_subscriptions', 'tags_subscriptions', 'cat_subscriptions'):
+    m2m_changed.connect(touch_subscribed_users, sender=getattr(AdvUser, field).through)
+m2m_changed.connect(bump_read_articles, sender=Article.viewed_users.through)
+
+# Facet index.
+post_save.connect(article_facets_changed, sender=Article)
+post_delete.connect(article_facets_changed, sender=Article)
+post_save.connect(user_location_changed, sender=AdvUser)
+
+# Category and tag counters.
+post_save.connect(article_counts_changed, sender=Article)
+post_delete.connect(article_counts_changed, sender=Article)
+
+# Related articles.
+post_save.connect(article_text_changed, sender=Article)
+
+# Slow query log.
+connection_created.connect(install_hook)
@@ -0,0 +1,116 @@
+from contextlib import contextmanager
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.http import StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+# View and path of the request being processed, set by SQLProfilerMiddleware.
+current = threading.local()
+
+# Prefix of EXPLAIN statement: {vendor: (plain, analyze)}.
+EXPLAIN = {
+    'postgresql': ('EXPLAIN ', 'EXPLAIN (ANALYZE, BUFFERS) '),
+    'mysql': ('EXPLAIN ', 'EXPLAIN ANALYZE '),
+    'sqlite': ('EXPLAIN QUERY PLAN ', None),
+}
+
+
+# connection_created receiver: adds the slow query hook to every new connection.
+def install_hook(sender, connection, **kwargs):
+    if log_slow_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(log_slow_query)
+
+
+# Turns the slow query log on or off for queries of the block in this thread.
+@contextmanager
+def logging_queries(enabled):
+    busy = getattr(current, 'busy', False)
+    current.busy = not enabled
+    try:
+        yield
+    finally:
+        current.busy = busy
+
+
+# Execute wrapper: times the query and queues it for the log when it's over SLOW_QUERY_THRESHOLD.
+# EXPLAIN and saving the record run in a task worker, the request only adds the task row.
+def log_slow_query(execute, sql, params, many, context):
+    threshold = settings.SLOW_QUERY_THRESHOLD
+    # Queries of the hook itself (queuing, EXPLAIN, saving the record) are never logged.
+    if threshold is None or getattr(current, 'busy', False):
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    result = execute(sql, params, many, context)
+    duration = time.perf_counter() - start
+    if duration >= threshold and not many:
+        from .tasks import record_slow_query
+        with logging_queries(False):
+            try:
+                # Task arguments are JSON: dates and other values are passed as strings,
+                # which EXPLAIN accepts in their place. Parameters of other statements
+                # (password hashes, session data) are neither explained nor kept.
+                params = json.loads(json.dumps(params, default=str)) if is_select(sql) else None
+                record_slow_query.delay(context['connection'].alias, sql, params, duration,
+                                        getattr(current, 'view', ''), getattr(current, 'path', ''))
+            except Exception:
+                logger.exception('Could not queue slow query')
+    return result
+
+
+def is_select(sql):
+    return sql.lstrip().upper().startswith('SELECT')
+
+
+# Plan of SELECT query. Other statements aren't explained: EXPLAIN ANALYZE would run them again.
+def explain(connection, sql, params, analyze):
+    if not is_select(sql) or connection.vendor not in EXPLAIN:
+        return '', False
+    plain, analyzed = EXPLAIN[connection.vendor]
+    analyze = analyze and analyzed is not None
+    with connection.cursor() as cursor:
+        cursor.execute((analyzed if analyze else plain) + sql, params)
+        rows = cursor.fetchall()
+    return '\n'.join(' '.join(str(column) for column in row) for row in rows), analyze
+
+
+# Saves a slow query with its plan. Parameters are kept for SELECTs only.
+def record(connection, sql, params, duration, view='', path=''):
+    from .models import SlowQuery
+    if not is_select(sql):
+        params = None
+    analyze = random.random() < settings.SLOW_QUERY_ANALYZE_RATE
+    try:
+        # Savepoint, so a failed EXPLAIN doesn't break the transaction of the view.
+        with transaction.atomic(using=connection.alias):
+            plan, analyzed = explain(connection, sql, params, analyze)
+    except DatabaseError as e:
+        plan, analyzed = f'EXPLAIN failed: {e}', False
+    with transaction.atomic():
+        entry = SlowQuery.objects.create(
+            sql=sql, params='' if params is None else json.dumps(params, default=str, ensure_ascii=False), duration=duration,
+            database=connection.alias, view=view, path=path,
+            plan=plan, analyzed=analyzed,
+        )
+        # Ring buffer: records older than the last SLOW_QUERY_LOG_SIZE are dropped.
+        SlowQuery.objects.filter(pk__lte=entry.pk - settings.SLOW_QUERY_LOG_SIZE).delete()
+    logger.warning('Slow query (%.1fms) in %s: %s', duration * 1000, entry.view or '-', sql)
+    return entry
+
+
+# Streams records as JSON lines.
+def export_jsonl(queryset, filename='slow_queries.jsonl'):
+    fields = ('id', 'created_at', 'duration', 'database', 'view', 'path', 'sql', 'params', 'plan', 'analyzed')
+
+    def lines():
+        for row in queryset.order_by('pk').values_list(*fields).iterator():
+            yield json.dumps(dict(zip(fields, row)), default=str, ensure_ascii=False) + '\n'
+    response = StreamingHttpResponse(lines(), content_type='application/x-ndjson; charset=utf-8')
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,64 @@
+from django.core.files import File
+from django.db.models import FileField
+
+# Field values of model instances as loaded from the database, for the receivers that compare
+# them with the saved ones (listings, counters, facets, files, company stats...). One post_init
+# receiver takes the snapshot; save() of the model refreshes it once all post_save receivers
+# ran, so every receiver sees the same old values whatever the order they are connected in.
+
+# Value of a deferred field: it wasn't loaded, reading it would cost a query.
+DEFERRED = object()
+
+# (attname, is file field) of concrete fields by model.
+_fields = {}
+
+
+def _model_fields(model):
+    if model not in _fields:
+        _fields[model] = [(field.attname, isinstance(field, FileField)) for field in model._meta.concrete_fields]
+    return _fields[model]
+
+
+# Name of a stored file, None when there is none or it's an upload not saved yet.
+def _file_name(value):
+    if isinstance(value, File):
+        return value.name if getattr(value, '_committed', False) else None
+    return value or None
+
+
+# Current values of the loaded fields: {attname: value}, file fields by name.
+def current_values(instance):
+    values = {}
+    data = instance.__dict__
+    for attname, is_file in _model_fields(type(instance)):
+        value = data.get(attname, DEFERRED)
+        values[attname] = _file_name(value) if is_file and value is not DEFERRED else value
+    return values
+
+
+# post_init receiver.
+def remember_fields(sender, instance, **kwargs):
+    instance._loaded_fields = current_values(instance)
+
+
+# Called by save() of the models after post_save: saved values become the loaded ones.
+def refresh_fields(instance, update_fields=None):
+    values = current_values(instance)
+    if update_fields is None or not hasattr(instance, '_loaded_fields'):
+        instance._loaded_fields = values
+    else:
+        for name in update_fields:
+            attname = instance._meta.get_field(name).attname
+            instance._loaded_fields[attname] = values[attname]
+
+
+# Values of the fields as loaded, DEFERRED for those that weren't.
+def loaded(instance, *fields):
+    values = getattr(instance, '_loaded_fields', {})
+    return tuple(values.get(field, DEFERRED) for field in fields)
+
+
+# Values of the fields now, DEFERRED for those that aren't loaded.
+def current(instance, *fields):
+    values = current_values(instance)
+    return tuple(values[field] for field in fields)
@@ -0,0 +1,222 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.files.storage import FileSystemStorage, default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .snapshots import DEFERRED, current, loaded
+from .thumbnails import variants_dir
+
+# Upload fields which files are reference counted: {model label: field name}.
+FILE_FIELDS = {
+    'articles.Article': 'image',
+    'articles.AdvUser': 'account_image',
+}
+
+
+# Stores uploads by content hash: images/ab/cd/abcd...ef.png.
+# Uploading the same file twice stores it once, the name given by upload_to
+# is used only for its extension.
+class ContentAddressedStorage(FileSystemStorage):
+    prefix = 'images'
+
+    def get_available_name(self, name, max_length=None):
+        # Final name is chosen by _save, identical names mean identical content.
+        return name
+
+    def hashed_name(self, digest, name):
+        ext = os.path.splitext(name)[1].lower()
+        return os.path.join(self.prefix, digest[:2], digest[2:4], digest + ext)
+
+    def _save(self, name, content):
+        os.makedirs(self.location, exist_ok=True)
+        # Hash while copying to a temporary file, so the upload is read only once.
+        fd, tmp_path = tempfile.mkstemp(dir=self.location, suffix='.upload')
+        digest = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                if hasattr(content, 'seek'):
+                    content.seek(0)
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            name = self.hashed_name(digest.hexdigest(), name)
+            full_path = self.path(name)
+            if os.path.exists(full_path):
+                try:
+                    # Fresh mtime keeps the file from collect_garbage until the reference is saved.
+                    os.utime(full_path)
+                    return name
+                except FileNotFoundError:
+                    # Collected meanwhile, stored again below.
+                    pass
+            directory = os.path.dirname(full_path)
+            if self.directory_permissions_mode is not None:
+                old_umask = os.umask(0)
+                try:
+                    os.makedirs(directory, self.directory_permissions_mode, exist_ok=True)
+                finally:
+                    os.umask(old_umask)
+            else:
+                os.makedirs(directory, exist_ok=True)
+            # Concurrent uploads of the same file write the same bytes, so replace is safe.
+            os.replace(tmp_path, full_path)
+            tmp_path = None
+            if self.file_permissions_mode is not None:
+                os.chmod(full_path, self.file_permissions_mode)
+            return name
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _stored_file_model():
+    from .models import StoredFile
+    return StoredFile
+
+
+def add_reference(name):
+    StoredFile = _stored_file_model()
+    if StoredFile.objects.filter(name=name).update(ref_count=F('ref_count') + 1):
+        return
+    try:
+        with transaction.atomic():
+            StoredFile.objects.create(name=name, ref_count=1)
+    except IntegrityError:
+        # Created by concurrent request.
+        StoredFile.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+
+def remove_reference(name):
+    _stored_file_model().objects.filter(name=name).update(ref_count=F('ref_count') - 1)
+
+
+def _file_field(instance):
+    return FILE_FIELDS.get(instance._meta.label)
+
+
+# post_save receiver: moves reference from the file the instance was loaded with to the new one.
+def update_file_references(sender, instance, created, update_fields=None, **kwargs):
+    field = _file_field(instance)
+    if not field or field not in instance.__dict__:
+        return
+    if update_fields is not None and field not in update_fields:
+        return
+    old, = loaded(instance, field)
+    new, = current(instance, field)
+    if old is DEFERRED:
+        old = None
+    if old == new:
+        return
+    if new:
+        add_reference(new)
+    if old:
+        remove_reference(old)
+
+
+# post_delete receiver.
+def release_file_reference(sender, instance, **kwargs):
+    field = _file_field(instance)
+    if field and field in instance.__dict__:
+        name = getattr(instance, field).name
+        if name:
+            remove_reference(name)
+
+
+# Walks storage directory lazily and yields (relative name, mtime) of every file.
+def iter_stored_files(directory=ContentAddressedStorage.prefix, storage=default_storage):
+    stack = [storage.path(directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield os.path.relpath(entry.path, storage.location), entry.stat().st_mtime
+
+
+# Deletes an orphan unless it was referenced or uploaded again since it was listed.
+# The reference counter is re-checked with its row locked; the file is moved aside first,
+# so an identical upload either touched it before (it's put back) or stores it anew.
+def _delete_orphan(name, deadline, storage):
+    StoredFile = _stored_file_model()
+    with transaction.atomic():
+        if StoredFile.objects.select_for_update().filter(name=name, ref_count__gt=0).exists():
+            return False
+        path = storage.path(name)
+        trash = path + '.deleting'
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return False
+        if os.stat(trash).st_mtime >= deadline:
+            os.replace(trash, path)
+            return False
+        os.remove(trash)
+        shutil.rmtree(storage.path(variants_dir(name)), ignore_errors=True)
+        StoredFile.objects.filter(name=name, ref_count__lte=0).delete()
+    return True
+
+
+# Deletes files nobody references. Files are checked in batches, so memory doesn't
+# depend on the number of files. Fresh files are skipped: they may belong to an
+# upload which isn't saved to the database yet (uploads of existing files touch them).
+# Returns (checked, deleted) counters.
+def collect_garbage(min_age=3600, batch_size=500, dry_run=False, storage=default_storage):
+    StoredFile = _stored_file_model()
+    deadline = time.time() - min_age
+    checked = deleted = 0
+    batch = []
+
+    def sweep(batch):
+        names = [name for name, mtime in batch]
+        referenced = set(StoredFile.objects.filter(name__in=names, ref_count__gt=0).values_list('name', flat=True))
+        orphans = [name for name, mtime in batch if name not in referenced and mtime < deadline]
+        if dry_run:
+            return len(orphans)
+        return sum(_delete_orphan(name, deadline, storage) for name in orphans)
+
+    for item in iter_stored_files(storage=storage):
+        batch.append(item)
+        checked += 1
+        if len(batch) >= batch_size:
+            deleted += sweep(batch)
+            batch = []
+    if batch:
+        deleted += sweep(batch)
+    return checked, deleted
+
+
+# Recalculates reference counters from model tables (fixes drift after
+# queryset.update() and raw SQL, which bypass signals).
+def recount_references(apps=None):
+    if apps is None:
+        from django.apps import apps
+    StoredFile = apps.get_model('articles', 'StoredFile')
+    counts = {}
+    for label, field in FILE_FIELDS.items():
+        model = apps.get_model(label)
+        names = model.objects.exclude(**{field: ''}).exclude(**{field + '__isnull': True}).values_list(field, flat=True)
+        for name in names.iterator(chunk_size=2000):
+            counts[name] = counts.get(name, 0) + 1
+    by_count = {}
+    for name, count in counts.items():
+        by_count.setdefault(count, []).append(name)
+    with transaction.atomic():
+        StoredFile.objects.update(ref_count=0)
+        existing = set(StoredFile.objects.values_list('name', flat=True))
+        StoredFile.objects.bulk_create([StoredFile(name=name, ref_count=count) for name, count in counts.items() if name not in existing], batch_size=1000)
+        # Most files have one or two references, so this is a few updates.
+        for count, names in by_count.items():
+            names = [name for name in names if name in existing]
+            for i in range(0, len(names), 500):
+                StoredFile.objects.filter(name__in=names[i:i + 500]).update(ref_count=count)
+    return counts
@@ -0,0 +1,274 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import timedelta
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from django.utils.module_loading import autodiscover_modules
+
+from .db_router import routing_scope
+from .metrics import TASK_DURATION, TASK_WAIT, TASKS_RUNNING
+from .models import Task, TaskQueueLock
+from .slow_queries import logging_queries
+
+logger = logging.getLogger(__name__)
+
+# Registered task functions by name.
+registry = {}
+
+
+# Registers a function as a background task:
+#
+#     @task(queue='mail', max_attempts=5)
+#     def send_email(user_id): ...
+#
+#     send_email.delay(user.pk)
+#
+# Arguments must be JSON serializable. The task row is written in the caller's
+# transaction, so a task is never started for a change that was rolled back.
+def task(queue='default', max_attempts=3):
+    def decorator(func):
+        name = f'{func.__module__}.{func.__name__}'
+        registry[name] = func
+
+        def delay(*args, **kwargs):
+            return enqueue(name, args, kwargs, queue=queue, max_attempts=max_attempts)
+        func.delay = delay
+        func.task_name = name
+        return func
+    return decorator
+
+
+def enqueue(name, args=(), kwargs=None, queue='default', max_attempts=3, run_at=None):
+    payload = json.dumps({'args': list(args), 'kwargs': kwargs or {}}, ensure_ascii=False)
+    return Task.objects.create(name=name, queue=queue, payload=payload, max_attempts=max_attempts,
+                               run_at=run_at or timezone.now())
+
+
+def get_task(name):
+    if name not in registry:
+        autodiscover_modules('tasks')
+    return registry.get(name)
+
+
+def _running(queue):
+    return Task.objects.filter(status=Task.RUNNING, queue=queue).count()
+
+
+# Locks the row of a queue until the end of the transaction.
+def _lock_queue(queue):
+    locked = TaskQueueLock.objects.select_for_update().filter(name=queue)
+    if not list(locked):
+        # First claim of the queue.
+        TaskQueueLock.objects.bulk_create([TaskQueueLock(name=queue)], ignore_conflicts=True)
+        list(locked)
+
+
+# Marks up to `limit` due tasks of a queue as running and returns them. Never more than
+# TASK_QUEUES allows to run at once: the count of running tasks and the claim are one transaction.
+def claim(queue, limit, worker):
+    now = timezone.now()
+    maximum = settings.TASK_QUEUES.get(queue, 1)
+    due = Task.objects.filter(status=Task.QUEUED, queue=queue, run_at__lte=now).order_by('run_at', 'pk')
+    fields = {'status': Task.RUNNING, 'started_at': now, 'heartbeat_at': now, 'attempts': F('attempts') + 1}
+    if connection.features.has_select_for_update_skip_locked:
+        # PostgreSQL, MySQL 8: claims of a queue wait for each other on its lock row,
+        # due tasks locked otherwise (retried from the admin, say) are skipped.
+        with transaction.atomic():
+            _lock_queue(queue)
+            limit = min(limit, maximum - _running(queue))
+            ids = list(due.select_for_update(skip_locked=True).values_list('pk', flat=True)[:max(limit, 0)])
+            Task.objects.filter(pk__in=ids).update(worker=worker, **fields)
+        claimed = Task.objects.filter(pk__in=ids)
+    else:
+        # SQLite: a single UPDATE first, reading first would deadlock concurrent workers. It takes
+        # the write lock of the database, so the count that follows holds until commit; tasks
+        # over the limit are given back.
+        worker = f'{worker}:{uuid.uuid4().hex[:8]}'
+        with transaction.atomic():
+            Task.objects.filter(status=Task.QUEUED, pk__in=due.values('pk')[:limit]).update(worker=worker, **fields)
+            claimed = Task.objects.filter(status=Task.RUNNING, worker=worker)
+            excess = _running(queue) - maximum
+            if excess > 0:
+                extra = list(claimed.order_by('-run_at', '-pk').values_list('pk', flat=True)[:excess])
+                Task.objects.filter(pk__in=extra).update(status=Task.QUEUED, worker='', started_at=None,
+                                                         heartbeat_at=None, attempts=F('attempts') - 1)
+    return list(claimed.order_by('run_at', 'pk'))
+
+
+# Failed attempt: the task is queued again after TASK_RETRY_DELAY * 2^(attempt - 1) seconds
+# until it runs out of attempts.
+def _failure(task, error):
+    if task.attempts < task.max_attempts:
+        delay = settings.TASK_RETRY_DELAY * 2 ** (task.attempts - 1)
+        return {'status': Task.QUEUED, 'run_at': timezone.now() + timedelta(seconds=delay), 'error': error}
+    return {'status': Task.FAILED, 'error': error}
+
+
+# Queue bookkeeping isn't in the slow query log: recording a query queues a task, whose
+# bookkeeping would queue the next one. Queries of the task itself are logged.
+def execute(task):
+    with logging_queries(False):
+        return _execute(task)
+
+
+def _execute(task):
+    func = get_task(task.name)
+    TASK_WAIT.labels(task.queue).observe(max(0, (task.started_at - task.run_at).total_seconds()))
+    TASKS_RUNNING.labels(task.queue).inc()
+    start = time.perf_counter()
+    try:
+        if func is None:
+            raise LookupError(f'Unknown task {task.name}')
+        payload = json.loads(task.payload)
+        # Like a request: replicas until the task writes, whatever the worker did before.
+        with routing_scope(), logging_queries(True):
+            func(*payload['args'], **payload['kwargs'])
+    except Exception:
+        logger.exception('Task %s failed (attempt %d of %d)', task, task.attempts, task.max_attempts)
+        result = _failure(task, traceback.format_exc())
+    else:
+        result = {'status': Task.DONE, 'error': ''}
+    finally:
+        TASKS_RUNNING.labels(task.queue).dec()
+    duration = time.perf_counter() - start
+    TASK_DURATION.labels(task.name, result['status']).observe(duration)
+    Task.objects.filter(pk=task.pk).update(finished_at=timezone.now(), duration=duration, **result)
+    return result['status']
+
+
+# Running tasks without a heartbeat for TASK_TIMEOUT are considered lost (their worker died)
+# and count as a failed attempt. Long tasks of a live worker keep beating; Python threads
+# can't be killed, so a task hung in a live worker isn't stopped either.
+def requeue_stale():
+    deadline = timezone.now() - timedelta(seconds=settings.TASK_TIMEOUT)
+    stale = Q(heartbeat_at__lt=deadline) | Q(heartbeat_at=None, started_at__lt=deadline)
+    for task in Task.objects.filter(stale, status=Task.RUNNING):
+        Task.objects.filter(pk=task.pk, status=Task.RUNNING).update(**_failure(task, 'Timed out'))
+
+
+def purge_finished():
+    deadline = timezone.now() - timedelta(seconds=settings.TASK_KEEP_DONE)
+    Task.objects.filter(status=Task.DONE, finished_at__lt=deadline).delete()
+
+
+# Free slots of every queue: TASK_QUEUES limits running tasks of a queue over all workers.
+# Queues without one are skipped by fetch(), claim() enforces the limit.
+def free_slots(queues):
+    running = dict(Task.objects.filter(status=Task.RUNNING, queue__in=queues).order_by()
+                   .values('queue').annotate(count=Count('pk')).values_list('queue', 'count'))
+    return {queue: settings.TASK_QUEUES.get(queue, 1) - running.get(queue, 0) for queue in queues}
+
+
+# Polls the database and runs due tasks in `concurrency` threads.
+# With concurrency 1 tasks run in the calling thread (used in tests).
+class Worker:
+    def __init__(self, queues=None, concurrency=None, poll_interval=None):
+        self.queues = list(queues or settings.TASK_QUEUES)
+        self.concurrency = concurrency or settings.TASK_WORKER_CONCURRENCY
+        self.poll_interval = settings.TASK_POLL_INTERVAL if poll_interval is None else poll_interval
+        self.name = f'{socket.gethostname()}:{os.getpid()}'
+        self.stopping = threading.Event()
+        self.processed = 0
+        # Ids of the tasks running in this worker.
+        self.active = set()
+
+    def stop(self):
+        self.stopping.set()
+
+    def _execute(self, task):
+        self.active.add(task.pk)
+        try:
+            return execute(task)
+        finally:
+            self.active.discard(task.pk)
+
+    def _run_in_thread(self, task):
+        try:
+            return self._execute(task)
+        finally:
+            connection.close()
+
+    # Marks the tasks running in this worker as alive.
+    def heartbeat(self):
+        ids = list(self.active)
+        if ids:
+            Task.objects.filter(pk__in=ids, status=Task.RUNNING).update(heartbeat_at=timezone.now())
+
+    # Heartbeats every TASK_HEARTBEAT seconds until `done` is set. A thread of its own:
+    # the tasks block the loop (concurrency 1) and their threads.
+    def _beat(self, done):
+        try:
+            with logging_queries(False):
+                while not done.wait(settings.TASK_HEARTBEAT):
+                    try:
+                        self.heartbeat()
+                    except DatabaseError:
+                        logger.exception('Heartbeat failed')
+        finally:
+            connection.close()
+
+    def fetch(self, limit):
+        tasks = []
+        if limit <= 0:
+            return tasks
+        for queue, slots in free_slots(self.queues).items():
+            if len(tasks) >= limit:
+                break
+            if slots > 0:
+                tasks += claim(queue, min(slots, limit - len(tasks)), self.name)
+        return tasks
+
+    # Runs until stop() is called; with once=True until no task is due.
+    def run(self, once=False):
+        autodiscover_modules('tasks')
+        last_maintenance = None
+        executor = ThreadPoolExecutor(self.concurrency) if self.concurrency > 1 else None
+        running = set()
+        beating = threading.Event()
+        beat = threading.Thread(target=self._beat, args=(beating, ), daemon=True)
+        beat.start()
+        try:
+            # The worker's own queries aren't in the slow query log, see execute().
+            with logging_queries(False):
+                while not self.stopping.is_set():
+                    # Drops broken and expired connections (never the one of a surrounding transaction).
+                    if not connection.in_atomic_block:
+                        close_old_connections()
+                    if last_maintenance is None or time.monotonic() - last_maintenance > 60:
+                        requeue_stale()
+                        purge_finished()
+                        last_maintenance = time.monotonic()
+                    tasks = self.fetch(self.concurrency - len(running))
+                    for task in tasks:
+                        self.processed += 1
+                        if executor is None:
+                            self._execute(task)
+                        else:
+                            running.add(executor.submit(self._run_in_thread, task))
+                    if once and not tasks and not running:
+                        break
+                    if running:
+                        done, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                    elif not tasks:
+                        self.stopping.wait(self.poll_interval)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+            beating.set()
+            beat.join()
+        return self.processed
+
+
+# Runs every due task in this thread and returns how many ran. For tests and scripts.
+def run_pending(queues=None):
+    return Worker(queues, concurrency=1, poll_interval=0).run(once=True)
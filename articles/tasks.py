@@ -0,0 +1,51 @@
+from datetime import datetime
+
+from django.db import connections
+
+from . import slow_queries
+from .models import AdvUser, Notifications
+from .moderation import approve_articles
+from .task_queue import task
+from .utilities import send_activation_notification
+
+
+@task(queue='mail', max_attempts=5)
+def send_activation_email(user_id):
+    user = AdvUser.objects.filter(pk=user_id, is_activated=False).first()
+    if user is not None:
+        send_activation_notification(user)
+
+
+# Notification for many users with one insert; users who already have it are skipped.
+@task()
+def notify_users(user_ids, sender, n_type, msg):
+    if not user_ids:
+        return
+    notified = set(Notifications.objects.filter(user_id__in=user_ids, sender=sender, n_type=n_type, content=msg).values_list('user_id', flat=True))
+    created_at = datetime.now().strftime('%H:%M:%S %m/%d/%Y')
+    Notifications.objects.bulk_create([
+        Notifications(user_id=pk, sender=sender, n_type=n_type, content=msg, created_at=created_at)
+        for pk in user_ids if pk not in notified
+    ])
+
+
+# Author rating is the mean rating of all their articles.
+@task()
+def recompute_author_rating(user_id):
+    user = AdvUser.objects.filter(pk=user_id).first()
+    if user is not None:
+        user.recompute_rating()
+
+
+# Publishes articles by ids or the whole moderation queue, progress is kept under `job`.
+@task(queue='moderation')
+def approve_pending(ids=None, job=None):
+    approve_articles(ids, job=job)
+
+
+# Plan and record of a slow query found by slow_queries.log_slow_query.
+@task()
+def record_slow_query(database, sql, params, duration, view='', path=''):
+    # Queries of the record itself aren't logged.
+    with slow_queries.logging_queries(False):
+        slow_queries.record(connections[database], sql, params, duration, view, path)
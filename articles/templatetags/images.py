@@ -0,0 +1,44 @@
+from django import template
+from django.utils.html import format_html, format_html_join
+
+from articles.image_proxy import proxy_url
+from articles.thumbnails import get_variants
+
+register = template.Library()
+
+
+def _srcset(sources):
+    return ', '.join(f'{url} {width}w' for url, width in sources)
+
+
+# Url of remote image served through local caching proxy.
+# Usage: <img src="{{ article.image_url|proxied }}">
+@register.filter
+def proxied(url):
+    return proxy_url(url)
+
+
+# Renders uploaded image with resized variants and lazy loading.
+# Usage: {% responsive_image article.image class='card-image' sizes='(min-width: 1200px) 33vw, 100vw' %}
+@register.simple_tag
+def responsive_image(image, sizes='100vw', **attrs):
+    if not image:
+        return ''
+    attrs.setdefault('loading', 'lazy')
+    attrs.setdefault('decoding', 'async')
+    extra = format_html_join(' ', '{}="{}"', attrs.items())
+    variants = get_variants(image)
+    if not variants:
+        return format_html('<img src="{}" {}>', image.url, extra)
+
+    jpeg = variants.get('jpeg', [])
+    # Browsers without srcset support get the largest resized jpeg instead of the original.
+    src = jpeg[-1][0] if jpeg else image.url
+    webp = ''
+    if 'webp' in variants:
+        webp = format_html('<source type="image/webp" srcset="{}" sizes="{}">', _srcset(variants['webp']), sizes)
+    if jpeg:
+        img = format_html('<img src="{}" srcset="{}" sizes="{}" {}>', src, _srcset(jpeg), sizes, extra)
+    else:
+        img = format_html('<img src="{}" {}>', src, extra)
+    return format_html('<picture>{}{}</picture>', webp, img)
@@ -1,10 +1,60 @@
+from django.apps import apps
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
 from django.core.signing import Signer
+from django.db import connections
+from django.db.models.signals import post_init
 from django.template.loader import render_to_string
-from django.test import TestCase
+from django.template import Context, Template
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from PIL import Image
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+from tagging.models import Tag, TaggedItem
+import csv
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from unittest import mock
 
 from articles.utilities import send_activation_notification
 from articlesboard.settings import ALLOWED_HOSTS, SITE_NAME
-from .models import AdvUser
+from .models import AdvUser, Article, ArticleRevision, ArticleTerm, Category, CategoryCount, FacetChange, Notifications, RelatedArticle
+from .models import SlowQuery, StoredFile, Task, TagCount
+from .async_views import AsyncViewRouter
+from .conditional import listing_version
+from .counters import get_snapshot, rebuild_counters
+from .db_router import PrimaryReplicaRouter
+from .exports import DATASETS
+from .importer import insert_batch, validate_record
+from .facets import FacetIndex, Matches, index as facet_index
+from .moderation import approve_articles
+from .profiling import QueryBudgetMixin, query_shape
+from .ratelimit import take
+from .related import _refresh_terms, rebuild_related
+from .revisions import get_revision, prune_revisions, record_revision
+from .snapshots import DEFERRED, loaded, remember_fields
+from .task_queue import Worker, claim, enqueue, requeue_stale, run_pending, task
+from .tasks import recompute_author_rating, send_activation_email
+from .storage import _delete_orphan, collect_garbage, iter_stored_files
+from .thumbnails import get_variants, variants_dir
+from . import db_router, image_proxy
+from private_messages.models import Dialog
+from companies.models import Company, CompanyStats
 
 
 class EmailMessage(TestCase):
@@ -20,4 +70,1590 @@ class EmailMessage(TestCase):
         subject = render_to_string('email/test_subject.txt', context=context)
         body = render_to_string('email/test_body.txt', context=context)
         user.email(subject, body)
-        
\ No newline at end of file
+        
+
+# CurrentSiteMiddleware needs a site for the test client host.
+class SiteTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Site.objects.update_or_create(pk=1, defaults={'domain': 'testserver', 'name': SITE_NAME})
+
+    def setUp(self):
+        # Warm up the site cache so it doesn't show up in query counts.
+        Site.objects.get_current(RequestFactory().get('/'))
+
+
+class BulkSubscriptions(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = AdvUser.objects.create_user(username='reader', password='pass')
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.tags = [Tag.objects.create(name=f'tag{i}') for i in range(10)]
+        self.category = Category.objects.create(name='python')
+        self.client.force_login(self.user)
+
+    def post(self, data):
+        return self.client.post(reverse('articles:update_subscriptions'), json.dumps(data), content_type='application/json')
+
+    def test_add_and_remove(self):
+        self.user.tags_subscriptions.add(self.tags[0])
+        response = self.post({
+            'tags': {'add': [t.name for t in self.tags[1:]], 'remove': ['tag0', 'missing']},
+            'categories': {'add': ['python']},
+            'users': {'add': ['writer']},
+        })
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(data['added']['tags'], sorted(t.name for t in self.tags[1:]))
+        self.assertEqual(data['removed']['tags'], ['tag0'])
+        self.assertEqual(data['unknown']['tags'], ['missing'])
+        self.assertEqual(set(self.user.tags_subscriptions.all()), set(self.tags[1:]))
+        self.assertIn(self.category, self.user.cat_subscriptions.all())
+        # User subscriptions are symmetrical, both directions are stored.
+        self.assertIn(self.author, self.user.user_subscriptions.all())
+        self.assertIn(self.user, self.author.user_subscriptions.all())
+        self.assertEqual(run_pending(), 1)
+        self.assertEqual(Notifications.objects.filter(user=self.author).count(), 1)
+
+    def test_already_subscribed_is_not_duplicated(self):
+        self.user.tags_subscriptions.add(self.tags[0])
+        data = self.post({'tags': {'add': ['tag0']}}).json()
+        self.assertEqual(data['added']['tags'], [])
+        self.assertEqual(self.user.tags_subscriptions.count(), 1)
+
+    def test_query_count_does_not_grow_with_tags(self):
+        # Session, user, tag lookup, diff query, savepoint, insert, updated_at of user, release.
+        with self.assertNumQueries(8):
+            self.post({'tags': {'add': [t.name for t in self.tags]}})
+
+    def test_bad_json(self):
+        response = self.client.post(reverse('articles:update_subscriptions'), 'nope', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_malformed_sections(self):
+        for data in ({'tags': ['tag0']}, {'tags': {'add': 'tag0'}}, {'users': {'remove': [{'name': 'writer'}]}},
+                     {'categories': {'add': [True]}}, {'tags': {'add': ['tag0']}, 'users': 'writer'}):
+            response = self.post(data)
+            self.assertEqual(response.status_code, 400, data)
+            self.assertIn('error', response.json())
+        self.assertFalse(self.user.tags_subscriptions.exists())
+        self.assertEqual(self.post({'tags': {'add': ['tag0']}, 'users': None}).status_code, 200)
+
+
+def make_image_file(name='picture.png', size=(1600, 900), fmt='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, (200, 30, 30)).save(buffer, fmt)
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class Thumbnails(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+
+    def test_variants_built_on_upload(self):
+        article = Article.objects.create(category=self.category, author=self.author, title='t', content='c', image=make_image_file())
+        # Resized by a task worker, not in the request.
+        self.assertEqual(get_variants(article.image), {})
+        self.assertTrue(Task.objects.filter(name='articles.thumbnails.build_variants', queue='thumbnails').exists())
+        run_pending()
+        variants = get_variants(article.image)
+        self.assertEqual([width for url, width in variants['webp']], [320, 640, 1280])
+        self.assertEqual([width for url, width in variants['jpeg']], [320, 640, 1280])
+        html = Template('{% load images %}{% responsive_image image class="card-image" %}').render(Context({'image': article.image}))
+        self.assertIn('type="image/webp"', html)
+        self.assertIn('640w', html)
+        self.assertIn('loading="lazy"', html)
+        self.assertIn('class="card-image"', html)
+
+    def test_small_images_are_not_upscaled(self):
+        article = Article.objects.create(category=self.category, author=self.author, title='t', content='c', image=make_image_file(size=(500, 300)))
+        run_pending()
+        self.assertEqual([width for url, width in get_variants(article.image)['jpeg']], [320, 500])
+
+    def test_backfill_command(self):
+        article = Article.objects.create(category=self.category, author=self.author, title='t', content='c', image=make_image_file())
+        run_pending()
+        shutil.rmtree(os.path.join(self.media_root, 'thumbs'))
+        self.assertEqual(get_variants(article.image), {})
+        out = io.StringIO()
+        call_command('build_thumbnails', workers=1, stdout=out)
+        self.assertIn('Built: 1', out.getvalue())
+        self.assertIn('webp', get_variants(article.image))
+
+
+# Origin server for image proxy tests. Counts requests per path.
+class StubOriginHandler(BaseHTTPRequestHandler):
+    hits = {}
+
+    def do_GET(self):
+        StubOriginHandler.hits[self.path] = StubOriginHandler.hits.get(self.path, 0) + 1
+        StubOriginHandler.host = self.headers['Host']
+        if self.path.startswith('/image'):
+            buffer = io.BytesIO()
+            Image.new('RGB', (3000, 1000), (10, 20, 30)).save(buffer, 'PNG')
+            body, content_type = buffer.getvalue(), 'image/png'
+        elif self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/image-redirected')
+            self.end_headers()
+            return
+        elif self.path == '/text':
+            body, content_type = b'not an image', 'text/plain'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImageProxy(SiteTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), StubOriginHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.origin = 'http://127.0.0.1:%d' % cls.server.server_port
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        StubOriginHandler.hits = {}
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        settings_override = override_settings(IMAGE_PROXY_CACHE_DIR=self.cache_dir, IMAGE_PROXY_ALLOW_PRIVATE=True)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def get(self, path, **extra):
+        return self.client.get(image_proxy.proxy_url(self.origin + path), **extra)
+
+    def test_fetches_once_and_normalizes(self):
+        response = self.get('/image.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        image = Image.open(io.BytesIO(b''.join(response.streaming_content)))
+        self.assertEqual(max(image.size), settings.IMAGE_PROXY_MAX_DIMENSION)
+        response.close()
+        self.get('/image.png').close()
+        self.assertEqual(StubOriginHandler.hits['/image.png'], 1)
+
+    def test_not_modified(self):
+        etag = self.get('/image.png')['ETag']
+        response = self.get('/image.png', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_redirect_is_followed(self):
+        self.assertEqual(self.get('/redirect').status_code, 200)
+
+    def test_bad_origin_is_not_retried(self):
+        self.assertEqual(self.get('/text').status_code, 502)
+        self.assertEqual(self.get('/text').status_code, 502)
+        self.assertEqual(StubOriginHandler.hits['/text'], 1)
+        self.assertEqual(self.get('/missing').status_code, 502)
+
+    def test_bad_signature(self):
+        response = self.client.get(reverse('articles:image_proxy'), {'u': self.origin + '/image.png'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_private_addresses_are_refused(self):
+        with override_settings(IMAGE_PROXY_ALLOW_PRIVATE=False):
+            self.assertEqual(self.get('/image.png').status_code, 502)
+        self.assertNotIn('/image.png', StubOriginHandler.hits)
+
+    def test_least_recently_used_are_evicted(self):
+        for name in ('a', 'b'):
+            self.get(f'/image-{name}.png').close()
+        # Make "b" the least recently used one.
+        os.utime(image_proxy.cache_path(image_proxy.cache_key(self.origin + '/image-b.png'), '.jpg'), (0, 0))
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(self.cache_dir) for f in files)
+        # Room for 2.5 images: the third one evicts down to 90% of that.
+        with override_settings(IMAGE_PROXY_CACHE_SIZE=size * 5 // 4):
+            self.get('/image-c.png').close()
+        self.assertIsNotNone(image_proxy.get_cached(image_proxy.cache_key(self.origin + '/image-a.png')))
+        self.assertIsNone(image_proxy.get_cached(image_proxy.cache_key(self.origin + '/image-b.png')))
+
+
+    def test_size_is_tracked_without_walking(self):
+        self.get('/image-a.png').close()
+        with mock.patch('articles.image_proxy.os.walk') as walk:
+            self.get('/image-b.png').close()
+        walk.assert_not_called()
+        size = sum(os.path.getsize(os.path.join(root, f)) for root, dirs, files in os.walk(self.cache_dir) for f in files)
+        self.assertEqual(cache.get(image_proxy.SIZE_KEY), size)
+
+    def test_connects_to_checked_address(self):
+        resolved = []
+        getaddrinfo = socket.getaddrinfo
+
+        def resolve(host, *args, **kwargs):
+            if host == 'images.test':
+                resolved.append(host)
+                host = '127.0.0.1'
+            return getaddrinfo(host, *args, **kwargs)
+        url = 'http://images.test:%d/image.png' % self.server.server_port
+        with mock.patch('socket.getaddrinfo', resolve):
+            response = self.client.get(image_proxy.proxy_url(url))
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        # Resolved once, by the check; the connection went to the checked address.
+        self.assertEqual(resolved, ['images.test'])
+        self.assertEqual(StubOriginHandler.host, 'images.test:%d' % self.server.server_port)
+
+class ContentAddressedMedia(TestCase):
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+
+    def create_article(self, image):
+        return Article.objects.create(category=self.category, author=self.author, title='t', content='c', image=image)
+
+    def test_identical_uploads_are_stored_once(self):
+        first = self.create_article(make_image_file('a.PNG'))
+        second = self.create_article(make_image_file('b.png'))
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertRegex(first.image.name, r'^images/[0-9a-f]{2}/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(StoredFile.objects.get(name=first.image.name).ref_count, 2)
+        self.assertEqual(sum(1 for item in iter_stored_files()), 1)
+
+    def test_references_follow_changes(self):
+        article = self.create_article(make_image_file())
+        old_name = article.image.name
+        article = Article.objects.get(pk=article.pk)
+        article.image = make_image_file(size=(100, 100))
+        article.save()
+        self.assertEqual(StoredFile.objects.get(name=old_name).ref_count, 0)
+        self.assertEqual(StoredFile.objects.get(name=article.image.name).ref_count, 1)
+        article.delete()
+        self.assertEqual(StoredFile.objects.get(name=article.image.name).ref_count, 0)
+
+    def test_garbage_collection(self):
+        kept = self.create_article(make_image_file())
+        removed = self.create_article(make_image_file(size=(100, 100)))
+        removed_name = removed.image.name
+        run_pending()
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, variants_dir(removed_name))))
+        removed.delete()
+        checked, deleted = collect_garbage(min_age=0, batch_size=1)
+        self.assertEqual((checked, deleted), (2, 1))
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, kept.image.name)))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, removed_name)))
+        self.assertFalse(os.path.exists(os.path.join(self.media_root, variants_dir(removed_name))))
+        self.assertFalse(StoredFile.objects.filter(name=removed_name).exists())
+
+    def test_fresh_files_are_kept(self):
+        self.create_article(make_image_file()).delete()
+        self.assertEqual(collect_garbage(min_age=3600), (1, 0))
+
+    def test_upload_during_collection_is_kept(self):
+        storage = Article._meta.get_field('image').storage
+        for upload in (lambda: storage.save('a.png', make_image_file()), lambda: self.create_article(make_image_file())):
+            name = self.create_article(make_image_file()).image.name
+            Article.objects.all().delete()
+            path = os.path.join(self.media_root, name)
+            os.utime(path, (0, 0))
+
+            # The same file is uploaded after the collector listed it as an orphan.
+            def upload_then_delete(*args, delete=_delete_orphan):
+                upload()
+                return delete(*args)
+            with mock.patch('articles.storage._delete_orphan', upload_then_delete):
+                self.assertEqual(collect_garbage(min_age=60), (1, 0))
+            self.assertTrue(os.path.exists(path))
+
+    def test_recount(self):
+        article = self.create_article(make_image_file())
+        StoredFile.objects.all().delete()
+        call_command('collect_media', recount=True, min_age=0, stdout=io.StringIO())
+        self.assertEqual(StoredFile.objects.get(name=article.image.name).ref_count, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.media_root, article.image.name)))
+
+
+class ConditionalGet(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+        self.article = Article.objects.create(category=self.category, author=self.author, title='t', content='c', tags='django', is_active=True)
+
+    def assertNotModified(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('no-cache', response['Cache-Control'])
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        return response['ETag']
+
+    def assertModified(self, url, etag):
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_article(self):
+        url = reverse('articles:article', kwargs={'pk': self.article.pk})
+        etag = self.assertNotModified(url)
+        # Views counter doesn't invalidate the page, visits answered with 304 are counted too.
+        self.assertEqual(Article.objects.get(pk=self.article.pk).views, 2)
+        article = Article.objects.get(pk=self.article.pk)
+        article.title = 'new title'
+        article.save()
+        self.assertModified(url, etag)
+
+    def test_not_modified_skips_rendering(self):
+        url = reverse('articles:article', kwargs={'pk': self.article.pk})
+        etag = self.client.get(url)['ETag']
+        # Site lookup is cached, so it's the article and the views counter.
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def test_etag_depends_on_viewer(self):
+        url = reverse('articles:article', kwargs={'pk': self.article.pk})
+        etag = self.client.get(url)['ETag']
+        self.client.force_login(self.author)
+        self.assertModified(url, etag)
+
+    def test_profile(self):
+        reader = AdvUser.objects.create_user(username='reader', password='pass')
+        self.client.force_login(reader)
+        url = reverse('articles:profile', kwargs={'username': 'writer'})
+        etag = self.assertNotModified(url)
+        reader.subscribe_user(self.author)
+        self.assertModified(url, etag)
+
+    def test_category_listing(self):
+        url = reverse('articles:search_by_category', kwargs={'category_name': 'python'})
+        etag = self.assertNotModified(url)
+        Article.objects.create(category=self.category, author=self.author, title='t2', content='c', is_active=True)
+        self.assertModified(url, etag)
+
+    def test_tag_listing(self):
+        Tag.objects.get_or_create(name='django')
+        url = reverse('articles:search_by_tag', kwargs={'tag': 'django'})
+        etag = self.assertNotModified(url)
+        other = Category.objects.create(name='other')
+        Article.objects.create(category=other, author=self.author, title='t2', content='c', tags='flask')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.article.tags = 'django orm'
+        self.article.save()
+        self.assertModified(url, etag)
+
+    def test_unknown_tag(self):
+        self.assertEqual(self.client.get(reverse('articles:search_by_tag', kwargs={'tag': 'missing'})).status_code, 404)
+
+    def test_tag_listing_is_exact(self):
+        Tag.objects.get_or_create(name='py')
+        url = reverse('articles:search_by_tag', kwargs={'tag': 'py'})
+        etag = self.assertNotModified(url)
+        Article.objects.create(category=self.category, author=self.author, title='t2', content='c', tags='python', is_active=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(len(self.client.get(url).context['articles']), 0)
+        Article.objects.create(category=self.category, author=self.author, title='t3', content='c', tags='py', is_active=True)
+        self.assertModified(url, etag)
+
+    def test_listing_follows_read_articles(self):
+        reader = AdvUser.objects.create_user(username='reader', password='pass')
+        self.client.force_login(reader)
+        url = reverse('articles:search_by_category', kwargs={'category_name': 'python'})
+        etag = self.assertNotModified(url)
+        self.client.get(reverse('articles:article', kwargs={'pk': self.article.pk}))
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['read_articles'], {self.article.pk})
+
+
+class Feeds(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+        self.article = Article.objects.create(category=self.category, author=self.author, title='Published', content='c', tags='django', is_active=True)
+        Article.objects.create(category=self.category, author=self.author, title='Moderated', content='c', tags='django')
+
+    def test_feeds(self):
+        Tag.objects.get_or_create(name='django')
+        for name, kwargs in (('category_feed', {'category_name': 'python'}), ('tag_feed', {'tag': 'django'}),
+                             ('author_feed', {'username': 'writer'}), ('category_atom_feed', {'category_name': 'python'})):
+            response = self.client.get(reverse('articles:' + name, kwargs=kwargs))
+            self.assertEqual(response.status_code, 200)
+            self.assertContains(response, 'Published')
+            self.assertNotContains(response, 'Moderated')
+
+    def test_cached_until_article_changes(self):
+        url = reverse('articles:category_feed', kwargs={'category_name': 'python'})
+        response = self.client.get(url)
+        etag = response['ETag']
+        # Cached XML: only the category id lookup.
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).content, response.content)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        article = Article.objects.get(title='Moderated')
+        article.is_active = True
+        article.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Moderated')
+
+    def test_tag_feed_follows_exact_tag(self):
+        Tag.objects.get_or_create(name='django')
+        url = reverse('articles:tag_feed', kwargs={'tag': 'django'})
+        etag = self.client.get(url)['ETag']
+        Article.objects.create(category=self.category, author=self.author, title='Other', content='c', tags='djangorest', is_active=True)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Article.objects.create(category=self.category, author=self.author, title='Tagged', content='c', tags='django', is_active=True)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'Tagged')
+        self.assertNotContains(response, 'Other')
+
+    def test_unknown_listing(self):
+        self.assertEqual(self.client.get(reverse('articles:author_feed', kwargs={'username': 'nobody'})).status_code, 404)
+
+
+class JsonApi(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass', first_name='Иван')
+        self.category = Category.objects.create(name='python')
+        self.articles = [
+            Article.objects.create(category=self.category, author=self.author, title=f'title{i}', content='long content', tags='django orm', is_active=True)
+            for i in range(5)
+        ]
+        Article.objects.create(category=self.category, author=self.author, title='hidden', content='c')
+
+    def get(self, url, **params):
+        return self.client.get(url, params).json()
+
+    def test_list_does_not_load_content(self):
+        url = reverse('articles:api_list', kwargs={'resource': 'articles'})
+        with self.assertNumQueries(1) as ctx:
+            data = self.get(url)
+        self.assertNotIn('content', ctx.captured_queries[0]['sql'])
+        self.assertEqual([a['title'] for a in data['results']], [f'title{i}' for i in range(4, -1, -1)])
+        self.assertEqual(data['results'][0]['author'], {'id': self.author.pk, 'username': 'writer'})
+        self.assertEqual(data['results'][0]['tags'], ['django', 'orm'])
+
+    def test_sparse_fieldset(self):
+        url = reverse('articles:api_list', kwargs={'resource': 'articles'})
+        with self.assertNumQueries(1) as ctx:
+            data = self.get(url, fields='id,title')
+        self.assertNotIn('articles_category', ctx.captured_queries[0]['sql'])
+        self.assertEqual(set(data['results'][0]), {'id', 'title'})
+        self.assertEqual(self.client.get(url, {'fields': 'password'}).status_code, 400)
+
+    def test_batch_fetch(self):
+        url = reverse('articles:api_list', kwargs={'resource': 'articles'})
+        ids = [self.articles[3].pk, self.articles[0].pk, 999]
+        with self.assertNumQueries(1):
+            data = self.get(url, ids=','.join(map(str, ids)), fields='id')
+        self.assertEqual(data['results'], [{'id': ids[0]}, {'id': ids[1]}])
+
+    def test_cursor_pagination(self):
+        url = reverse('articles:api_list', kwargs={'resource': 'articles'})
+        seen = []
+        params = {'limit': 2, 'fields': 'id'}
+        while True:
+            with self.assertNumQueries(1):
+                data = self.get(url, **params)
+            seen += [a['id'] for a in data['results']]
+            if not data['next']:
+                break
+            params['cursor'] = data['next']
+        self.assertEqual(seen, sorted((a.pk for a in self.articles), reverse=True))
+        self.assertEqual(self.client.get(url, {'cursor': 'bad'}).status_code, 400)
+
+    def test_detail(self):
+        data = self.get(reverse('articles:api_detail', kwargs={'resource': 'articles', 'key': self.articles[0].pk}))
+        self.assertEqual(data['content'], 'long content')
+        self.assertEqual(data['category'], {'id': self.category.pk, 'name': 'python'})
+        with self.assertNumQueries(1):
+            data = self.get(reverse('articles:api_detail', kwargs={'resource': 'users', 'key': 'writer'}))
+        self.assertEqual(data['first_name'], 'Иван')
+        self.assertIsNone(data['company'])
+        self.assertNotIn('password', data)
+        hidden = Article.objects.get(title='hidden')
+        self.assertEqual(self.client.get(reverse('articles:api_detail', kwargs={'resource': 'articles', 'key': hidden.pk})).status_code, 404)
+        for key in ('²', 'x'):
+            self.assertEqual(self.client.get(reverse('articles:api_detail', kwargs={'resource': 'articles', 'key': key})).status_code, 404)
+
+    def test_other_resources(self):
+        self.assertEqual(self.get(reverse('articles:api_list', kwargs={'resource': 'categories'}))['results'][0]['name'], 'python')
+        self.assertEqual({t['name'] for t in self.get(reverse('articles:api_list', kwargs={'resource': 'tags'}))['results']}, {'django', 'orm'})
+        self.assertEqual(self.client.get(reverse('articles:api_list', kwargs={'resource': 'secrets'})).status_code, 404)
+
+
+class QueryBudgets(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.reader = AdvUser.objects.create_user(username='reader', password='pass')
+        self.category = Category.objects.create(name='python')
+        Tag.objects.get_or_create(name='django')
+        for i in range(3):
+            author = AdvUser.objects.create_user(username=f'writer{i}', password='pass')
+            self.reader.subscribe_user(author)
+            for j in range(3):
+                article = Article.objects.create(category=self.category, author=author, title=f't{i}{j}', content='c', tags='django orm', is_active=True)
+                article.viewed_users.add(self.reader)
+        self.article = article
+        self.client.force_login(self.reader)
+
+    def test_index(self):
+        with self.assertQueryBudget(8, max_repeats=1):
+            response = self.client.get(reverse('articles:index'))
+        self.assertEqual(len(response.context['last_articles']), 9)
+
+    def test_index_anonymous(self):
+        self.client.logout()
+        with self.assertQueryBudget(2, max_repeats=1):
+            self.client.get(reverse('articles:index'))
+
+    def test_detail(self):
+        with self.assertQueryBudget(7, max_repeats=1):
+            response = self.client.get(reverse('articles:article', kwargs={'pk': self.article.pk}))
+        self.assertEqual({tag.name for tag in response.context['tags']}, {'django', 'orm'})
+
+    def test_search(self):
+        for url in (reverse('articles:search_by_tag', kwargs={'tag': 'django'}),
+                    reverse('articles:search_by_category', kwargs={'category_name': 'python'})):
+            with self.assertQueryBudget(8, max_repeats=1):
+                response = self.client.get(url)
+            self.assertEqual(len(response.context['read_articles']), 9)
+
+    def test_budget_catches_n_plus_one(self):
+        with self.assertRaises(AssertionError):
+            with self.assertQueryBudget(100, max_repeats=2):
+                for article in Article.objects.all():
+                    article.author.username
+
+    def test_query_shape(self):
+        self.assertEqual(query_shape("SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'"),
+                         query_shape("SELECT *  FROM t WHERE id IN (4) AND name = 'it''s'"))
+
+    @override_settings(SQL_QUERY_BUDGET=1)
+    def test_middleware_logs_offenders(self):
+        with self.assertLogs('articles.sql', 'WARNING') as logs:
+            response = self.client.get(reverse('articles:index'))
+        self.assertIn('queries (budget 1)', logs.output[0])
+        self.assertIn('Server-Timing', response)
+
+
+class SeedAndBenchmark(SiteTestCase):
+
+    def test_seed_data(self):
+        call_command('seed_data', users=20, articles=50, categories=3, tags=10, follows=3, views=4, votes=2,
+                     notifications=2, chunk_size=7, stdout=io.StringIO())
+        self.assertEqual(AdvUser.objects.filter(username__startswith='seed_user').count(), 20)
+        self.assertEqual(Article.objects.count(), 50)
+        article = Article.objects.filter(rated_users__isnull=False).first()
+        self.assertGreater(article.rating, 0)
+        # Tags are linked as if articles were saved one by one.
+        self.assertEqual({t.name for t in Tag.objects.get_for_object(article)}, set(article.tags.split()))
+        user = AdvUser.objects.filter(user_subscriptions__isnull=False).first()
+        self.assertIn(user, user.user_subscriptions.first().user_subscriptions.all())
+        self.assertEqual(Notifications.objects.count(), 40)
+        # Counters are rebuilt after the bulk inserts.
+        self.assertEqual(sum(category['count'] for category in get_snapshot()['categories']),
+                         Article.objects.filter(is_active=True).count())
+        dialog = Dialog.objects.filter(message__isnull=False).first()
+        self.assertEqual(dialog.members.count(), 2)
+        self.assertIn(dialog.message_set.first().sender, dialog.members.values_list('username', flat=True))
+        # Next run adds users instead of failing on duplicates.
+        call_command('seed_data', users=5, articles=5, stdout=io.StringIO())
+        self.assertEqual(AdvUser.objects.filter(username__startswith='seed_user').count(), 25)
+
+    # The profiler middleware would log repeated queries of the dialog pages.
+    @override_settings(SQL_PROFILER=False)
+    def test_benchmark(self):
+        call_command('seed_data', users=10, articles=30, categories=2, tags=5, stdout=io.StringIO())
+        out = io.StringIO()
+        call_command('benchmark', requests=3, warmup=1, host='testserver', json=True, stdout=out)
+        results = {r['scenario']: r for r in json.loads(out.getvalue())}
+        self.assertEqual(set(results), {'index', 'index_user', 'detail', 'search_tag', 'search_category', 'profile',
+                                        'notify_user', 'api_articles', 'dialogs', 'dialog_page'})
+        self.assertTrue(all(r['p50'] <= r['p99'] <= r['max'] and r['queries'] > 0 for r in results.values()))
+
+
+class Metrics(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('articles:metrics')
+
+    def test_access(self):
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+        with override_settings(METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+            self.assertEqual(self.client.get(self.url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+        staff = AdvUser.objects.create_user(username='staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_request_metrics(self):
+        self.client.get(reverse('articles:index'))
+        self.client.get(reverse('articles:index'))
+        staff = AdvUser.objects.create_user(username='staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        text = self.client.get(self.url).content.decode()
+        self.assertRegex(text, r'articlesboard_request_duration_seconds_count\{method="GET",status="200",view="articles:index"\} [1-9]')
+        self.assertRegex(text, r'articlesboard_db_queries_per_request_count\{view="articles:index"\} [1-9]')
+        self.assertIn('articlesboard_cache_requests_total', text)
+
+
+class SlowQueries(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.article = Article.objects.create(category=Category.objects.create(name='python'), author=self.author,
+                                              title='t', content='c', is_active=True)
+        # Neighbours of the new article.
+        run_pending()
+
+    # Records queued slow queries, as a task worker does.
+    def record(self):
+        with self.assertLogs('articles.slow_queries', 'WARNING') as logs:
+            run_pending()
+        return logs.output
+
+    def test_records_view_and_plan(self):
+        with override_settings(SLOW_QUERY_THRESHOLD=0):
+            self.client.get(reverse('articles:article', kwargs={'pk': self.article.pk}))
+        # The request only queued the queries.
+        self.assertFalse(SlowQuery.objects.exists())
+        self.assertIn('Slow query', self.record()[0])
+        entry = SlowQuery.objects.filter(sql__contains='articles_article', sql__startswith='SELECT').last()
+        self.assertEqual(entry.view, 'articles:article')
+        self.assertEqual(entry.path, f'/articles/{self.article.pk}/')
+        self.assertIn(str(self.article.pk), entry.params)
+        self.assertIn('articles_article', entry.plan)
+        # Queries of the log itself aren't logged.
+        self.assertFalse(SlowQuery.objects.filter(sql__contains='articles_slowquery').exists())
+        self.assertFalse(SlowQuery.objects.filter(sql__contains='articles_task').exists())
+
+    def test_ring_buffer(self):
+        with override_settings(SLOW_QUERY_THRESHOLD=0, SLOW_QUERY_LOG_SIZE=3):
+            for i in range(5):
+                list(Article.objects.filter(title=f'title{i}'))
+            self.record()
+        self.assertEqual(SlowQuery.objects.count(), 3)
+        self.assertIn('title4', SlowQuery.objects.first().params)
+
+    def test_fast_queries_are_skipped(self):
+        self.client.get(reverse('articles:article', kwargs={'pk': self.article.pk}))
+        self.assertFalse(Task.objects.filter(status=Task.QUEUED).exists())
+
+    def test_export(self):
+        with override_settings(SLOW_QUERY_THRESHOLD=0):
+            list(Article.objects.all())
+        self.record()
+        admin = AdvUser.objects.create_superuser(username='admin', email='admin@example.com', password='pass')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:articles_slowquery_export'))
+        rows = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual(len(rows), SlowQuery.objects.count())
+        self.assertTrue(rows[0]['sql'].startswith('SELECT'))
+
+    def test_export_needs_view_permission(self):
+        staff = AdvUser.objects.create_user(username='staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        self.assertEqual(self.client.get(reverse('admin:articles_slowquery_export')).status_code, 403)
+
+    def test_write_parameters_are_not_kept(self):
+        with override_settings(SLOW_QUERY_THRESHOLD=0):
+            user = AdvUser.objects.create_user(username='secret', password='pass', email='secret@example.com')
+        self.assertFalse(Task.objects.filter(payload__contains=user.password).exists())
+        self.record()
+        inserts = SlowQuery.objects.filter(sql__startswith='INSERT', sql__contains='articles_advuser')
+        self.assertTrue(inserts.exists())
+        self.assertEqual(set(inserts.values_list('params', flat=True)), {''})
+        self.assertFalse(SlowQuery.objects.filter(params__contains='secret@example.com').exists())
+
+
+class CachedProfiles(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.reader = AdvUser.objects.create_user(username='reader', password='pass')
+        self.category = Category.objects.create(name='python')
+        Article.objects.create(category=self.category, author=self.author, title='t', content='c', views=7, is_active=True)
+        self.url = reverse('articles:profile', kwargs={'username': 'writer'})
+        self.client.force_login(self.reader)
+
+    def test_cached_page_needs_no_profile_queries(self):
+        response = self.client.get(self.url)
+        self.assertEqual((response.context['article_count'], response.context['total_views']), (1, 7))
+        # Session and viewer only.
+        with self.assertNumQueries(2):
+            response = self.client.get(self.url)
+        self.assertFalse(response.context['is_subscribed'])
+
+    def test_subscriptions_invalidate_both_profiles(self):
+        self.client.get(self.url)
+        self.reader.subscribe_user(self.author)
+        response = self.client.get(self.url)
+        self.assertEqual(response.context['subscribers'], ['reader'])
+        self.assertTrue(response.context['is_subscribed'])
+        self.assertContains(response, 'Unfollow')
+        self.assertEqual(self.client.get(reverse('articles:profile')).context['subscribers'], ['writer'])
+
+    def test_article_and_user_changes_invalidate(self):
+        self.client.get(self.url)
+        Article.objects.create(category=self.category, author=self.author, title='t2', content='c', is_active=True)
+        self.assertEqual(self.client.get(self.url).context['article_count'], 2)
+        self.author.status = 'new status'
+        self.author.save()
+        self.assertContains(self.client.get(self.url), 'new status')
+
+    def test_unknown_user(self):
+        self.assertEqual(self.client.get(reverse('articles:profile', kwargs={'username': 'nobody'})).status_code, 404)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouting(SiteTestCase):
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpClass(cls):
+        # Second SQLite database with the same tables. It isn't a mirror, so rows written
+        # straight to it show which database a query really read.
+        connections.databases['replica'] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+        with connections['replica'].schema_editor() as editor:
+            for model in apps.get_models():
+                if model._meta.managed and not model._meta.proxy:
+                    editor.create_model(model)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].close()
+        del connections.databases['replica']
+        del connections._connections.replica
+
+    def setUp(self):
+        super().setUp()
+        self.user = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+        self.article = Article.objects.create(category=self.category, author=self.user, title='primary title', content='c', is_active=True)
+        # Replica lags behind: same rows, older title. Bulk inserts bypass the router.
+        self.article.title = 'replica title'
+        for obj in (Site.objects.get(pk=1), self.user, self.category, self.article):
+            type(obj).objects.using('replica').bulk_create([obj])
+        db_router.state.wrote = False
+        self.listing = reverse('articles:search_by_category', kwargs={'category_name': 'python'})
+
+    def test_reads_go_to_replica_until_write(self):
+        self.assertEqual(Article.objects.get(pk=self.article.pk).title, 'replica title')
+        Article.objects.filter(pk=self.article.pk).update(views=1)
+        self.assertEqual(Article.objects.get(pk=self.article.pk).title, 'primary title')
+        self.assertEqual(Article.objects.using('replica').get(pk=self.article.pk).views, 0)
+        self.assertFalse(PrimaryReplicaRouter().allow_migrate('replica', 'articles'))
+
+    def test_without_replicas(self):
+        self.assertEqual(PrimaryReplicaRouter(replicas=[]).db_for_read(Article), 'default')
+
+    def test_session_is_pinned_after_post(self):
+        self.assertContains(self.client.get(self.listing), 'replica title')
+        response = self.client.post(reverse('articles:login'), {'username': 'writer', 'password': 'pass'})
+        self.assertIn('primary_db', response.cookies)
+        # Request state is reset, the cookie pins the next requests.
+        self.assertFalse(db_router.reads_from_primary())
+        self.assertContains(self.client.get(self.listing), 'primary title')
+
+    def test_get_writes_do_not_pin(self):
+        response = self.client.get(reverse('articles:article', kwargs={'pk': self.article.pk}))
+        self.assertNotIn('primary_db', response.cookies)
+        self.assertEqual(Article.objects.using('default').get(pk=self.article.pk).views, 1)
+        self.assertContains(self.client.get(self.listing), 'replica title')
+
+    def test_tasks_start_on_replica(self):
+        titles = []
+        with mock.patch.dict('articles.task_queue.registry', {'read_title': lambda: titles.append(Article.objects.get(pk=self.article.pk).title)}):
+            enqueue('read_title')
+            enqueue('read_title')
+            run_pending()
+        # The worker wrote (claimed the tasks) before each of them ran.
+        self.assertEqual(titles, ['replica title', 'replica title'])
+
+
+class ModerationQueue(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='python')
+        self.authors = [AdvUser.objects.create_user(username=f'writer{i}', password='pass') for i in range(2)]
+        self.articles = [
+            Article.objects.create(category=self.category, author=self.authors[i % 2], title=f't{i}', content='c', tags='django')
+            for i in range(12)
+        ]
+        self.admin = AdvUser.objects.create_superuser(username='admin', email='admin@example.com', password='pass')
+        self.client.force_login(self.admin)
+
+    def test_batch_is_set_based(self):
+        version = listing_version('category', self.category.pk)
+        with self.assertQueryBudget(13, max_repeats=1):
+            approved = approve_articles([a.pk for a in self.articles], batch_size=100)
+        self.assertEqual(approved, 12)
+        self.assertFalse(Article.objects.filter(is_active=False).exists())
+        self.assertEqual(Notifications.objects.filter(n_type='Статья опубликована').count(), 12)
+        self.assertNotEqual(listing_version('category', self.category.pk), version)
+
+    def test_already_published_are_skipped(self):
+        approve_articles([self.articles[0].pk])
+        self.assertEqual(approve_articles([a.pk for a in self.articles[:3]]), 2)
+        self.assertEqual(Notifications.objects.count(), 3)
+
+    def test_queue_page_and_approve_all(self):
+        url = reverse('admin:articles_article_moderation')
+        with self.settings(MODERATION_PAGE_SIZE=5):
+            response = self.client.get(url)
+            self.assertEqual([a.title for a in response.context['articles']], ['t0', 't1', 't2', 't3', 't4'])
+            response = self.client.get(url, {'after': response.context['next_after']})
+            self.assertEqual(response.context['articles'][0].title, 't5')
+        response = self.client.post(url, {'all': '1', 'job': 'job1'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json(), {'job': 'job1'})
+        self.assertEqual(Article.objects.filter(is_active=False).count(), 12)
+        with self.settings(MODERATION_BATCH_SIZE=5):
+            run_pending()
+        progress = self.client.get(reverse('admin:articles_article_moderation_progress'), {'job': 'job1'}).json()
+        self.assertEqual(progress, {'done': 12, 'total': 12, 'finished': True})
+
+    def test_approve_selected(self):
+        url = reverse('admin:articles_article_moderation')
+        self.client.post(url, {'ids': [self.articles[0].pk, self.articles[1].pk, '²']})
+        run_pending()
+        self.assertEqual(Article.objects.filter(is_active=True).count(), 2)
+        self.assertEqual(self.client.get(url).context['articles'][0].title, 't2')
+
+    def test_progress_needs_change_permission(self):
+        staff = AdvUser.objects.create_user(username='staff', password='pass', is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get(reverse('admin:articles_article_moderation_progress'), {'job': 'job1'})
+        self.assertEqual(response.status_code, 403)
+
+
+class AdminChangelists(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='python')
+        for i in range(10):
+            author = AdvUser.objects.create_user(username=f'writer{i}', password='pass')
+            Article.objects.create(category=self.category, author=author, title=f'title {i}', content='c')
+        self.admin = AdvUser.objects.create_superuser(username='admin', email='admin@example.com', password='pass')
+        self.client.force_login(self.admin)
+
+    def test_rows_cost_no_queries(self):
+        for url in (reverse('admin:articles_article_changelist'), reverse('admin:articles_advuser_changelist')):
+            with self.assertQueryBudget(12, max_repeats=1):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+
+    def test_search_and_drilldown(self):
+        url = reverse('admin:articles_article_changelist')
+        response = self.client.get(url, {'q': 'title 3'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+        response = self.client.get(url, {'q': 'writer4'})
+        self.assertEqual([a.title for a in response.context['cl'].result_list], ['title 4'])
+        now = Article.objects.first().created_at
+        response = self.client.get(url, {'created_at__year': now.year, 'created_at__month': now.month})
+        self.assertEqual(response.context['cl'].result_count, 10)
+
+    def test_paginator_counts_exactly_off_postgresql(self):
+        from .paginators import EstimatedCountPaginator
+        paginator = EstimatedCountPaginator(Article.objects.order_by('pk'), 3)
+        self.assertEqual(paginator.count, 10)
+        self.assertEqual(paginator.num_pages, 4)
+
+
+class ArticleRevisions(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='python')
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.paragraphs = [f'Абзац {i}: ' + 'текст статьи ' * 20 + '\n' for i in range(50)]
+        self.article = Article.objects.create(category=self.category, author=self.author, title='t',
+                                              content=''.join(self.paragraphs), tags='django')
+
+    def edit(self, i):
+        self.paragraphs[i % 50] = f'Правка {i}\n'
+        self.article.content = ''.join(self.paragraphs)
+        self.article.title = f't{i}'
+        return record_revision(self.article, self.author)
+
+    @override_settings(ARTICLE_REVISION_SNAPSHOT_EVERY=10)
+    def test_snapshots_deltas_and_rebuild(self):
+        record_revision(self.article, self.author)
+        contents = [self.article.content]
+        for i in range(24):
+            self.edit(i)
+            contents.append(self.article.content)
+        self.assertIsNone(record_revision(self.article, self.author))
+        revisions = ArticleRevision.objects.filter(article=self.article)
+        self.assertEqual(list(revisions.filter(is_snapshot=True).values_list('number', flat=True)), [1, 11, 21])
+        for number, content in enumerate(contents, 1):
+            self.assertEqual(get_revision(self.article.pk, number)['content'], content)
+        stored = sum(len(revision.data) for revision in revisions)
+        self.assertLess(stored, sum(revision.size for revision in revisions) / 10)
+        with self.assertNumQueries(1):
+            self.assertEqual(get_revision(self.article.pk, 20)['title'], 't18')
+
+    @override_settings(ARTICLE_REVISION_SNAPSHOT_EVERY=10)
+    def test_prune_keeps_last_revisions_rebuildable(self):
+        record_revision(self.article, self.author)
+        for i in range(14):
+            self.edit(i)
+        expected = get_revision(self.article.pk, 13)
+        self.assertEqual(prune_revisions(self.article.pk, keep=3), 12)
+        self.assertEqual(list(self.article.revisions.values_list('number', 'is_snapshot')),
+                         [(13, True), (14, False), (15, False)])
+        self.assertEqual(get_revision(self.article.pk, 13), expected)
+        self.assertEqual(get_revision(self.article.pk, 15)['content'], self.article.content)
+        call_command('prune_revisions', keep=2, stdout=io.StringIO())
+        self.assertEqual(self.article.revisions.count(), 2)
+
+    def test_edit_view_records_history_and_moderators_see_diff(self):
+        self.client.force_login(self.author)
+        response = self.client.post(reverse('articles:edit_article', kwargs={'pk': self.article.pk}), {
+            'category': self.category.pk, 'title': 'new title', 'card_text': '', 'image_url': '',
+            'content': self.article.content.replace('Абзац 3', 'Раздел 3'), 'tags': 'django', 'author': self.author.pk,
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(self.article.revisions.values_list('number', flat=True)), [1, 2])
+        self.assertEqual(get_revision(self.article.pk, 1)['title'], 't')
+
+        admin = AdvUser.objects.create_superuser(username='admin', email='admin@example.com', password='pass')
+        self.client.force_login(admin)
+        response = self.client.get(reverse('admin:articles_article_revisions', kwargs={'pk': self.article.pk}))
+        diff = dict(response.context['diff'])
+        self.assertIn('+new title', diff['Название статьи'])
+        self.assertTrue(any(line.startswith('+Раздел 3') for line in diff['Содержание']))
+        # Malformed numbers fall back to the latest revisions.
+        response = self.client.get(reverse('admin:articles_article_revisions', kwargs={'pk': self.article.pk}), {'a': '²'})
+        self.assertEqual(dict(response.context['diff']), diff)
+
+
+# Async consumers read in other threads, so data must be committed.
+class AsyncViews(TransactionTestCase):
+
+    def setUp(self):
+        Site.objects.update_or_create(pk=1, defaults={'domain': 'testserver', 'name': SITE_NAME})
+        self.category = Category.objects.create(name='python')
+        self.reader = AdvUser.objects.create_user(username='reader', password='pass')
+        self.writer = AdvUser.objects.create_user(username='writer', password='pass')
+        self.reader.subscribe_user(self.writer)
+        for i in range(3):
+            Article.objects.create(category=self.category, author=self.writer, title=f'title {i}', content='c', is_active=True)
+        self.client.force_login(self.reader)
+        self.cookie = f'{settings.SESSION_COOKIE_NAME}={self.client.cookies[settings.SESSION_COOKIE_NAME].value}'
+
+    def get(self, path, cookie=True):
+        headers = [(b'host', b'testserver')] + ([(b'cookie', self.cookie.encode())] if cookie else [])
+        communicator = HttpCommunicator(AsyncViewRouter(), 'GET', path, headers=headers)
+        return async_to_sync(communicator.get_response)(timeout=10)
+
+    def test_pages_match_sync_views(self):
+        pages = ((reverse('articles:index'), 'title 2'),
+                 (reverse('articles:profile', kwargs={'username': 'writer'}), 'Статей: 3'))
+        for path, text in pages:
+            response = self.get(path)
+            self.assertEqual(response['status'], 200)
+            self.assertIn(b'Cookie', dict(response['headers'])[b'Vary'])
+            body = response['body'].decode()
+            self.assertIn(text, body)
+            self.assertIn(self.reader.username, body)
+        self.assertNotIn('reader', self.get(reverse('articles:index'), cookie=False)['body'].decode())
+
+    def test_missing_profile_and_other_pages(self):
+        self.assertEqual(self.get(reverse('articles:profile', kwargs={'username': 'nobody'}))['status'], 404)
+        # Not an async page: served by the sync view.
+        response = self.get(reverse('articles:search_by_category', kwargs={'category_name': 'python'}))
+        self.assertIn('title 1', response['body'].decode())
+
+    def test_benchmark(self):
+        out = io.StringIO()
+        call_command('benchmark_asgi', requests=4, concurrency=2, user='reader', host='testserver', json=True, stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual({(r['scenario'], r['variant']) for r in results},
+                         {(s, v) for s in ('index', 'index_user', 'profile') for v in ('sync', 'async')})
+
+
+calls = []
+
+
+@task(max_attempts=2)
+def flaky(fail_times):
+    calls.append(fail_times)
+    if len(calls) <= fail_times:
+        raise ValueError('flaky')
+
+
+class TaskQueue(SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        calls.clear()
+
+    def run_failing(self):
+        with self.assertLogs('articles.task_queue', 'ERROR'):
+            return run_pending()
+
+    def test_retry_with_backoff_then_fail(self):
+        job = flaky.delay(5)
+        self.assertEqual(self.run_failing(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Task.QUEUED, 1))
+        self.assertIn('ValueError', job.error)
+        self.assertGreater(job.run_at, job.finished_at)
+        # Not due yet.
+        self.assertEqual(run_pending(), 0)
+        Task.objects.update(run_at=job.created_at)
+        self.run_failing()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, len(calls)), (Task.FAILED, 2, 2))
+
+    def test_success_after_retry(self):
+        job = flaky.delay(1)
+        self.run_failing()
+        Task.objects.update(run_at=job.created_at)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.error), (Task.DONE, ''))
+        self.assertIsNotNone(job.duration)
+
+    def test_queue_limits(self):
+        for i in range(3):
+            enqueue(flaky.task_name, [0], queue='mail')
+            enqueue(flaky.task_name, [0])
+        Task.objects.filter(pk=Task.objects.filter(queue='mail').first().pk).update(status=Task.RUNNING)
+        with self.settings(TASK_QUEUES={'default': 1, 'mail': 2}):
+            claimed = Worker(concurrency=10).fetch(10)
+        self.assertEqual(sorted(t.queue for t in claimed), ['default', 'mail'])
+
+    # A claim over the limit (another worker claimed since the free slots were counted).
+    def test_claim_keeps_queue_limit(self):
+        for i in range(3):
+            enqueue(flaky.task_name, [0], queue='mail')
+        Task.objects.filter(pk=Task.objects.first().pk).update(status=Task.RUNNING)
+        with self.settings(TASK_QUEUES={'mail': 2}):
+            claimed = claim('mail', 5, 'worker')
+        self.assertEqual(len(claimed), 1)
+        self.assertIsNotNone(claimed[0].heartbeat_at)
+        self.assertEqual(Task.objects.filter(status=Task.RUNNING).count(), 2)
+        self.assertEqual(Task.objects.filter(status=Task.QUEUED, attempts=0, worker='').count(), 1)
+
+    def test_unknown_task_fails(self):
+        job = enqueue('articles.tasks.missing', max_attempts=1)
+        self.run_failing()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Task.FAILED)
+        self.assertIn('Unknown task', job.error)
+
+    @override_settings(TASK_TIMEOUT=0)
+    def test_stale_running_task_is_requeued(self):
+        job = flaky.delay(0)
+        Task.objects.update(status=Task.RUNNING, attempts=1, started_at=job.created_at)
+        run_pending()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Task.QUEUED, 1))
+        self.assertIn('Timed out', job.error)
+
+    @override_settings(TASK_TIMEOUT=60)
+    def test_heartbeat_keeps_long_task_running(self):
+        job = flaky.delay(0)
+        started = timezone.now() - timedelta(hours=1)
+        Task.objects.update(status=Task.RUNNING, attempts=1, started_at=started, heartbeat_at=started)
+        worker = Worker()
+        worker.active.add(job.pk)
+        worker.heartbeat()
+        requeue_stale()
+        job.refresh_from_db()
+        self.assertEqual(job.status, Task.RUNNING)
+        self.assertGreater(job.heartbeat_at, started)
+
+    def test_side_effects_run_in_worker(self):
+        author = AdvUser.objects.create_user(username='writer', password='pass', email='w@example.com', is_activated=False)
+        category = Category.objects.create(name='python')
+        for rating in (2, 5):
+            Article.objects.create(category=category, author=author, title='t', content='c', rating=rating)
+        send_activation_email.delay(author.pk)
+        recompute_author_rating.delay(author.pk)
+        self.assertEqual(len(mail.outbox), 0)
+        out = io.StringIO()
+        call_command('run_tasks', once=True, concurrency=1, stdout=out)
+        self.assertIn('Processed tasks: 2', out.getvalue())
+        self.assertEqual(len(mail.outbox), 1)
+        author.refresh_from_db()
+        self.assertEqual(author.rating, 4)
+
+
+@override_settings(FACET_SYNC_INTERVAL=0)
+class FacetBrowsing(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        facet_index.reset()
+        self.python = Category.objects.create(name='python')
+        self.go = Category.objects.create(name='go')
+        self.moscow = AdvUser.objects.create_user(username='moscow', password='pass', country='RU', city='Moscow')
+        self.berlin = AdvUser.objects.create_user(username='berlin', password='pass', country='DE', city='Berlin')
+        self.articles = [
+            Article.objects.create(category=(self.python, self.go)[i % 2], author=(self.moscow, self.berlin)[i % 3 == 0],
+                                   title=f't{i}', content='c', tags=('django, web', 'web', 'cli')[i % 3],
+                                   rating=i % 6, is_active=i != 5)
+            for i in range(12)
+        ]
+
+    # Counts computed from the database, to compare the index with.
+    def expected(self, selection):
+        def matches(article, skip=None):
+            values = {
+                'category': {article.category_id}, 'tag': {t.strip() for t in article.tags.split(',')},
+                'country': {article.author.country.code}, 'city': {article.author.city},
+                'rating': {min(int(article.rating), 4)},
+            }
+            return all(values[facet] & chosen for facet, chosen in selection.items() if chosen and facet != skip), values
+        articles = list(Article.objects.filter(is_active=True).select_related('author'))
+        counts = {}
+        for facet in ('category', 'tag', 'country', 'city', 'rating'):
+            counter = {}
+            for article in articles:
+                ok, values = matches(article, skip=facet)
+                for value in values[facet] if ok else ():
+                    counter[value] = counter.get(value, 0) + 1
+            counts[facet] = counter
+        return sorted((a.pk for a in articles if matches(a)[0]), reverse=True), counts
+
+    def assertSearch(self, selection):
+        selection = dict({facet: set() for facet in ('category', 'tag', 'country', 'city', 'rating')}, **selection)
+        pks, counts = self.expected(selection)
+        for scan_limit in (0, 10000):
+            with self.settings(FACET_SCAN_LIMIT=scan_limit):
+                matches, found = facet_index.search(selection)
+            self.assertEqual(list(matches), pks)
+            self.assertEqual({facet: dict(values) for facet, values in found.items()}, counts)
+
+    def test_intersected_counts(self):
+        facet_index.sync()
+        self.assertSearch({})
+        self.assertSearch({'category': {self.python.pk}})
+        self.assertSearch({'category': {self.python.pk}, 'tag': {'web'}, 'country': {'RU'}})
+        self.assertSearch({'tag': {'cli', 'django'}, 'rating': {2, 3, 4}})
+        self.assertSearch({'city': {'Nowhere'}})
+
+    def test_incremental_updates(self):
+        facet_index.sync()
+        with mock.patch.object(FacetIndex, 'rebuild') as rebuild:
+            approve_articles([self.articles[5].pk])
+            article = Article.objects.get(pk=self.articles[0].pk)
+            article.tags = 'go, cli'
+            article.category = self.python
+            article.save()
+            user = AdvUser.objects.get(pk=self.moscow.pk)
+            user.city = 'Kazan'
+            user.save()
+            Article.objects.get(pk=self.articles[1].pk).delete()
+            self.articles[2].change_rating(5, self.berlin)
+            facet_index.sync()
+            self.assertFalse(rebuild.called)
+        self.assertSearch({})
+        self.assertSearch({'city': {'Kazan'}})
+        self.assertSearch({'tag': {'go'}, 'category': {self.python.pk}})
+
+    def test_unchanged_save_records_no_change(self):
+        FacetChange.objects.all().delete()
+        article = Article.objects.get(pk=self.articles[0].pk)
+        article.title = 'new title'
+        article.save()
+        self.assertFalse(FacetChange.objects.exists())
+        pk = article.pk
+        article.delete()
+        self.assertEqual(list(FacetChange.objects.values_list('article_id', flat=True)), [pk])
+
+    def test_matches_pages(self):
+        matches = Matches(0b1011010)
+        self.assertEqual(len(matches), 4)
+        self.assertEqual(list(matches), [6, 4, 3, 1])
+        self.assertEqual(matches[1:3], [4, 3])
+        self.assertEqual(matches[3], 1)
+
+    def test_page(self):
+        url = reverse('articles:facets')
+        self.client.get(url)
+        # Session-less anonymous page: change log, category names and the articles of the page.
+        with self.assertQueryBudget(3, max_repeats=1) as profile:
+            response = self.client.get(url, {'category': self.python.pk, 'rating_min': 2})
+        self.assertFalse([sql for alias, sql, duration in profile.queries if 'COUNT(' in sql or 'GROUP BY' in sql])
+        expected, counts = self.expected({'category': {self.python.pk}, 'rating': {2, 3, 4}})
+        self.assertEqual(response.context['total'], len(expected))
+        self.assertEqual([a.pk for a in response.context['articles']], expected[:9])
+        rating = next(facet for facet in response.context['facets'] if facet['name'] == 'rating')
+        self.assertEqual([item['value'] for item in rating['values'] if item['selected']], [2, 3, 4])
+        self.assertContains(response, '?category=%d&amp;rating=2&amp;rating=3&amp;rating=4&amp;tag=web' % self.python.pk)
+
+    def test_malformed_numbers_are_ignored(self):
+        url = reverse('articles:facets')
+        for query in ({'category': '²'}, {'rating': '²'}, {'rating_min': '²', 'rating_max': '3'}):
+            self.assertEqual(self.client.get(url, query).status_code, 200)
+
+
+class Exports(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.category = Category.objects.create(name='python')
+        self.users = [AdvUser.objects.create_user(username=f'user{i}', password='pass', email=f'u{i}@example.com') for i in range(3)]
+        self.articles = [
+            Article.objects.create(category=self.category, author=self.users[i % 3], title=f'Статья, "{i}"', content='c', views=i)
+            for i in range(5)
+        ]
+        for article in self.articles[:3]:
+            article.rated_users.add(*self.users[:2])
+            article.viewed_users.add(self.users[2])
+        self.admin = AdvUser.objects.create_superuser(username='admin', email='admin@example.com', password='pass')
+        self.client.force_login(self.admin)
+
+    def download(self, dataset, **params):
+        response = self.client.get(reverse('admin:articles_article_export_download', kwargs={'dataset': dataset}), params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def test_csv(self):
+        response, content = self.download('articles')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="articles.csv"')
+        rows = list(csv.DictReader(io.StringIO(content.decode('utf-8'))))
+        self.assertEqual([row['title'] for row in rows], [a.title for a in self.articles])
+        self.assertEqual((rows[1]['author'], rows[1]['category'], rows[1]['views']), ('user1', 'python', '1'))
+
+    def test_jsonl_gzip(self):
+        response, content = self.download('votes', format='jsonl', gzip='1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = [json.loads(line) for line in gzip.decompress(content).decode('utf-8').splitlines()]
+        self.assertEqual(len(rows), 6)
+        self.assertEqual({row['user_id'] for row in rows}, {self.users[0].pk, self.users[1].pk})
+        _, content = self.download('users', format='jsonl')
+        self.assertIn('u1@example.com', content.decode('utf-8'))
+
+    def test_keyset_batches(self):
+        # One short query per batch, plus the empty one that ends the export.
+        with self.assertQueryBudget(4, max_repeats=4):
+            batches = list(DATASETS['views'].rows(chunk_size=1))
+        self.assertEqual([len(batch) for batch in batches], [1, 1, 1])
+
+    def test_command(self):
+        path = os.path.join(tempfile.mkdtemp(), 'articles.csv.gz')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        call_command('export_data', 'articles', '--gzip', '--chunk-size', '2', '-o', path)
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            self.assertEqual(len(list(csv.DictReader(file))), 5)
+
+    def test_permissions(self):
+        self.client.force_login(AdvUser.objects.create_user(username='staff', password='pass', is_staff=True))
+        self.assertEqual(self.client.get(reverse('admin:articles_article_export')).status_code, 403)
+        self.client.force_login(self.admin)
+        self.assertContains(self.client.get(reverse('admin:articles_article_export')), 'views.jsonl.gz')
+        response = self.client.get(reverse('admin:articles_article_export_download', kwargs={'dataset': 'nope'}))
+        self.assertEqual(response.status_code, 404)
+
+
+class BulkImport(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.company = Company.objects.create(name='Acme')
+        self.author = AdvUser.objects.create_user(username='writer', password='pass', company=self.company)
+        self.category = Category.objects.create(name='python')
+        Tag.objects.create(name='django')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def record(self, i, **fields):
+        return dict({'title': f'Статья {i}', 'content': 'text', 'category': 'python', 'author': 'writer',
+                     'tags': ['django', f'tag{i % 2}']}, **fields)
+
+    def write(self, lines):
+        path = os.path.join(self.directory, 'articles.jsonl')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write('\n'.join(line if isinstance(line, str) else json.dumps(line, ensure_ascii=False) for line in lines))
+        return path
+
+    def test_command(self):
+        path = self.write([
+            self.record(1), self.record(2, tags='orm web'), '{broken', self.record(4, title='x' * 101),
+            self.record(5, author='nobody'), self.record(6, category='go'), '', self.record(8),
+        ])
+        errors = os.path.join(self.directory, 'errors.jsonl')
+        out = io.StringIO()
+        call_command('import_articles', path, '--workers', '0', '--batch-size', '3', '--errors', errors, stdout=out)
+        self.assertIn('3 imported, 4 failed', out.getvalue())
+        with open(errors, encoding='utf-8') as file:
+            reported = {item['line']: set(item['errors']) for item in map(json.loads, file)}
+        self.assertEqual(reported, {3: {'json'}, 4: {'title'}, 5: {'author'}, 6: {'category'}})
+        article = Article.objects.get(title='Статья 2')
+        self.assertFalse(article.is_active)
+        self.assertEqual(sorted(tag.name for tag in Tag.objects.get_for_object(article)), ['orm', 'web'])
+        self.assertEqual(sorted(tag.name for tag in Tag.objects.get_for_object(Article.objects.get(title='Статья 8'))), ['django', 'tag0'])
+        self.assertEqual(Tag.objects.filter(name='django').count(), 1)
+
+    def test_batch_is_set_based(self):
+        records = [validate_record((i, json.dumps(self.record(i)))) for i in range(20)]
+        # References, tags, articles, tagged items and counters: the count doesn't grow with the batch.
+        with self.assertQueryBudget(21, max_repeats=2):
+            inserted, errors = insert_batch([(number, record) for number, record, problems in records], active=True)
+        self.assertEqual((inserted, errors), (20, {}))
+        self.assertEqual(TaggedItem.objects.count(), 40)
+        self.assertEqual(CompanyStats.objects.get(company=self.company).articles, 20)
+        self.assertEqual(self.client.get(reverse('articles:profile', kwargs={'username': 'writer'})).context['article_count'], 20)
+
+    def test_validation_in_worker_processes(self):
+        lines = [(1, json.dumps(self.record(1))), (2, json.dumps(self.record(2, content='')))]
+        with ProcessPoolExecutor(2) as pool:
+            results = list(pool.map(validate_record, lines))
+        self.assertEqual(results[0][1]['tags'], 'django, tag1')
+        self.assertEqual((results[1][1], list(results[1][2])), (None, ['content']))
+
+
+@override_settings(RATE_LIMITS={'rating': {'user': (2, 60), 'ip': (5, 60)}, 'autocomplete': {'ip': (1, 60)}})
+class RateLimits(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.user = AdvUser.objects.create_user(username='reader', password='pass')
+        author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.article = Article.objects.create(category=Category.objects.create(name='python'), author=author,
+                                              title='t', content='c', is_active=True)
+        self.url = reverse('articles:change_rating', kwargs={'pk': self.article.pk, 'rating': 5})
+
+    def test_user_bucket(self):
+        self.client.force_login(self.user)
+        for i in range(2):
+            self.assertEqual(self.client.get(self.url, HTTP_REFERER='/').status_code, 302)
+        # Rejected before the session and the user are loaded.
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, HTTP_REFERER='/')
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response['Retry-After']), 0)
+        # Another session only shares the address bucket.
+        other = self.client_class()
+        other.force_login(self.user)
+        self.assertEqual(other.get(self.url, HTTP_REFERER='/').status_code, 302)
+
+    def test_random_session_cookies_hit_address_bucket(self):
+        for i in range(5):
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = f'random{i}'
+            self.assertEqual(self.client.get(self.url).status_code, 302)
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = 'random5'
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).status_code, 429)
+
+    def test_ip_bucket(self):
+        url = reverse('private_messages:dialogs') + 'create/autocomplete/'
+        self.assertEqual(self.client.post(url, {'username': 'wri'}).status_code, 200)
+        response = self.client.post(url, {'username': 'wri'}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('error', response.json())
+
+    def test_refill(self):
+        request = RequestFactory().get('/', REMOTE_ADDR='10.0.0.1')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = 'session'
+        self.assertEqual([take(request, 'rating', now=100) for i in range(3)][:2], [0, 0])
+        self.assertAlmostEqual(take(request, 'rating', now=110), 20)
+        # Tokens come back at 2 per minute, up to the bucket size.
+        self.assertEqual(take(request, 'rating', now=130), 0)
+        self.assertGreater(take(request, 'rating', now=130), 0)
+
+
+class FieldSnapshots(SiteTestCase):
+
+    def test_one_snapshot_for_all_receivers(self):
+        receivers = [r for r in post_init._live_receivers(Article) if r.__module__.startswith(('articles', 'companies'))]
+        self.assertEqual(receivers, [remember_fields])
+        author = AdvUser.objects.create_user(username='writer', password='pass')
+        article = Article.objects.create(category=Category.objects.create(name='python'), author=author,
+                                         title='t', content='c', tags='django', is_active=True)
+        article = Article.objects.only('pk', 'title').get(pk=article.pk)
+        self.assertEqual(loaded(article, 'title', 'tags'), ('t', DEFERRED))
+        article.tags = 'orm'
+        article.save(update_fields=['tags'])
+        self.assertEqual(loaded(article, 'title', 'tags'), ('t', 'orm'))
+        # Deferred when loaded: the counters are left to rebuild_counters, listings of the new tag change.
+        self.assertEqual(TagCount.objects.get(name='django').articles, 1)
+        version = listing_version('tag', 'orm')
+        article.title = 'new'
+        article.save()
+        self.assertNotEqual(listing_version('tag', 'orm'), version)
+        self.assertEqual(loaded(article, 'title'), ('new', ))
+
+
+class ArticleCounters(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.python = Category.objects.create(name='python')
+        self.go = Category.objects.create(name='go')
+
+    def counts(self):
+        return (dict(CategoryCount.objects.filter(articles__gt=0).values_list('category__name', 'articles')),
+                dict(TagCount.objects.filter(articles__gt=0).values_list('name', 'articles')))
+
+    def create(self, title, tags, is_active=True, category=None):
+        return Article.objects.create(category=category or self.python, author=self.author, title=title,
+                                      content='c', tags=tags, is_active=is_active)
+
+    def test_incremental_updates(self):
+        first = self.create('a', 'django orm')
+        second = self.create('b', 'django', is_active=False)
+        self.assertEqual(self.counts(), ({'python': 1}, {'django': 1, 'orm': 1}))
+        second.is_active = True
+        second.save()
+        first = Article.objects.get(pk=first.pk)
+        first.tags = 'orm web'
+        first.category = self.go
+        first.save()
+        self.assertEqual(self.counts(), ({'python': 1, 'go': 1}, {'django': 1, 'orm': 1, 'web': 1}))
+        Article.objects.get(pk=second.pk).delete()
+        expected = ({'go': 1}, {'orm': 1, 'web': 1})
+        self.assertEqual(self.counts(), expected)
+        rebuild_counters()
+        self.assertEqual(self.counts(), expected)
+
+    def test_bulk_approval(self):
+        articles = [self.create(f't{i}', 'django', is_active=False) for i in range(3)]
+        approve_articles([article.pk for article in articles])
+        self.assertEqual(self.counts(), ({'python': 3}, {'django': 3}))
+
+    def test_rebuild_repairs_drift(self):
+        self.create('a', 'django orm')
+        TagCount.objects.update(articles=7)
+        CategoryCount.objects.all().delete()
+        out = io.StringIO()
+        call_command('rebuild_counters', stdout=out)
+        self.assertIn('categories: 1, tags: 2', out.getvalue())
+        self.assertEqual(self.counts(), ({'python': 1}, {'django': 1, 'orm': 1}))
+
+    def test_page_from_cached_snapshot(self):
+        for i in range(4):
+            self.create(f't{i}', 'django' if i else 'django rare')
+        url = reverse('articles:tags')
+        self.assertContains(self.client.get(url), 'weight-5')
+        with self.assertQueryBudget(2) as profile:
+            response = self.client.get(url)
+        self.assertFalse([sql for alias, sql, duration in profile.queries if 'count' in sql.lower()])
+        self.assertEqual([(tag['name'], tag['count']) for tag in response.context['tags']], [('django', 4), ('rare', 1)])
+        self.assertEqual(response.context['categories'], [{'name': 'python', 'count': 4}])
+        # Changes drop the snapshot.
+        self.create('new', 'rare')
+        self.assertEqual(get_snapshot()['tags'][1]['count'], 2)
+
+
+@override_settings(RELATED_ARTICLES=2)
+class RelatedArticles(QueryBudgetMixin, SiteTestCase):
+
+    TEXTS = (
+        ('Асинхронный python', 'asyncio корутины event loop python', 'python asyncio'),
+        ('Корутины в python', 'asyncio корутины и задачи python', 'python asyncio'),
+        ('Django ORM', 'запросы django orm python', 'python django'),
+        ('Рецепт борща', 'свекла капуста бульон борщ', 'кулинария'),
+        ('Рецепт щей', 'капуста бульон щи', 'кулинария'),
+    )
+
+    def setUp(self):
+        super().setUp()
+        self.author = AdvUser.objects.create_user(username='writer', password='pass')
+        self.category = Category.objects.create(name='python')
+        self.articles = [self.create(*text) for text in self.TEXTS]
+        run_pending()
+
+    def create(self, title, content, tags, is_active=True):
+        return Article.objects.create(category=self.category, author=self.author, title=title, content=content,
+                                      tags=tags, is_active=is_active)
+
+    def related(self, article):
+        return list(RelatedArticle.objects.filter(article=article).order_by('rank').values_list('related__title', flat=True))
+
+    def test_rebuild(self):
+        self.assertEqual(rebuild_related(chunk_size=2), 5)
+        self.assertEqual(self.related(self.articles[0]), ['Корутины в python', 'Django ORM'])
+        self.assertEqual(self.related(self.articles[3]), ['Рецепт щей'])
+        self.assertEqual(ArticleTerm.objects.filter(article=self.articles[0], term='#asyncio').count(), 1)
+
+    def test_new_article_gets_neighbours_incrementally(self):
+        call_command('rebuild_related', stdout=io.StringIO())
+        article = self.create('Щи из капусты', 'капуста щи бульон', 'кулинария', is_active=False)
+        self.assertFalse(Task.objects.filter(status=Task.QUEUED).exists())
+        article.is_active = True
+        article.save()
+        run_pending()
+        self.assertEqual(self.related(article), ['Рецепт щей', 'Рецепт борща'])
+        # Added to the lists of its neighbours with free places or less similar articles.
+        self.assertEqual(set(self.related(self.articles[4])), {'Щи из капусты', 'Рецепт борща'})
+        article.is_active = False
+        article.save()
+        run_pending()
+        self.assertEqual(self.related(article), [])
+
+    # Common terms, with more stored rows than a refresh may read, are skipped.
+    @override_settings(RELATED_MAX_POSTINGS=2)
+    def test_refresh_reads_bounded_postings(self):
+        vector = {'python': 0.9, 'asyncio': 0.5, 'корутины': 0.1}
+        self.assertEqual(_refresh_terms(vector, {'python': 10, 'asyncio': 1, 'корутины': 1}), ['asyncio', 'корутины'])
+        self.assertEqual(_refresh_terms(vector, {'python': 2, 'asyncio': 1}), ['python', 'корутины'])
+
+    def test_detail_page_reads_neighbours_with_one_query(self):
+        rebuild_related()
+        with self.assertQueryBudget(20) as profile:
+            response = self.client.get(reverse('articles:article', kwargs={'pk': self.articles[3].pk}))
+        self.assertEqual([article.title for article in response.context['related']], ['Рецепт щей'])
+        self.assertContains(response, 'Похожие статьи')
+        self.assertEqual(len([sql for alias, sql, duration in profile.queries if 'articles_relatedarticle' in sql]), 1)
+
+    def test_new_neighbours_invalidate_detail_page(self):
+        rebuild_related()
+        url = reverse('articles:article', kwargs={'pk': self.articles[4].pk})
+        response = self.client.get(url)
+        headers = {'HTTP_IF_NONE_MATCH': response['ETag'], 'HTTP_IF_MODIFIED_SINCE': response['Last-Modified']}
+        self.assertEqual(self.client.get(url, **headers).status_code, 304)
+        self.create('Щи из капусты', 'капуста щи бульон', 'кулинария')
+        run_pending()
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Щи из капусты', [article.title for article in response.context['related']])
+
@@ -0,0 +1,102 @@
+import os
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+
+from .task_queue import task
+from .utilities import parse_int
+
+# Formats of generated variants: (file extension, Pillow format name, mime type).
+FORMATS = {
+    'webp': ('webp', 'WEBP', 'image/webp'),
+    'jpeg': ('jpg', 'JPEG', 'image/jpeg'),
+}
+
+
+# Returns directory with variants of image, e.g. thumbs/images/3f/a2/<sha256>/ for images/3f/a2/<sha256>.png.
+def variants_dir(name):
+    return os.path.join('thumbs', os.path.splitext(name)[0])
+
+
+# Returns relative path of resized variant, e.g. thumbs/images/3f/a2/<sha256>/640.webp.
+def variant_name(name, width, fmt):
+    return os.path.join(variants_dir(name), f'{width}.{FORMATS[fmt][0]}')
+
+
+# Resizes one image into every width and format. Gets plain paths only and doesn't touch
+# Django models or the database, so build_thumbnails can run it in a process pool.
+def make_variants(media_root, name, widths, formats, quality):
+    from PIL import Image, ImageOps
+
+    created = []
+    with Image.open(os.path.join(media_root, name)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+        # Never upscale: the largest variant is the original width.
+        for width in sorted({min(width, original.width) for width in widths}):
+            height = max(1, round(original.height * width / original.width))
+            resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+            for fmt in formats:
+                pil_format = FORMATS[fmt][1]
+                path = os.path.join(media_root, variant_name(name, width, fmt))
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                image = resized.convert('RGB') if pil_format == 'JPEG' else resized
+                # Write to a temporary file so a half-written variant is never served.
+                image.save(path + '.tmp', pil_format, quality=quality, optimize=True)
+                os.replace(path + '.tmp', path)
+                created.append(path)
+    return created
+
+
+def has_variants(name):
+    directory = variants_dir(name)
+    return default_storage.exists(directory) and bool(default_storage.listdir(directory)[1])
+
+
+# Resizes an uploaded image, run by `manage.py run_tasks` workers. The image may be gone by then.
+@task(queue='thumbnails')
+def build_variants(name, force=False):
+    if not default_storage.exists(name) or (not force and has_variants(name)):
+        return
+    make_variants(settings.MEDIA_ROOT, name, settings.THUMBNAIL_WIDTHS, settings.THUMBNAIL_FORMATS, settings.THUMBNAIL_QUALITY)
+
+
+# Queues generation of variants for image field file.
+def schedule_variants(image, force=False):
+    if not image or not image.name:
+        return None
+    if not force and has_variants(image.name):
+        return None
+    return build_variants.delay(image.name, force)
+
+
+# Returns {'webp': [(url, width), ...], 'jpeg': [...]} for variants that exist on disk.
+def get_variants(image):
+    result = {}
+    if not image or not image.name:
+        return result
+    directory = variants_dir(image.name)
+    try:
+        files = default_storage.listdir(directory)[1]
+    except FileNotFoundError:
+        return result
+    extensions = {FORMATS[fmt][0]: fmt for fmt in settings.THUMBNAIL_FORMATS}
+    for f in files:
+        width, _, ext = f.partition('.')
+        width = parse_int(width)
+        if width is not None and ext in extensions:
+            result.setdefault(extensions[ext], []).append((default_storage.url(os.path.join(directory, f)), width))
+    for sources in result.values():
+        sources.sort(key=lambda source: source[1])
+    return result
+
+
+# post_save receiver for models with uploaded images.
+def build_variants_on_save(sender, instance, update_fields=None, **kwargs):
+    for field in ('image', 'account_image'):
+        if update_fields is not None and field not in update_fields:
+            continue
+        image = getattr(instance, field, None)
+        if image:
+            schedule_variants(image)
@@ -10,9 +10,14 @@ from .views import APasswordResetCompleteView, subscribe_user, unsubscribe_user
 from .views import search_by_tag, subscribe_tag, unsubscribe_tag, search_by_category
 from .views import subscribe_category, unsubscribe_category, update_user_status
 from .views import update_account_image_url, notify_user, set_notification_viewed
+from .views import update_subscriptions, proxy_image, facet_search, tag_cloud
+from .api import api_list, api_detail
+from .metrics import metrics_view
+from .feeds import CategoryFeed, TagFeed, AuthorFeed, AtomCategoryFeed, AtomTagFeed, AtomAuthorFeed
 
 app_name = 'articles'
 urlpatterns = [
+    path('accounts/profile/subscriptions/', update_subscriptions, name='update_subscriptions'),
     path('accounts/profile/unsubscribe/category/<str:category_name>/', unsubscribe_category, name='unsubscribe_category'),
     path('accounts/profile/subscribe/category/<str:category_name>/', subscribe_category, name='subscribe_category'),
     path('accounts/profile/unsubscribe/tag/<str:tag>/', unsubscribe_tag, name='unsubscribe_tag'),
@@ -39,6 +44,18 @@ urlpatterns = [
     path('articles/edit/<int:pk>/', ArticleEditView.as_view(), name='edit_article'),
     path('articles/delete/<int:pk>/', ArticleDeleteView.as_view(), name='delete_article'),
     path('articles/add/', ArticleAddView.as_view(), name='add_article'),
+    path('images/proxy/', proxy_image, name='image_proxy'),
+    path('metrics', metrics_view, name='metrics'),
+    path('api/<str:resource>/<str:key>/', api_detail, name='api_detail'),
+    path('api/<str:resource>/', api_list, name='api_list'),
+    path('feeds/category/<str:category_name>/rss/', CategoryFeed(), name='category_feed'),
+    path('feeds/category/<str:category_name>/atom/', AtomCategoryFeed(), name='category_atom_feed'),
+    path('feeds/tag/<str:tag>/rss/', TagFeed(), name='tag_feed'),
+    path('feeds/tag/<str:tag>/atom/', AtomTagFeed(), name='tag_atom_feed'),
+    path('feeds/author/<str:username>/rss/', AuthorFeed(), name='author_feed'),
+    path('feeds/author/<str:username>/atom/', AtomAuthorFeed(), name='author_atom_feed'),
+    path('articles/facets/', facet_search, name='facets'),
+    path('articles/tags/', tag_cloud, name='tags'),
     path('articles/search/category/<str:category_name>/', search_by_category, name='search_by_category'),
     path('articles/search/tag/<str:tag>/', search_by_tag, name='search_by_tag'),
     path('articles/<int:pk>/<int:rating>/', change_rating, name='change_rating'),
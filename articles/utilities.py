@@ -5,6 +5,15 @@ from articlesboard.settings import ALLOWED_HOSTS, SITE_NAME
 signer = Signer()
 
 
+# Integer of a request parameter, `default` when it isn't one.
+# str.isdigit() isn't enough: it accepts '²', which int() rejects.
+def parse_int(value, default=None):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
 # Send activation message to user.
 def send_activation_notification(user):
     if ALLOWED_HOSTS:
@@ -1,6 +1,7 @@
 from django.shortcuts import render, get_object_or_404, redirect, reverse
 from django.shortcuts import render_to_response
 from django.http import HttpResponseRedirect, JsonResponse, HttpResponse
+from django.http import FileResponse, Http404, HttpResponseBadRequest, HttpResponseNotModified
 from articlesboard.settings import SITE_NAME
 from django.urls import reverse_lazy
 from django.core.signing import BadSignature
@@ -12,6 +13,7 @@ from django.contrib.auth.views import PasswordResetCompleteView, PasswordChangeV
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from django.contrib.messages.views import SuccessMessageMixin
 from django.views import View
 from django.views.generic.edit import CreateView, UpdateView
@@ -20,8 +22,10 @@ from django.views.generic.detail import DetailView
 from django.utils import timezone
 from django.forms import ValidationError
 from django.core.paginator import Paginator
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery
 import json
-from tagging.models import TaggedItem, Tag
+from tagging.models import Tag, TaggedItem
 from tagging_autocomplete_new.models import TagAutocomplete
 
 from datetime import datetime
@@ -30,70 +34,124 @@ from .models import AdvUser, Category, Article, Notifications
 from .forms import ARegisterUserForm, ChangeUserInfoForm, ArticleForm, ArticleFormSet
 from .forms import DeleteArticleForm, EditArticleForm, ChangeUserAdditionalInfoForm
 from .utilities import signer
+from .image_proxy import ImageProxyError, cache_key, fetch, signer as image_signer
+from .conditional import conditional_page, listing_version, read_version
+from .counters import get_snapshot
+from .facets import describe, get_index, parse_selection
+from .profiles import get_profile
+from .related import related_articles
+from .ratelimit import rate_limit
+from .revisions import ensure_history, record_revision
+from .tasks import notify_users, recompute_author_rating
+from companies.stats import add_view
 
 
-# Main page view.
+# Independent reads of the index page. The async index (articles/async_views.py)
+# runs them concurrently, index() one after another.
+def my_articles(user):
+    return list(Article.objects.filter(author=user, is_active=True).order_by('-created_at')[0:5])
+
+
+def user_notifications(user):
+    return list(Notifications.objects.filter(user=user).order_by('-created_at')[0:5])
+
+
+def latest_articles(user=None):
+    return list(Article.objects.filter(is_active=True).order_by('-created_at')[0:9])
+
+
+# Last 9 articles of every subscription, fetched with one query, or the latest articles.
+def subscription_feed(user):
+    latest = Article.objects.filter(author=OuterRef('author'), is_active=True).order_by('-created_at').values('pk')[0:9]
+    last_articles = list(Article.objects.filter(author__in=user.user_subscriptions.all(), pk__in=Subquery(latest))
+                         .order_by('author', '-created_at'))
+    return last_articles or latest_articles()
+
+
+# {context name: read} of the index page for a logged in user and for anonymous one.
+INDEX_USER_PARTS = {'my_articles': my_articles, 'notifications': user_notifications, 'last_articles': subscription_feed}
+INDEX_ANONYMOUS_PARTS = {'last_articles': latest_articles}
+
+
+def index_parts(request):
+    return INDEX_USER_PARTS if request.user.is_authenticated else INDEX_ANONYMOUS_PARTS
+
+
+# Main page view. Context may be fetched beforehand by the async index.
 def index(request):
-    if request.user.is_authenticated:
-        subscriptions = request.user.user_subscriptions.all()
-        my_articles = Article.objects.filter(author=request.user, is_active=True).order_by('-created_at')[0:5]
-        last_articles = []
-        notifications = Notifications.objects.filter(user=request.user).order_by('-created_at')[0:5]
-        if len(subscriptions) > 0:
-            for sub in subscriptions:
-                articles = Article.objects.filter(author=sub, is_active=True).order_by('-created_at')[0:9]
-                last_articles += articles
-        if len(last_articles) == 0:
-            last_articles = Article.objects.filter(is_active=True).order_by('-created_at')[0:9]
-        context = {'last_articles': last_articles, 'notifications': notifications, 'my_articles': my_articles}
-    else:
-        last_articles = Article.objects.filter(is_active=True).order_by('-created_at')[0:9]
-        # Refreshing popular articles.
-        context = {'last_articles': last_articles}
+    context = getattr(request, 'prefetched', None)
+    if context is None:
+        context = {name: read(request.user) for name, read in index_parts(request).items()}
     return render(request, 'articles/index.html', context)
 
 
+# Counts a view of the article: every visit of an anonymous user, the first one of a logged in
+# user. Runs before the conditional page, so visits answered with 304 are counted too.
+def count_view(request, article):
+    if request.user.is_authenticated:
+        if article.viewed_users.filter(pk=request.user.pk).exists():
+            return
+        article.viewed_users.add(request.user)
+    # Counter is updated in place, so views don't change updated_at (and ETag) of the article.
+    Article.objects.filter(pk=article.pk).update(views=F('views') + 1)
+    article.views += 1
+    if article.is_active:
+        add_view(article.author_id)
+
+
+# Validators for conditional GET of article page: the article and its related articles list.
+def article_stamp(request, article):
+    related = listing_version('related', article.pk)
+    modified = max(article.updated_at, datetime.fromtimestamp(float(related), timezone.utc))
+    return '%s:%s' % (article.updated_at.timestamp(), related), modified
+
+
+@conditional_page(article_stamp)
+def render_article(request, article):
+    tags = Tag.objects.get_for_object(article)
+    context = {'article': article, 'tags': tags, 'related': related_articles(article)}
+    return render(request, 'articles/article.html', context)
+
+
 # Article page view.
 def detail(request, pk):
-    article = Article.objects.get(pk=pk)
-    # Check if current user already read the article.
-    if request.user not in article.viewed_users.all():
-        if request.user.is_authenticated:
-            article.viewed_users.add(request.user)
-        article.views += 1
-        article.save()
-    # Get TaggedItem objects related to article.
-    tags_objs = TaggedItem.objects.filter(object_id=pk)
-    tags = []
-    for tag in tags_objs:
-        tags.append(tag.tag)
-    context = {'article': article, 'tags': tags}
-    return render(request, 'articles/article.html', context)
+    article = Article.objects.select_related('author', 'category').get(pk=pk)
+    count_view(request, article)
+    return render_article(request, article)
+
+
+# Cached profile of the page, read once per request.
+def request_profile(request, username):
+    if not hasattr(request, '_profile'):
+        request._profile = get_profile(username or request.user.username)
+    return request._profile
+
+
+# Validators for conditional GET of profile page: profile changes whenever its cache is rebuilt.
+def profile_stamp(request, username=None):
+    data = request_profile(request, username)
+    return (data['built_at'].timestamp(), data['built_at']) if data else None
 
 
 # Profile page view.
+@conditional_page(profile_stamp)
 def profile(request, username=None):
-    # Get AdvUser object by username.
-    if username is None:
-        username = request.user.username
-    user = get_object_or_404(AdvUser, username=username)
-    subscribers_objs = user.user_subscriptions.all()
-    subs = []
-    for sub in subscribers_objs:
-        subs.append(sub.username)
-    context = {'user': user, 'subscribers': subs}
+    data = request_profile(request, username)
+    if data is None:
+        raise Http404
+    context = dict(data, is_subscribed=request.user.username in data['subscribers'])
     return render(request, 'articles/user_actions/profile.html', context)
 
 
 # When user press rating button.
+@rate_limit('rating')
 @login_required
 def change_rating(request, rating: int, pk):
     article = Article.objects.get(pk=pk)
-    user = AdvUser.objects.get(username=article.author.username)
     if request.user not in article.rated_users.all():
-        user_articles = Article.objects.filter(author=user)
-        user.change_rating(rating, user_articles)
         article.change_rating(rating, request.user)
+        # Mean over all articles of the author, recomputed in background.
+        recompute_author_rating.delay(article.author_id)
         messages.add_message(request, messages.SUCCESS, 'Спасибо! Ваш голос учтен.')
     else:
         messages.add_message(request, messages.WARNING, 'Вы уже голосовали за эту статью!')
@@ -119,6 +177,7 @@ def user_activate(request, sign):
 
 
 # When user subscribes on other user.
+@rate_limit('subscriptions')
 @login_required
 def subscribe_user(request, username):
     user = AdvUser.objects.get(username=username)
@@ -132,6 +191,7 @@ def subscribe_user(request, username):
 
 
 # When user cancels subscription on other user.
+@rate_limit('subscriptions')
 @login_required
 def unsubscribe_user(request, username):
     user = AdvUser.objects.get(username=username)
@@ -145,6 +205,7 @@ def unsubscribe_user(request, username):
 
 
 # When user subscribes on tag.
+@rate_limit('subscriptions')
 @login_required
 def subscribe_tag(request, tag):
     tag = Tag.objects.get(name=tag)
@@ -157,6 +218,7 @@ def subscribe_tag(request, tag):
 
 
 # When user cancels subscription on tag.
+@rate_limit('subscriptions')
 @login_required
 def unsubscribe_tag(request, tag):
     tag = Tag.objects.get(name=tag)
@@ -168,6 +230,7 @@ def unsubscribe_tag(request, tag):
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
+@rate_limit('subscriptions')
 @login_required
 def subscribe_category(request, category_name):
     category = Category.objects.get(name=category_name)
@@ -178,6 +241,7 @@ def subscribe_category(request, category_name):
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
+@rate_limit('subscriptions')
 @login_required
 def unsubscribe_category(request, category_name):
     category = Category.objects.get(name=category_name)
@@ -188,35 +252,166 @@ def unsubscribe_category(request, category_name):
     return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
 
 
+# Subscription kinds accepted by update_subscriptions: (request key, AdvUser field, model, lookup field).
+SUBSCRIPTION_KINDS = (
+    ('tags', 'tags_subscriptions', Tag, 'name'),
+    ('categories', 'cat_subscriptions', Category, 'name'),
+    ('users', 'user_subscriptions', AdvUser, 'username'),
+)
+
+
+# (add, remove) names of a section of the bulk subscriptions request,
+# {"add": [...], "remove": [...]} with names or ids. None when the section is malformed.
+def subscription_names(section):
+    if section is None:
+        return set(), set()
+    if not isinstance(section, dict):
+        return None
+    for names in section.values():
+        if not isinstance(names, list) or not all(isinstance(name, (str, int)) and not isinstance(name, bool) for name in names):
+            return None
+    return {str(name) for name in section.get('add', [])}, {str(name) for name in section.get('remove', [])}
+
+
+# AJAX based function for changing many subscriptions at once.
+# Expects JSON like {"tags": {"add": [...], "remove": [...]}, "categories": {...}, "users": {...}}.
+@rate_limit('subscriptions')
+@login_required
+@require_POST
+def update_subscriptions(request):
+    try:
+        data = json.loads(request.body.decode('utf-8'))
+    except ValueError:
+        return JsonResponse({'error': 'Некорректный запрос'}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({'error': 'Некорректный запрос'}, status=400)
+
+    requested = {}
+    for key, field_name, model, lookup in SUBSCRIPTION_KINDS:
+        requested[key] = subscription_names(data.get(key))
+        if requested[key] is None:
+            return JsonResponse({'error': f'Некорректный раздел {key}'}, status=400)
+
+    changes = {}
+    names = {}
+    unknown = {}
+    for key, field_name, model, lookup in SUBSCRIPTION_KINDS:
+        add, remove = requested[key]
+        if not add and not remove:
+            continue
+        objects = model.objects.filter(**{lookup + '__in': add | remove})
+        if model is AdvUser:
+            objects = objects.exclude(pk=request.user.pk)
+        ids = dict(objects.values_list(lookup, 'pk'))
+        names[key] = {pk: name for name, pk in ids.items()}
+        unknown[key] = sorted((add | remove) - set(ids))
+        changes[field_name] = ([ids[n] for n in add if n in ids], [ids[n] for n in remove if n in ids])
+
+    applied = request.user.update_subscriptions(changes)
+
+    response = {'added': {}, 'removed': {}, 'unknown': {}}
+    for key, field_name, model, lookup in SUBSCRIPTION_KINDS:
+        if field_name not in applied:
+            continue
+        added, removed = applied[field_name]
+        response['added'][key] = sorted(names[key][pk] for pk in added)
+        response['removed'][key] = sorted(names[key][pk] for pk in removed)
+        response['unknown'][key] = unknown[key]
+
+    if 'user_subscriptions' in applied:
+        added, removed = applied['user_subscriptions']
+        if added:
+            notify_users.delay(sorted(added), f'/accounts/profile/{request.user.username}', 'Новый подписчик!', f'{request.user.username} теперь подписан на вас!')
+        if removed:
+            notify_users.delay(sorted(removed), request.user.username, 'Пользователь отменил подписку.', f'{request.user.username} отписался от Ваших обновлений!')
+
+    return JsonResponse(response)
+
+
+# Articles listed on tag page and in tag feeds: exactly the articles tagged `tag`,
+# the ones whose tag listing versions are bumped when they change.
+def tag_articles(tag: str):
+    return TaggedItem.objects.get_by_model(Article, [tag])
+
+
+# Articles listed on category page and in category feeds.
+def category_articles(category: Category):
+    return Article.objects.filter(category=category)
+
+
+# Ids of listed articles the user has already read (cards are highlighted).
+def read_article_ids(request, articles):
+    if not request.user.is_authenticated:
+        return set()
+    return set(request.user.viewed_users.filter(pk__in=[a.pk for a in articles]).values_list('pk', flat=True))
+
+
+# Validators for conditional GET of tag page: the listing and the viewer's read articles.
+def tag_stamp(request, tag):
+    return '%s:%s' % (listing_version('tag', tag), read_version(request)), None
+
+
 # Show search by tag results. (When user clicks on tag).
+@conditional_page(tag_stamp)
 def search_by_tag(request, tag):
-    articles = Article.objects.filter(tags__contains=tag)
+    # Tag cloud counts may name a tag before tagging has created it.
+    tag = get_object_or_404(Tag, name=tag)
+    articles = tag_articles(tag.name).select_related('category').order_by('-created_at')
     paginator = Paginator(articles, 9)
     if 'page' in request.GET:
         page_num = request.GET['page']
     else:
         page_num = 1
     page = paginator.get_page(page_num)
-    tag = Tag.objects.get(name=tag)
-    context = {'articles': page.object_list, 'page': page, 'tag': tag}
+    context = {'articles': page.object_list, 'page': page, 'tag': tag, 'read_articles': read_article_ids(request, page.object_list)}
     return render(request, 'articles/search.html', context)
 
 
+# Validators for conditional GET of category page: the listing and the viewer's read articles.
+def category_stamp(request, category_name):
+    category_id = Category.objects.filter(name=category_name).values_list('pk', flat=True).first()
+    if not category_id:
+        return None
+    return '%s:%s' % (listing_version('category', category_id), read_version(request)), None
+
+
 # Shows search by category results. (When user clicks on category).
+@conditional_page(category_stamp)
 def search_by_category(request, category_name):
     # category = Category.objects.get(name=category_name)
     category = get_object_or_404(Category, name=category_name)
-    articles = Article.objects.filter(category=category)
+    articles = category_articles(category).select_related('category').order_by('-created_at')
     paginator = Paginator(articles, 9)
     if 'page' in request.GET:
         page_num = request.GET['page']
     else:
         page_num = 1
     page = paginator.get_page(page_num)
-    context = {'articles': page.object_list, 'page': page, 'category': category}
+    context = {'articles': page.object_list, 'page': page, 'category': category, 'read_articles': read_article_ids(request, page.object_list)}
     return render(request, 'articles/search.html', context)
 
 
+# Faceted browsing: published articles filtered by category, tag, author's country and city
+# and rating, with counts next to every facet value. Counts and matches come from the
+# in-memory facet index, the database is only asked for the articles of the page.
+def facet_search(request):
+    selection = parse_selection(request.GET)
+    matches, counts = get_index().search(selection)
+    page = Paginator(matches, 9).get_page(request.GET.get('page', 1))
+    found = Article.objects.select_related('category').in_bulk(page.object_list)
+    articles = [found[pk] for pk in page.object_list if pk in found]
+    query = request.GET.copy()
+    query.pop('page', None)
+    context = {'articles': articles, 'page': page, 'total': len(matches), 'query': query.urlencode(),
+               'facets': describe(counts, selection, request.GET), 'read_articles': read_article_ids(request, articles)}
+    return render(request, 'articles/facets.html', context)
+
+
+# Tag cloud and categories with article counts, from the cached counters snapshot.
+def tag_cloud(request):
+    return render(request, 'articles/tags.html', get_snapshot())
+
+
 # AJAX based function for updating status message.
 @login_required
 def update_user_status(request):
@@ -240,13 +435,14 @@ def update_account_image_url(request):
 
 
 # User calls this function when subscribe or unsubscribe on something.
+# Notification is created by a background task, which skips duplicates.
 @login_required
 def update_user_notifications(request, user: AdvUser, sender: str, n_type: str, msg: str):
-    if len(list(Notifications.objects.filter(user=user, sender=sender, n_type=n_type, content=msg))) == 0:
-        Notifications.objects.create(user=user, sender=sender, n_type=n_type, content=msg, created_at=datetime.now().strftime('%H:%M:%S %m/%d/%Y'))
+    notify_users.delay([user.pk], sender, n_type, msg)
 
 
 # AJAX calls this function periodically.
+@rate_limit('notifications')
 def notify_user(request):
     notifications = Notifications.objects.filter(user=request.user, viewed=False).order_by('-id')[0:4]
     # Convert notifications to JSON format.
@@ -266,6 +462,7 @@ def notify_user(request):
     return JsonResponse({'notifications': ntf})
 
 
+@rate_limit('notifications')
 @login_required
 def set_notification_viewed(request):
     notifications = Notifications.objects.filter(user=request.user, viewed=False).order_by('-id')[0:4]
@@ -277,6 +474,31 @@ def set_notification_viewed(request):
     return HttpResponse('OK')
 
 
+# Serves remote images (Article.image_url, AdvUser.account_image_url) from the local cache.
+def proxy_image(request):
+    try:
+        url = image_signer.unsign(request.GET.get('u', ''))
+    except BadSignature:
+        return HttpResponseBadRequest()
+    etag = '"%s"' % cache_key(url)
+    headers = {'Cache-Control': 'public, max-age=31536000, immutable', 'ETag': etag}
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+    else:
+        try:
+            path, content_type = fetch(url)
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+        except FileNotFoundError:
+            # Evicted by another process right after lookup.
+            path, content_type = fetch(url)
+            response = FileResponse(open(path, 'rb'), content_type=content_type)
+        except ImageProxyError:
+            return HttpResponse(status=502)
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
 # Add article page view.
 class ArticleAddView(TemplateView, LoginRequiredMixin):
 
@@ -290,7 +512,9 @@ class ArticleAddView(TemplateView, LoginRequiredMixin):
     def post(self, request):
         form = ArticleForm(self.request.POST, self.request.FILES, initial={'author': self.request.user.pk})
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                article = form.save()
+                record_revision(article, editor=article.author)
             messages.add_message(self.request, messages.SUCCESS, 'Статья отправлена на модерацию.')
         else:
             messages.add_message(self.request, messages.WARNING, 'Ошибка')
@@ -325,10 +549,14 @@ class ArticleEditView(UpdateView, SuccessMessageMixin, LoginRequiredMixin):
         return render(self.request, self.template_name, context=context)
     
     def post(self, request):
+        # Before the form changes the instance: older articles get their stored text as revision 1.
+        ensure_history(self.article)
         form = EditArticleForm(self.request.POST, self.request.FILES, instance=self.article)
         if form.is_valid():
-            self.article.is_active = False
-            self.article.save()
+            with transaction.atomic():
+                self.article.is_active = False
+                self.article.save()
+                record_revision(self.article, editor=request.user if request.user.is_authenticated else None)
             messages.add_message(self.request, messages.SUCCESS, 'Статья успешно отредактирована и отправлена на модерацию.')
         else:
             messages.add_message(self.request, messages.WARNING, 'Ошибка.')
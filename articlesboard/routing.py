@@ -1,10 +1,15 @@
+from channels.http import AsgiHandler
 from channels.routing import ProtocolTypeRouter, URLRouter
+from django.conf import settings
+
+from articles.async_views import AsyncViewRouter
 # import articles.routing
 # from channels import route
 # from channels.auth import AuthMiddlewareStack
 
 application = ProtocolTypeRouter({
-    # (http->django views is added by default)
+    # Hot pages are served by async consumers (articles/async_views.py), the rest by django views.
+    'http': AsyncViewRouter() if settings.ASYNC_VIEWS else AsgiHandler,
     # 'websocket': AuthMiddlewareStack(
     #     URLRouter(
     #         articles.routing.websocket_urlpatterns
@@ -41,6 +41,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'articles.metrics.MetricsMiddleware',
+    'articles.profiling.SQLProfilerMiddleware',
+    'articles.db_router.ReplicaPinningMiddleware',
+    'articles.ratelimit.RateLimitMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -73,6 +77,8 @@ TEMPLATES = [
 
 # WSGI_APPLICATION = 'articlesboard.wsgi.application'
 ASGI_APPLICATION = 'articlesboard.routing.application'
+# Serve index and profile pages with async consumers, which run independent reads concurrently.
+ASYNC_VIEWS = True
 
 DATABASES = {
     'default': {
@@ -84,6 +90,16 @@ DATABASES = {
         'PORT': '5432',
     }
 }
+
+# Read replicas (articles/db_router.py): comma separated database URLs in
+# DATABASE_REPLICA_URLS. Locally two SQLite files work too, e.g.
+# DATABASE_REPLICA_URLS=sqlite:////tmp/replica.sqlite3 with a copy of the primary file.
+for _index, _url in enumerate(filter(None, os.environ.get('DATABASE_REPLICA_URLS', '').split(','))):
+    DATABASES['replica%d' % (_index + 1)] = dict(dj_database_url.parse(_url.strip()), TEST={'MIRROR': 'default'})
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias.startswith('replica')]
+DATABASE_ROUTERS = ['articles.db_router.PrimaryReplicaRouter']
+# How long a session reads from the primary after it changed something, seconds.
+REPLICA_PIN_SECONDS = 10
 # redis_host = os.environ.get('REDIS_HOST', 'localhost')
 # CHANNEL_LAYERS = {
 #     'default': {
@@ -136,11 +152,152 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+# Uploads are stored by content hash and deduplicated.
+DEFAULT_FILE_STORAGE = 'articles.storage.ContentAddressedStorage'
+
+# Resized variants of uploaded images (articles/thumbnails.py), built in the 'thumbnails' task queue.
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_FORMATS = ('webp', 'jpeg')
+THUMBNAIL_QUALITY = 80
+
+# Local cache of remote images (articles/image_proxy.py).
+IMAGE_PROXY_CACHE_DIR = os.path.join(BASE_DIR, 'cache', 'images')
+IMAGE_PROXY_CACHE_SIZE = 512 * 1024 * 1024
+IMAGE_PROXY_MAX_SIZE = 10 * 1024 * 1024
+IMAGE_PROXY_MAX_PIXELS = 40 * 1000 * 1000
+IMAGE_PROXY_MAX_DIMENSION = 1600
+IMAGE_PROXY_TIMEOUT = 5
+IMAGE_PROXY_MAX_REDIRECTS = 3
+# How long (in seconds) not to retry an origin that failed.
+IMAGE_PROXY_FAILURE_TTL = 300
+# Allow images from localhost and private networks. Only for development and tests.
+IMAGE_PROXY_ALLOW_PRIVATE = False
 
 SITE_NAME = 'ArticlesSite'
 
+# Shared by all worker processes on the box (listing versions, failed image origins).
+# For several servers point it to memcached.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'django'),
+    }
+}
+
+# Part of ETag of every page. Change it after template changes,
+# so browsers don't keep pages rendered with old templates.
+CONDITIONAL_GET_VERSION = '1'
+
+# SQL profiler (articles/profiling.py): requests over these budgets are logged
+# to 'articles.sql' logger. Repeated limit - how many times one query shape may run per request.
+SQL_PROFILER = True
+SQL_PROFILER_HEADER = DEBUG
+SQL_QUERY_BUDGET = 30
+SQL_TIME_BUDGET = 0.5
+SQL_REPEATED_QUERY_LIMIT = 5
+
+# Slow query log (articles/slow_queries.py, recorded by task workers): threshold in seconds (None - disabled),
+# share of slow SELECTs explained with EXPLAIN ANALYZE (runs the query again) and ring buffer size.
+SLOW_QUERY_THRESHOLD = 0.2
+SLOW_QUERY_ANALYZE_RATE = 0.0
+SLOW_QUERY_LOG_SIZE = 1000
+
+# Cached profile pages (articles/profiles.py), seconds. Bounds staleness of the views counter.
+PROFILE_CACHE_TIMEOUT = 600
+
+# Moderation queue (articles/moderation.py): articles per page and per UPDATE.
+MODERATION_PAGE_SIZE = 100
+MODERATION_BATCH_SIZE = 500
+
+# Admin changelists (articles/paginators.py): tables with more rows show PostgreSQL's estimated count.
+ADMIN_ESTIMATED_COUNT_THRESHOLD = 100000
+
+# Article history (articles/revisions.py): a full copy every N revisions, deltas between them;
+# bounds the work of rebuilding a revision. prune_revisions keeps the last ARTICLE_REVISION_KEEP.
+ARTICLE_REVISION_SNAPSHOT_EVERY = 10
+ARTICLE_REVISION_KEEP = 100
+
+# Background tasks (articles/task_queue.py), run by `manage.py run_tasks` workers.
+# Queue: how many of its tasks may run at once over all workers.
+TASK_QUEUES = {'default': 8, 'mail': 2, 'moderation': 1, 'thumbnails': 2}
+TASK_WORKER_CONCURRENCY = 4
+TASK_POLL_INTERVAL = 1.0
+# Failed task is retried after TASK_RETRY_DELAY seconds, doubled on every attempt.
+TASK_RETRY_DELAY = 30
+# Workers mark their running tasks alive every TASK_HEARTBEAT seconds.
+TASK_HEARTBEAT = 30
+# No heartbeat for that long (seconds) means the worker is gone, the task is retried.
+TASK_TIMEOUT = 600
+# Finished tasks are kept for the admin that long (seconds).
+TASK_KEEP_DONE = 24 * 60 * 60
+
+# Faceted browsing (articles/facets.py). Every process keeps facet bitsets in memory and
+# replays changes of other processes at most once in FACET_SYNC_INTERVAL seconds; changes
+# committed up to FACET_SYNC_LAG seconds late (long transactions, replica lag) are still seen.
+FACET_SYNC_INTERVAL = 1
+FACET_SYNC_LAG = 60
+# Change log is kept that long (seconds); a process idle for longer rebuilds its index.
+FACET_CHANGE_KEEP = 10 * 60
+# Up to that many matches facet values are counted by scanning the matches.
+FACET_SCAN_LIMIT = 2000
+# Values shown per facet.
+FACET_VALUES_SHOWN = 20
+
+# Exports (articles/exports.py): rows read per query.
+EXPORT_CHUNK_SIZE = 2000
+
+# Tag cloud page (articles/counters.py): number of tags, font size steps and how long
+# the cached snapshot may lag behind the counters, seconds.
+TAG_CLOUD_SIZE = 100
+TAG_CLOUD_STEPS = 5
+TAG_CLOUD_CACHE_TIMEOUT = 300
+
+# Related articles (articles/related.py): neighbours shown per article, terms kept per article,
+# terms an article is compared by, share of articles a term may appear in before it is dropped
+# as too common, stored rows a refresh of one article may read, articles per write chunk.
+RELATED_ARTICLES = 5
+RELATED_TERMS_PER_ARTICLE = 50
+RELATED_QUERY_TERMS = 20
+RELATED_MAX_DF = 0.5
+RELATED_MAX_POSTINGS = 20000
+RELATED_CHUNK_SIZE = 500
+
+# Company pages (companies/views.py).
+COMPANIES_PER_PAGE = 20
+COMPANY_EMPLOYEES_PER_PAGE = 20
+# Views of articles are added to the company stats in batches, every that many seconds.
+COMPANY_VIEWS_FLUSH_INTERVAL = 60
+
+# Prometheus metrics (articles/metrics.py): token of the scraper, empty - staff only.
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+# JSON API (articles/api.py): page size and the largest page or ids= batch.
+API_DEFAULT_LIMIT = 20
+API_MAX_LIMIT = 100
+
+# RSS/Atom feeds (articles/feeds.py).
+FEED_ITEMS = 20
+# Cached feed is replaced as soon as its listing changes, timeout only frees unused feeds.
+FEED_CACHE_TIMEOUT = 60 * 60
+# How long aggregators may keep feed without asking.
+FEED_MAX_AGE = 5 * 60
+
+# Rate limits of write and autocomplete endpoints (articles/ratelimit.py), token buckets
+# per client: {name: {'user': (requests, seconds), 'ip': (requests, seconds)}}.
+# 'user' is counted per session, 'ip' per address; clients behind one NAT share it, so it is higher.
+RATE_LIMITS = {
+    'rating': {'user': (10, 60), 'ip': (60, 60)},
+    'subscriptions': {'user': (30, 60), 'ip': (120, 60)},
+    'autocomplete': {'user': (60, 60), 'ip': (300, 60)},
+    'notifications': {'user': (30, 60), 'ip': (300, 60)},
+}
+# Cache of the buckets. Must be shared by all worker processes: file based, memcached or redis, not locmem.
+RATE_LIMIT_CACHE = 'default'
+# Request header with the client address when behind a proxy, e.g. 'HTTP_X_REAL_IP'; REMOTE_ADDR when None.
+RATE_LIMIT_IP_HEADER = None
+
 TAGGING_AUTOCOMPLETE_SEARCH_CONTAINS = True
 
 TAGGING_AUTOCOMPLETE_MIN_LENGTH = 1
 
-django_heroku.settings(locals())
\ No newline at end of file
+django_heroku.settings(locals())
@@ -9,6 +9,7 @@ urlpatterns = [
     path('tagging_autocomplete/', include('tagging_autocomplete_new.urls')),
     path('admin/', admin.site.urls),
     path('messages/', include('private_messages.urls')),
+    path('companies/', include('companies.urls', namespace='companies')),
     path('', include('articles.urls', namespace='')),
 ]
 
@@ -1,8 +1,9 @@
 from django.contrib import admin
-from .models import Company
+from .models import Company, CompanyStats
 
 class CompanyAdmin(admin.ModelAdmin):
-    list_display = ('name', 'created_at', )
+    list_display = ('name', 'employees', 'articles', 'created_at', )
+    list_select_related = ('stats', )
     search_fields = ('name', )
     # fieldsets = ('__all__', )
     fields = (
@@ -12,6 +13,15 @@ class CompanyAdmin(admin.ModelAdmin):
             'created_at',
         )
     readonly_fields = ('logo_preview', 'created_at')
+
+    # Columns from materialized stats (companies/stats.py).
+    def employees(self, company):
+        return company.stats.employees if hasattr(company, 'stats') else 0
+    employees.short_description = CompanyStats._meta.get_field('employees').verbose_name
+
+    def articles(self, company):
+        return company.stats.articles if hasattr(company, 'stats') else 0
+    articles.short_description = CompanyStats._meta.get_field('articles').verbose_name
         
 
 admin.site.register(Company, CompanyAdmin)
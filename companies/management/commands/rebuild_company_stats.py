@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from companies.stats import rebuild_stats
+
+
+# Recomputes materialized company stats from users and articles, e.g. after
+# bulk loads or raw SQL that bypass the incremental updates.
+class Command(BaseCommand):
+    help = 'Пересчитывает статистику компаний.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('company', nargs='*', type=int, help='Id компаний (по умолчанию все).')
+
+    def handle(self, *args, **options):
+        count = rebuild_stats(options['company'] or None)
+        self.stdout.write(f'Rebuilt companies: {count}')
@@ -0,0 +1,49 @@
+# Generated by Django 2.2.13 on 2026-10-19 14:51
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+import django.db.models.deletion
+
+
+# Stats of existing companies, later kept up to date by companies/stats.py.
+def fill_stats(apps, schema_editor):
+    Company = apps.get_model('companies', 'Company')
+    CompanyStats = apps.get_model('companies', 'CompanyStats')
+    AdvUser = apps.get_model('articles', 'AdvUser')
+    Article = apps.get_model('articles', 'Article')
+    stats = {pk: CompanyStats(company_id=pk) for pk in Company.objects.values_list('pk', flat=True)}
+    for pk, count in AdvUser.objects.filter(company__isnull=False).order_by().values('company').annotate(count=Count('pk')).values_list('company', 'count'):
+        stats[pk].employees = count
+    articles = (Article.objects.filter(is_active=True, author__company__isnull=False).order_by()
+                .values('author__company').annotate(count=Count('pk'), views=Sum('views'), rating=Sum('rating'))
+                .values_list('author__company', 'count', 'views', 'rating'))
+    for pk, count, views, rating in articles:
+        stats[pk].articles, stats[pk].total_views, stats[pk].rating_sum = count, views or 0, rating or 0
+    CompanyStats.objects.bulk_create(stats.values(), batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('companies', '0006_company_created_at'),
+        ('articles', '0026_task'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompanyStats',
+            fields=[
+                ('company', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='companies.Company', verbose_name='Компания')),
+                ('employees', models.IntegerField(default=0, verbose_name='Сотрудников')),
+                ('articles', models.IntegerField(default=0, verbose_name='Статей')),
+                ('total_views', models.BigIntegerField(default=0, verbose_name='Просмотров')),
+                ('rating_sum', models.FloatField(default=0, verbose_name='Сумма рейтингов')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Обновлено')),
+            ],
+            options={
+                'verbose_name': 'Статистика компании',
+                'verbose_name_plural': 'Статистика компаний',
+            },
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
@@ -24,4 +24,27 @@ class Company(models.Model):
     class Meta:
         verbose_name = 'Компания'
         verbose_name_plural = 'Компании'
-    
\ No newline at end of file
+    
+
+# Materialized aggregates of a company page (companies/stats.py): kept up to date
+# incrementally by signal receivers and bulk updates instead of GROUP BY on every request.
+# Only published articles are counted.
+class CompanyStats(models.Model):
+    company = models.OneToOneField(Company, primary_key=True, on_delete=models.CASCADE, related_name='stats', verbose_name='Компания')
+    employees = models.IntegerField(default=0, verbose_name='Сотрудников')
+    articles = models.IntegerField(default=0, verbose_name='Статей')
+    total_views = models.BigIntegerField(default=0, verbose_name='Просмотров')
+    # Sum of article ratings, average rating is rating_sum / articles.
+    rating_sum = models.FloatField(default=0, verbose_name='Сумма рейтингов')
+    updated_at = models.DateTimeField(auto_now=True, verbose_name='Обновлено')
+
+    @property
+    def average_rating(self):
+        return round(self.rating_sum / self.articles, 2) if self.articles else 0
+
+    def __str__(self):
+        return str(self.company_id)
+
+    class Meta:
+        verbose_name = 'Статистика компании'
+        verbose_name_plural = 'Статистика компаний'
@@ -0,0 +1,13 @@
+from django.db.models.signals import post_delete, post_save
+
+from articles.models import AdvUser, Article
+from .models import Company
+from .stats import article_deleted, article_saved, company_saved, user_deleted, user_saved
+
+
+# Materialized company stats.
+post_save.connect(company_saved, sender=Company)
+post_save.connect(user_saved, sender=AdvUser)
+post_delete.connect(user_deleted, sender=AdvUser)
+post_save.connect(article_saved, sender=Article)
+post_delete.connect(article_deleted, sender=Article)
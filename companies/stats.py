@@ -0,0 +1,196 @@
+from collections import Counter, defaultdict
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from articles.snapshots import DEFERRED, current, loaded
+
+from .models import Company, CompanyStats
+
+COUNTERS = ('employees', 'articles', 'total_views', 'rating_sum')
+
+# Views of published articles not in the stats yet: {author id: views}. Kept by the process,
+# views of a process that exits before a flush are restored by rebuild_company_stats.
+_pending_views = Counter()
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+# Article fields its company stats depend on.
+ARTICLE_FIELDS = ('author_id', 'is_active', 'views', 'rating')
+
+
+# Stats of the given companies computed from users and articles: {company id: {counter: value}}.
+def compute_stats(company_ids):
+    from articles.models import AdvUser, Article
+    stats = {pk: dict.fromkeys(COUNTERS, 0) for pk in company_ids}
+    employees = (AdvUser.objects.filter(company__in=company_ids).order_by()
+                 .values('company').annotate(count=Count('pk')).values_list('company', 'count'))
+    for pk, count in employees:
+        stats[pk]['employees'] = count
+    articles = (Article.objects.filter(is_active=True, author__company__in=company_ids).order_by()
+                .values('author__company').annotate(count=Count('pk'), views=Sum('views'), rating=Sum('rating'))
+                .values_list('author__company', 'count', 'views', 'rating'))
+    for pk, count, views, rating in articles:
+        stats[pk].update(articles=count, total_views=views or 0, rating_sum=rating or 0)
+    return stats
+
+
+# Recomputes stats of the given companies (all when None) in batches of GROUP BY queries.
+# Repairs the drift after changes that bypass the receivers (raw SQL, bulk_create, lost updates
+# of concurrent saves). Returns number of companies.
+def rebuild_stats(company_ids=None, batch_size=500):
+    if company_ids is None:
+        company_ids = Company.objects.order_by('pk').values_list('pk', flat=True)
+    ids = list(company_ids)
+    for i in range(0, len(ids), batch_size):
+        stats = compute_stats(ids[i:i + batch_size])
+        with transaction.atomic():
+            CompanyStats.objects.bulk_create([CompanyStats(company_id=pk) for pk in stats], ignore_conflicts=True)
+            for pk, counters in stats.items():
+                CompanyStats.objects.filter(company_id=pk).update(updated_at=timezone.now(), **counters)
+    return len(ids)
+
+
+# Stats of a company, computed on the spot when the company has none yet.
+def get_stats(company):
+    try:
+        return company.stats
+    except CompanyStats.DoesNotExist:
+        rebuild_stats([company.pk])
+        return CompanyStats.objects.get(company=company)
+
+
+# Adds {company id: {counter: delta}} to the stats, one UPDATE per changed company.
+def apply_deltas(deltas):
+    for pk, counters in deltas.items():
+        counters = {name: value for name, value in counters.items() if value}
+        if pk is None or not counters:
+            continue
+        changes = {name: F(name) + value for name, value in counters.items()}
+        if not CompanyStats.objects.filter(company_id=pk).update(updated_at=timezone.now(), **changes):
+            # No row yet: computed from the data, which already includes the change.
+            rebuild_stats([pk])
+
+
+# Counts a view of a published article of the author. Views are added to the stats by
+# a task every COMPANY_VIEWS_FLUSH_INTERVAL seconds, one UPDATE per company instead of one per view.
+def add_view(author_id):
+    with _pending_lock:
+        _pending_views[author_id] += 1
+        due = time.monotonic() - _last_flush >= settings.COMPANY_VIEWS_FLUSH_INTERVAL
+    if due:
+        flush_views()
+
+
+# Queues the pending views of the process.
+def flush_views():
+    global _last_flush
+    with _pending_lock:
+        views = dict(_pending_views)
+        _pending_views.clear()
+        _last_flush = time.monotonic()
+    if views:
+        from .tasks import apply_author_views
+        apply_author_views.delay({str(author): count for author, count in views.items()})
+
+
+# Drops the pending views (tests).
+def reset_views():
+    with _pending_lock:
+        _pending_views.clear()
+
+
+# Adds views by author id to the stats of their companies.
+def apply_views(views):
+    from articles.models import AdvUser
+    companies = dict(AdvUser.objects.filter(pk__in=views, company__isnull=False).values_list('pk', 'company_id'))
+    deltas = defaultdict(Counter)
+    for author, count in views.items():
+        if author in companies:
+            deltas[companies[author]]['total_views'] += count
+    apply_deltas(deltas)
+
+
+def article_counters(is_active, views, rating):
+    return Counter(articles=1, total_views=views or 0, rating_sum=rating or 0) if is_active else Counter()
+
+
+# Company of an author, without a query when the article was loaded with its author.
+def _author_company(article, author_id):
+    from articles.models import Article
+    if Article.author.is_cached(article) and article.author.pk == author_id:
+        return article.author.company_id
+    from articles.models import AdvUser
+    return AdvUser.objects.filter(pk=author_id).values_list('company_id', flat=True).first()
+
+
+# post_save receiver for Article. Moves the article's share of the stats from what it was
+# when loaded to what it is now; no query unless a published article changed.
+def article_saved(sender, instance, created, **kwargs):
+    old = () if created else loaded(instance, *ARTICLE_FIELDS)
+    new = current(instance, *ARTICLE_FIELDS)
+    if old == new:
+        return
+    if DEFERRED in old + new:
+        # Loaded with deferred fields: the old share is unknown.
+        rebuild_stats([pk for pk in [_author_company(instance, instance.author_id)] if pk])
+        return
+    deltas = defaultdict(Counter)
+    if old and old[1]:
+        deltas[_author_company(instance, old[0])].subtract(article_counters(*old[1:]))
+    if new[1]:
+        deltas[_author_company(instance, new[0])].update(article_counters(*new[1:]))
+    apply_deltas(deltas)
+
+
+# post_delete receiver for Article.
+def article_deleted(sender, instance, **kwargs):
+    values = loaded(instance, *ARTICLE_FIELDS)
+    if DEFERRED in values:
+        values = current(instance, *ARTICLE_FIELDS)
+    if DEFERRED in values:
+        if instance.author_id is not None:
+            rebuild_stats([pk for pk in [_author_company(instance, instance.author_id)] if pk])
+    elif values[1]:
+        share = article_counters(*values[1:])
+        apply_deltas({_author_company(instance, values[0]): {name: -value for name, value in share.items()}})
+
+
+# post_save receiver for AdvUser: a user who changed company takes their articles along.
+def user_saved(sender, instance, created, **kwargs):
+    from articles.models import Article
+    old = None if created else loaded(instance, 'company_id')[0]
+    new = instance.company_id
+    if old == new:
+        return
+    if old is DEFERRED:
+        rebuild_stats([pk for pk in [new] if pk])
+        return
+    deltas = defaultdict(Counter)
+    deltas[new]['employees'] += 1
+    if not created:
+        deltas[old]['employees'] -= 1
+        share = (Article.objects.filter(author=instance, is_active=True)
+                 .aggregate(articles=Count('pk'), total_views=Sum('views'), rating_sum=Sum('rating')))
+        share = Counter({name: value or 0 for name, value in share.items()})
+        deltas[old].subtract(share)
+        deltas[new].update(share)
+    apply_deltas(deltas)
+
+
+# post_delete receiver for AdvUser (users with articles can't be deleted).
+def user_deleted(sender, instance, **kwargs):
+    company, = loaded(instance, 'company_id')
+    if company is DEFERRED:
+        company = instance.company_id
+    apply_deltas({company: {'employees': -1}})
+
+
+# post_save receiver for Company.
+def company_saved(sender, instance, created, **kwargs):
+    if created:
+        CompanyStats.objects.get_or_create(company=instance)
@@ -0,0 +1,9 @@
+from articles.task_queue import task
+
+from .stats import apply_views
+
+
+# Views counted by stats.add_view: {author id: views}, ids as strings (JSON keys).
+@task()
+def apply_author_views(views):
+    apply_views({int(author): count for author, count in views.items()})
@@ -1,3 +1,83 @@
-from django.test import TestCase
+from django.core.management import call_command
+from django.urls import reverse
+import io
 
-# Create your tests here.
+from articles.models import AdvUser, Article, Category
+from articles.moderation import approve_articles
+from articles.profiling import QueryBudgetMixin
+from articles.task_queue import run_pending
+from articles.tests import SiteTestCase
+from .models import Company, CompanyStats
+from .stats import compute_stats, flush_views, reset_views
+
+
+class CompanyPages(QueryBudgetMixin, SiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        reset_views()
+        self.company = Company.objects.create(name='Acme')
+        self.other = Company.objects.create(name='Globex')
+        self.category = Category.objects.create(name='python')
+        self.users = [AdvUser.objects.create_user(username=f'worker{i}', password='pass', company=self.company) for i in range(3)]
+        self.articles = [
+            Article.objects.create(category=self.category, author=self.users[i % 2], title=f't{i}', content='c',
+                                   views=10 * i, rating=i, is_active=i != 3)
+            for i in range(4)
+        ]
+
+    def assertStatsExact(self, *companies):
+        expected = compute_stats([company.pk for company in companies])
+        for company in companies:
+            stats = CompanyStats.objects.get(company=company)
+            self.assertEqual({name: getattr(stats, name) for name in expected[company.pk]}, expected[company.pk])
+
+    def test_stats_follow_changes(self):
+        stats = CompanyStats.objects.get(company=self.company)
+        self.assertEqual((stats.employees, stats.articles, stats.total_views, stats.average_rating), (3, 3, 30, 1))
+        article = Article.objects.get(pk=self.articles[3].pk)
+        article.is_active = True
+        article.save()
+        self.articles[0].change_rating(5, self.users[2])
+        views = CompanyStats.objects.get(company=self.company).total_views
+        self.client.get(reverse('articles:article', kwargs={'pk': self.articles[1].pk}))
+        # Views are added in batches.
+        self.assertEqual(CompanyStats.objects.get(company=self.company).total_views, views)
+        flush_views()
+        run_pending()
+        self.assertStatsExact(self.company, self.other)
+        # Moving to another company takes the articles along.
+        user = AdvUser.objects.get(pk=self.users[1].pk)
+        user.company = self.other
+        user.save()
+        self.assertStatsExact(self.company, self.other)
+        Article.objects.get(pk=self.articles[2].pk).delete()
+        AdvUser.objects.get(pk=self.users[2].pk).delete()
+        self.assertStatsExact(self.company, self.other)
+        self.assertEqual(CompanyStats.objects.get(company=self.company).employees, 1)
+
+    def test_moderation_updates_stats(self):
+        article = Article.objects.create(category=self.category, author=self.users[2], title='new', content='c', views=5)
+        approve_articles([article.pk])
+        self.assertStatsExact(self.company)
+        self.assertEqual(CompanyStats.objects.get(company=self.company).articles, 4)
+
+    def test_rebuild_repairs_drift(self):
+        CompanyStats.objects.update(employees=100, articles=0, total_views=0, rating_sum=0)
+        CompanyStats.objects.filter(company=self.other).delete()
+        call_command('rebuild_company_stats', stdout=io.StringIO())
+        self.assertStatsExact(self.company, self.other)
+
+    def test_pages_read_materialized_stats(self):
+        response = self.client.get(reverse('companies:company_list'))
+        self.assertContains(response, 'Acme')
+        self.assertContains(response, reverse('companies:company', kwargs={'pk': self.company.pk}))
+        url = reverse('companies:company', kwargs={'pk': self.company.pk})
+        # Session, company with stats, employees, articles: no aggregates.
+        with self.assertQueryBudget(4, max_repeats=1) as profile:
+            response = self.client.get(url)
+        self.assertFalse([sql for alias, sql, duration in profile.queries if 'COUNT(' in sql or 'SUM(' in sql])
+        self.assertEqual(response.context['stats'].articles, 3)
+        self.assertEqual([a.title for a in response.context['page']], ['t2', 't1', 't0'])
+        self.assertEqual([u.username for u in response.context['employees_page']], ['worker0', 'worker1', 'worker2'])
+        self.assertEqual(self.client.get(reverse('companies:company', kwargs={'pk': 999})).status_code, 404)
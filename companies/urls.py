@@ -0,0 +1,9 @@
+from django.urls import path
+
+from .views import company_detail, company_list
+
+app_name = 'companies'
+urlpatterns = [
+    path('<int:pk>/', company_detail, name='company'),
+    path('', company_list, name='company_list'),
+]
@@ -1,3 +1,34 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.shortcuts import get_object_or_404, render
 
-# Create your views here.
+from articles.models import AdvUser, Article
+from .models import Company
+from .stats import get_stats
+
+
+# Directory of companies with their stats, one query per page.
+def company_list(request):
+    companies = Company.objects.select_related('stats').order_by('name')
+    page = Paginator(companies, settings.COMPANIES_PER_PAGE).get_page(request.GET.get('page', 1))
+    return render(request, 'companies/company_list.html', {'companies': page.object_list, 'page': page})
+
+
+# Company page: stats, employees and their published articles. Paginators take their
+# counts from the stats, so the page runs no COUNT or GROUP BY over users and articles.
+def company_detail(request, pk):
+    company = get_object_or_404(Company.objects.select_related('stats'), pk=pk)
+    stats = get_stats(company)
+    employees = Paginator(AdvUser.objects.filter(company=company).order_by('username'),
+                          settings.COMPANY_EMPLOYEES_PER_PAGE)
+    employees.count = stats.employees
+    articles = Paginator(Article.objects.filter(author__company=company, is_active=True)
+                         .select_related('category', 'author').order_by('-created_at'), 9)
+    articles.count = stats.articles
+    context = {
+        'company': company,
+        'stats': stats,
+        'employees_page': employees.get_page(request.GET.get('employees', 1)),
+        'page': articles.get_page(request.GET.get('page', 1)),
+    }
+    return render(request, 'companies/company.html', context)
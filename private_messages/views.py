@@ -9,10 +9,12 @@ import json
 
 
 from articles.models import AdvUser
+from articles.ratelimit import rate_limit
 from .models import Message, Dialog
 from .forms import CreateMessageForm
 
 
+@rate_limit('autocomplete')
 def get_user_autocomplete(request):
 
     users = AdvUser.objects.filter(username__contains=request.POST['username']).order_by('username')[0:5]